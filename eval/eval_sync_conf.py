@@ -22,19 +22,31 @@ from latentsync.utils.util import red_text
 import torch
 
 
-def syncnet_eval(syncnet, syncnet_detector, video_path, temp_dir, detect_results_dir="detect_results"):
-    syncnet_detector(video_path=video_path, min_track=50)
-    crop_videos = os.listdir(os.path.join(detect_results_dir, "crop"))
-    if crop_videos == []:
-        raise Exception(red_text(f"Face not detected in {video_path}"))
+def syncnet_eval(
+    syncnet, syncnet_detector, video_path, temp_dir, detect_results_dir="detect_results", in_memory=False
+):
+    """in_memory decodes the video once and crops the faces in memory, temp_dir and detect_results_dir are unused"""
     av_offset_list = []
     conf_list = []
-    for video in crop_videos:
-        av_offset, _, conf = syncnet.evaluate(
-            video_path=os.path.join(detect_results_dir, "crop", video), temp_dir=temp_dir
-        )
-        av_offset_list.append(av_offset)
-        conf_list.append(conf)
+    if in_memory:
+        tracks = syncnet_detector.crop_tracks(video_path=video_path, min_track=50)
+        if tracks == []:
+            raise Exception(red_text(f"Face not detected in {video_path}"))
+        for faces, audio in tracks:
+            av_offset, _, conf = syncnet.evaluate_frames(faces, audio)
+            av_offset_list.append(av_offset)
+            conf_list.append(conf)
+    else:
+        syncnet_detector(video_path=video_path, min_track=50)
+        crop_videos = os.listdir(os.path.join(detect_results_dir, "crop"))
+        if crop_videos == []:
+            raise Exception(red_text(f"Face not detected in {video_path}"))
+        for video in crop_videos:
+            av_offset, _, conf = syncnet.evaluate(
+                video_path=os.path.join(detect_results_dir, "crop", video), temp_dir=temp_dir
+            )
+            av_offset_list.append(av_offset)
+            conf_list.append(conf)
     av_offset = int(fmean(av_offset_list))
     conf = fmean(conf_list)
     print(f"Input video: {video_path}\nSyncNet confidence: {conf:.2f}\nAV offset: {av_offset}")
@@ -47,6 +59,7 @@ def main():
     parser.add_argument("--video_path", type=str, default=None, help="")
     parser.add_argument("--videos_dir", type=str, default="/root/processed")
     parser.add_argument("--temp_dir", type=str, default="temp", help="")
+    parser.add_argument("--in_memory", action="store_true", help="evaluate without writing frames to disk")
 
     args = parser.parse_args()
 
@@ -58,14 +71,18 @@ def main():
     syncnet_detector = SyncNetDetector(device=device, detect_results_dir="detect_results")
 
     if args.video_path is not None:
-        syncnet_eval(syncnet, syncnet_detector, args.video_path, args.temp_dir)
+        syncnet_eval(syncnet, syncnet_detector, args.video_path, args.temp_dir, in_memory=args.in_memory)
     else:
         sync_conf_list = []
         video_names = sorted([f for f in os.listdir(args.videos_dir) if f.endswith(".mp4")])
         for video_name in tqdm.tqdm(video_names):
             try:
                 _, conf = syncnet_eval(
-                    syncnet, syncnet_detector, os.path.join(args.videos_dir, video_name), args.temp_dir
+                    syncnet,
+                    syncnet_detector,
+                    os.path.join(args.videos_dir, video_name),
+                    args.temp_dir,
+                    in_memory=args.in_memory,
                 )
                 sync_conf_list.append(conf)
             except Exception as e:
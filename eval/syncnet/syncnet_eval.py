@@ -72,15 +72,26 @@ class SyncNetEval(torch.nn.Module):
         # Load video
         # ========== ==========
 
-        images = []
-
         flist = glob.glob(os.path.join(temp_dir, "*.jpg"))
         flist.sort()
+        images = [cv2.imread(fname) for fname in flist]
+
+        # ========== ==========
+        # Load audio
+        # ========== ==========
+
+        sample_rate, audio = wavfile.read(os.path.join(temp_dir, "audio.wav"))
+
+        results = self.evaluate_frames(images, audio, sample_rate, batch_size=batch_size, vshift=vshift)
+        rmtree(temp_dir)
+        return results
 
-        for fname in flist:
-            img_input = cv2.imread(fname)
-            img_input = cv2.resize(img_input, (224, 224))  # HARD CODED, CHANGE BEFORE RELEASE
-            images.append(img_input)
+    def evaluate_frames(self, images, audio, sample_rate=16000, batch_size=20, vshift=15):
+        """images: the BGR face crops at 25 fps, audio: int16 samples, returns (av_offset, min_dist, conf)"""
+
+        self.__S__.eval()
+
+        images = [cv2.resize(img_input, (224, 224)) for img_input in images]  # HARD CODED, CHANGE BEFORE RELEASE
 
         im = numpy.stack(images, axis=3)
         im = numpy.expand_dims(im, axis=0)
@@ -88,11 +99,6 @@ class SyncNetEval(torch.nn.Module):
 
         imtv = torch.autograd.Variable(torch.from_numpy(im.astype(float)).float())
 
-        # ========== ==========
-        # Load audio
-        # ========== ==========
-
-        sample_rate, audio = wavfile.read(os.path.join(temp_dir, "audio.wav"))
         mfcc = zip(*python_speech_features.mfcc(audio, sample_rate))
         mfcc = numpy.stack([numpy.array(i) for i in mfcc])
 
@@ -155,7 +161,6 @@ class SyncNetEval(torch.nn.Module):
         framewise_conf = signal.medfilt(fconf, kernel_size=9)
 
         # numpy.set_printoptions(formatter={"float": "{: 0.3f}".format})
-        rmtree(temp_dir)
         return av_offset.item(), min_dist.item(), conf.item()
 
     def extract_feature(self, opt, videofile):
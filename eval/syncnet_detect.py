@@ -5,8 +5,9 @@ import numpy as np
 from shutil import rmtree
 import torch
 
+from decord import AudioReader, VideoReader
 from scenedetect.video_manager import VideoManager
-from scenedetect.scene_manager import SceneManager
+from scenedetect.scene_manager import SceneManager, compute_downscale_factor
 from scenedetect.stats_manager import StatsManager
 from scenedetect.detectors import ContentDetector
 
@@ -16,6 +17,9 @@ from scipy import signal
 
 from eval.detectors import S3FD
 
+VIDEO_FPS = 25
+AUDIO_SAMPLE_RATE = 16000
+
 
 class SyncNetDetector:
     def __init__(self, device, detect_results_dir="detect_results"):
@@ -82,6 +86,36 @@ class SyncNetDetector:
 
         rmtree(temp_dir)
 
+    def crop_tracks(self, video_path: str, min_track=50, scale=False):
+        """
+        In-memory version of __call__, the video is decoded once and nothing is written to disk. Returns the face
+        crops (BGR, 224x224) and the int16 audio at 16 kHz of every track, what SyncNetEval.evaluate_frames takes.
+        The whole video is held in memory, it is meant for short clips like the preprocessed and validation videos
+        """
+        frames = read_frames(video_path)
+        if scale:
+            frames = np.stack([cv2.resize(frame, (224, 224)) for frame in frames])
+        audio = read_audio(video_path)
+
+        faces = self.detect_face_frames(frames)
+
+        # The scenes and the crops are computed on BGR frames, like the frames read by OpenCV
+        frames = np.ascontiguousarray(frames[..., ::-1])
+        scene = self.scene_detect_frames(frames)
+
+        samples_per_frame = AUDIO_SAMPLE_RATE // VIDEO_FPS
+        tracks = []
+        for start, end in scene:
+            if end - start >= min_track:
+                for track in self.track_face(faces[start:end], min_track=min_track):
+                    dets = smooth_track(track)
+                    crops = [crop_face(frames[frame], dets, fidx) for fidx, frame in enumerate(track["frame"])]
+                    # The audio cut at the times of the first and last frames of the track
+                    audio_start = track["frame"][0] * samples_per_frame
+                    audio_end = (track["frame"][-1] + 1) * samples_per_frame
+                    tracks.append((crops, audio[audio_start:audio_end]))
+        return tracks
+
     def scene_detect(self, video_dir):
         video_manager = VideoManager([os.path.join(video_dir, "video.mp4")])
         stats_manager = StatsManager()
@@ -103,6 +137,22 @@ class SyncNetDetector:
 
         return scene_list
 
+    def scene_detect_frames(self, frames):
+        """The (start, end) frames of the scenes of scene_detect, from BGR frames"""
+        detector = ContentDetector()
+        # Downscaled like the default of VideoManager.set_downscale_factor
+        downscale = compute_downscale_factor(frames.shape[2])
+        cuts = []
+        for frame_num, frame in enumerate(frames):
+            if downscale > 1:
+                size = (round(frame.shape[1] / downscale), round(frame.shape[0] / downscale))
+                frame = cv2.resize(frame, size, interpolation=cv2.INTER_LINEAR)
+            cuts.extend(detector.process_frame(frame_num, frame))
+        cuts.extend(detector.post_process(len(frames)))
+
+        boundaries = [0] + cuts + [len(frames)]
+        return list(zip(boundaries[:-1], boundaries[1:]))
+
     def track_face(self, scenefaces, num_failed_det=25, min_track=50, min_face_size=100):
 
         iouThres = 0.5  # Minimum IOU between consecutive face detections
@@ -151,12 +201,14 @@ class SyncNetDetector:
         flist = glob.glob(os.path.join(frames_dir, "*.jpg"))
         flist.sort()
 
-        dets = []
+        frames = (cv2.cvtColor(cv2.imread(fname), cv2.COLOR_BGR2RGB) for fname in flist)
+        return self.detect_face_frames(frames, facedet_scale)
 
-        for fidx, fname in enumerate(flist):
-            image = cv2.imread(fname)
+    def detect_face_frames(self, frames, facedet_scale=0.25):
+        """frames: RGB"""
+        dets = []
 
-            image_np = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+        for fidx, image_np in enumerate(frames):
             bboxes = self.s3f_detector.detect_faces(image_np, conf_th=0.9, scales=[facedet_scale])
 
             dets.append([])
@@ -173,35 +225,11 @@ class SyncNetDetector:
         fourcc = cv2.VideoWriter_fourcc(*"mp4v")
         vOut = cv2.VideoWriter(cropfile + "t.mp4", fourcc, frame_rate, (224, 224))
 
-        dets = {"x": [], "y": [], "s": []}
-
-        for det in track["bbox"]:
-
-            dets["s"].append(max((det[3] - det[1]), (det[2] - det[0])) / 2)
-            dets["y"].append((det[1] + det[3]) / 2)  # crop center x
-            dets["x"].append((det[0] + det[2]) / 2)  # crop center y
-
-        # Smooth detections
-        dets["s"] = signal.medfilt(dets["s"], kernel_size=13)
-        dets["x"] = signal.medfilt(dets["x"], kernel_size=13)
-        dets["y"] = signal.medfilt(dets["y"], kernel_size=13)
+        dets = smooth_track(track)
 
         for fidx, frame in enumerate(track["frame"]):
-
-            cs = crop_scale
-
-            bs = dets["s"][fidx]  # Detection box size
-            bsi = int(bs * (1 + 2 * cs))  # Pad videos by this amount
-
             image = cv2.imread(flist[frame])
-
-            frame = np.pad(image, ((bsi, bsi), (bsi, bsi), (0, 0)), "constant", constant_values=(110, 110))
-            my = dets["y"][fidx] + bsi  # BBox center Y
-            mx = dets["x"][fidx] + bsi  # BBox center X
-
-            face = frame[int(my - bs) : int(my + bs * (1 + 2 * cs)), int(mx - bs * (1 + cs)) : int(mx + bs * (1 + cs))]
-
-            vOut.write(cv2.resize(face, (224, 224)))
+            vOut.write(crop_face(image, dets, fidx, crop_scale))
 
         audiotmp = os.path.join(temp_dir, "audio.wav")
         audiostart = (track["frame"][0]) / frame_rate
@@ -235,6 +263,53 @@ class SyncNetDetector:
         return {"track": track, "proc_track": dets}
 
 
+def smooth_track(track):
+    dets = {"x": [], "y": [], "s": []}
+
+    for det in track["bbox"]:
+
+        dets["s"].append(max((det[3] - det[1]), (det[2] - det[0])) / 2)
+        dets["y"].append((det[1] + det[3]) / 2)  # crop center x
+        dets["x"].append((det[0] + det[2]) / 2)  # crop center y
+
+    # Smooth detections
+    dets["s"] = signal.medfilt(dets["s"], kernel_size=13)
+    dets["x"] = signal.medfilt(dets["x"], kernel_size=13)
+    dets["y"] = signal.medfilt(dets["y"], kernel_size=13)
+    return dets
+
+
+def crop_face(image, dets, fidx, crop_scale=0.4):
+    cs = crop_scale
+
+    bs = dets["s"][fidx]  # Detection box size
+    bsi = int(bs * (1 + 2 * cs))  # Pad videos by this amount
+
+    frame = np.pad(image, ((bsi, bsi), (bsi, bsi), (0, 0)), "constant", constant_values=(110, 110))
+    my = dets["y"][fidx] + bsi  # BBox center Y
+    mx = dets["x"][fidx] + bsi  # BBox center X
+
+    face = frame[int(my - bs) : int(my + bs * (1 + 2 * cs)), int(mx - bs * (1 + cs)) : int(mx + bs * (1 + cs))]
+    return cv2.resize(face, (224, 224))
+
+
+def read_frames(video_path: str, fps: int = VIDEO_FPS):
+    """RGB frames at fps, dropping or repeating source frames like ffmpeg -r"""
+    vr = VideoReader(video_path)
+    source_fps = vr.get_avg_fps()
+    num_frames = int(round(len(vr) * fps / source_fps))
+    indices = np.minimum(np.round(np.arange(num_frames) * source_fps / fps).astype(int), len(vr) - 1)
+    frames = vr.get_batch(indices).asnumpy()
+    vr.seek(0)
+    return frames
+
+
+def read_audio(video_path: str):
+    """Mono 16 kHz int16 samples, like the pcm_s16le WAV extracted by ffmpeg"""
+    audio = AudioReader(video_path, sample_rate=AUDIO_SAMPLE_RATE, mono=True)[:].asnumpy()[0]
+    return np.clip(np.round(audio * 32768), -32768, 32767).astype(np.int16)
+
+
 def bounding_box_iou(boxA, boxB):
     xA = max(boxA[0], boxB[0])
     yA = max(boxA[1], boxB[1])
@@ -0,0 +1,172 @@
+# Copyright (c) 2024 Bytedance Ltd. and/or its affiliates
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import random
+
+import numpy as np
+import torch
+from torch.utils.data import IterableDataset
+
+from .latent_dataset import LatentSyncNetDataset, LatentUNetDataset
+from .shards import ShardVideoReader
+
+
+class ClipLocalityDataset(IterableDataset):
+    """
+    Serves the samples of a UNetDataset or a SyncNetDataset video by video. A worker opens a video once, decodes one
+    contiguous span of span_frames frames and samples windows_per_video training windows from it, instead of paying
+    for a container open, an index build and a seek for every sample. The windows pass through a per-worker shuffle
+    buffer of shuffle_buffer_size samples, which mixes about shuffle_buffer_size / windows_per_video videos. The
+    DataLoader builds each batch of an IterableDataset from a single worker, wrap it in a BatchMixer to get batches
+    that mix the samples of all the workers.
+
+    The order only depends on (seed, epoch, rank, worker): every epoch the videos are shuffled with the seed and the
+    epoch and split between the ranks, then between the workers, and each worker samples from its own seeded
+    random.Random. set_epoch must be called before the epoch's iterator is created, like DistributedSampler.set_epoch.
+    """
+
+    def __init__(
+        self,
+        dataset,
+        windows_per_video: int = 4,
+        span_frames: int = 96,
+        shuffle_buffer_size: int = 16,
+        num_replicas: int = 1,
+        rank: int = 0,
+        seed: int = 0,
+    ):
+        if isinstance(dataset, (LatentUNetDataset, LatentSyncNetDataset)):
+            raise ValueError("The clip-locality sampler decodes videos, it doesn't support the latent cache")
+        # The span has to hold the positive and the negative windows
+        if span_frames < 3 * dataset.num_frames:
+            raise ValueError(f"span_frames must be at least 3 * num_frames = {3 * dataset.num_frames}")
+        self.dataset = dataset
+        self.windows_per_video = windows_per_video
+        self.span_frames = span_frames
+        self.shuffle_buffer_size = shuffle_buffer_size
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+
+    def __len__(self):
+        # Every rank serves the same number of samples, so that no rank runs out of data before the others
+        return len(self.dataset) // self.num_replicas * self.windows_per_video
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    def worker_init_fn(self, worker_id):
+        self.dataset.worker_init_fn(worker_id)
+
+    def worker_videos(self, worker_id: int, num_workers: int):
+        videos = list(self.dataset.indices)
+        random.Random(f"{self.seed}-{self.epoch}").shuffle(videos)
+        videos = videos[: len(self.dataset) // self.num_replicas * self.num_replicas]
+        return videos[self.rank :: self.num_replicas][worker_id::num_workers]
+
+    def windows(self, videos, rng: random.Random):
+        """Yields the windows of the videos, going around them again when some of them failed"""
+        for position in range(len(videos) * 1000):
+            idx = videos[position % len(videos)]
+            video_path = self.dataset.video_paths[idx]
+            try:
+                vr = self.dataset.open_video(idx)
+                span_length = min(len(vr), self.span_frames)
+                span_start = rng.randint(0, len(vr) - span_length)
+                span = vr.get_batch(np.arange(span_start, span_start + span_length, dtype=int)).asnumpy()
+                vr.seek(0)  # avoid memory leak
+            except Exception as e:
+                print(f"{type(e).__name__} - {e} - {video_path}")
+                continue
+
+            span_reader = ShardVideoReader(span)
+            for _ in range(self.windows_per_video):
+                try:
+                    sample = self.dataset.sample_from_video(idx, span_reader, frame_offset=span_start)
+                except Exception as e:  # Handle the exception of face not detcted
+                    print(f"{type(e).__name__} - {e} - {video_path}")
+                    continue
+                if sample is not None:
+                    yield sample
+        raise RuntimeError("No training window could be sampled from the videos of the worker")
+
+    def __iter__(self):
+        worker_info = torch.utils.data.get_worker_info()
+        worker_id, num_workers = (0, 1) if worker_info is None else (worker_info.id, worker_info.num_workers)
+        rng = random.Random(f"{self.seed}-{self.epoch}-{self.rank}-{worker_id}")
+        self.dataset.rng = rng
+
+        videos = self.worker_videos(worker_id, num_workers)
+        if len(videos) == 0:
+            return
+        # An equal share per worker, the windows of a failed video are made up from the next ones
+        num_samples = len(self) // num_workers
+        windows = self.windows(videos, rng)
+
+        buffer = []
+        for remaining in range(num_samples, 0, -1):
+            while len(buffer) < min(self.shuffle_buffer_size, remaining):
+                buffer.append(next(windows))
+            index = rng.randrange(len(buffer))
+            buffer[index], buffer[-1] = buffer[-1], buffer[index]
+            yield buffer.pop()
+
+
+class BatchMixer:
+    """
+    Wraps the DataLoader of a ClipLocalityDataset and re-deals the samples of every num_batches consecutive batches in
+    a random order, the sizes of the batches are kept. The DataLoader takes the batches from its workers in turn, so
+    with num_batches = num_workers every batch mixes the samples of all the workers. The order depends on the seed,
+    the epoch and the rank of the dataset.
+    """
+
+    def __init__(self, dataloader, num_batches: int):
+        self.dataloader = dataloader
+        self.num_batches = num_batches
+
+    def __len__(self):
+        return len(self.dataloader)
+
+    def mix(self, batches, rng: random.Random):
+        sizes = [next(len(value) for value in batch.values() if isinstance(value, torch.Tensor)) for batch in batches]
+        order = list(range(sum(sizes)))
+        rng.shuffle(order)
+        mixed = {}
+        for key, value in batches[0].items():
+            if isinstance(value, torch.Tensor):
+                mixed[key] = torch.cat([batch[key] for batch in batches])[torch.tensor(order)]
+            elif isinstance(value, list) and len(value) == sizes[0]:
+                values = [item for batch in batches for item in batch[key]]
+                mixed[key] = [values[i] for i in order]
+            else:
+                mixed[key] = value  # Not per sample, e.g. the empty mel list when the audio isn't loaded
+        start = 0
+        for size in sizes:
+            yield {
+                key: value[start : start + size] if len(value) == len(order) else value for key, value in mixed.items()
+            }
+            start += size
+
+    def __iter__(self):
+        dataset = self.dataloader.dataset
+        rng = random.Random(f"{dataset.seed}-{dataset.epoch}-{dataset.rank}-mix")
+        batches = []
+        for batch in self.dataloader:
+            batches.append(batch)
+            if len(batches) == self.num_batches:
+                yield from self.mix(batches, rng)
+                batches = []
+        if len(batches) > 0:
+            yield from self.mix(batches, rng)
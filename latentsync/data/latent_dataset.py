@@ -0,0 +1,176 @@
+# Copyright (c) 2024 Bytedance Ltd. and/or its affiliates
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+
+import torch
+
+from .unet_dataset import UNetDataset
+from .syncnet_dataset import SyncNetDataset
+from ..utils.feature_store import FeatureStore
+from ..whisper.audio2feature import get_sliced_features
+
+# Layout of the cached tensor of a video: (num_frames, 4, latent_channels, latent_height, latent_width), where the
+# second dimension holds the VAE posterior of the frames and of the frames with the fixed mask applied
+LATENT_MEAN = 0
+LATENT_STD = 1
+MASKED_LATENT_MEAN = 2
+MASKED_LATENT_STD = 3
+
+
+def latents_cache_key(video_path: str) -> str:
+    return os.path.basename(video_path).replace(".mp4", "_latents")
+
+
+def sample_posterior(latents: torch.Tensor, mean_slot: int, std_slot: int) -> torch.Tensor:
+    """Same as DiagonalGaussianDistribution.sample, from the stored mean and std"""
+    mean = latents[:, mean_slot].float()
+    std = latents[:, std_slot].float()
+    return mean + std * torch.randn_like(mean)
+
+
+class LatentUNetDataset(UNetDataset):
+    """
+    Serves VAE latents sampled from the posteriors cached by preprocess/build_latent_cache.py instead of pixels, so
+    that the training step doesn't run the VAE encoder. The latents are not scaled yet.
+    """
+
+    def __init__(self, train_data_dir: str, config):
+        super().__init__(train_data_dir, config)
+        if self.mask != "fix_mask":
+            raise ValueError("The latent cache only supports the fixed mask")
+        self.latent_store = FeatureStore(config.data.latent_cache_dir)
+
+    def num_latents(self, idx):
+        shape = self.latent_store.shape(latents_cache_key(self.video_paths[idx]))
+        if shape is None:
+            raise RuntimeError("Latents are not cached, run preprocess/build_latent_cache.py")
+        return shape[0]
+
+    def load_latents(self, idx, start_idx):
+        # Only the window is read from the store, not the latents of the whole video
+        return self.latent_store.get(latents_cache_key(self.video_paths[idx]), start_idx, start_idx + self.num_frames)
+
+    def __getitem__(self, idx):
+        video_path = None
+        while True:
+            try:
+                idx = self.rng.choice(self.indices)
+                video_path = self.video_paths[idx]
+
+                num_latents = self.num_latents(idx)
+
+                start_range = self.start_range(idx, num_latents)
+                if num_latents < 3 * self.num_frames or start_range is None:
+                    continue
+
+                start_idx, ref_start_idx = self.sample_start_indices(num_latents, start_range)
+
+                if self.load_audio_data:
+                    original_mel = self.load_mel(idx)
+                    mel = self.crop_audio_window(original_mel, start_idx)
+
+                    if mel.shape[-1] != self.mel_window_length:
+                        continue
+                else:
+                    mel = []
+
+                if self.load_audio_embeds:
+                    audio_embeds = get_sliced_features(
+                        self.load_audio_feat(idx), range(start_idx, start_idx + self.num_frames)
+                    )
+                else:
+                    audio_embeds = []
+
+                window = self.load_latents(idx, start_idx)
+                ref_window = self.load_latents(idx, ref_start_idx)
+                gt_latents = sample_posterior(window, LATENT_MEAN, LATENT_STD)
+                masked_gt_latents = sample_posterior(window, MASKED_LATENT_MEAN, MASKED_LATENT_STD)
+                ref_latents = sample_posterior(ref_window, LATENT_MEAN, LATENT_STD)
+                break
+
+            except Exception as e:
+                print(f"{type(e).__name__} - {e} - {video_path}")
+
+        mask = self.mask_image[0:1].unsqueeze(0).repeat(self.num_frames, 1, 1, 1)
+
+        sample = dict(
+            gt_latents=gt_latents,
+            masked_gt_latents=masked_gt_latents,
+            ref_latents=ref_latents,
+            mel=mel,
+            audio_embeds=audio_embeds,
+            mask=mask,
+            video_path=video_path,
+            start_idx=start_idx,
+        )
+
+        return sample
+
+
+class LatentSyncNetDataset(SyncNetDataset):
+    """SyncNetDataset for latent-space training, the frames are latents sampled from the cached posteriors"""
+
+    def __init__(self, data_dir: str, fileslist: str, config):
+        super().__init__(data_dir, fileslist, config)
+        self.latent_store = FeatureStore(config.data.latent_cache_dir)
+
+    def num_latents(self, idx):
+        shape = self.latent_store.shape(latents_cache_key(self.video_paths[idx]))
+        if shape is None:
+            raise RuntimeError("Latents are not cached, run preprocess/build_latent_cache.py")
+        return shape[0]
+
+    def load_latents(self, idx, start_idx):
+        # Only the window is read from the store, not the latents of the whole video
+        return self.latent_store.get(latents_cache_key(self.video_paths[idx]), start_idx, start_idx + self.num_frames)
+
+    def __getitem__(self, idx):
+        video_path = None
+        while True:
+            try:
+                idx = self.rng.choice(self.indices)
+                video_path = self.video_paths[idx]
+
+                num_latents = self.num_latents(idx)
+
+                start_range = self.start_range(idx, num_latents)
+                if num_latents < 2 * self.num_frames or start_range is None:
+                    continue
+
+                start_idx, wrong_start_idx = self.sample_start_indices(num_latents, start_range)
+
+                original_mel = self.load_mel(idx)
+                mel = self.crop_audio_window(original_mel, start_idx)
+
+                if mel.shape[-1] != self.mel_window_length:
+                    continue
+
+                if self.rng.choice([True, False]):
+                    y = torch.ones(1).float()
+                    chosen_start_idx = start_idx
+                else:
+                    y = torch.zeros(1).float()
+                    chosen_start_idx = wrong_start_idx
+
+                window = self.load_latents(idx, chosen_start_idx)
+                chosen_frames = sample_posterior(window, LATENT_MEAN, LATENT_STD)
+                break
+
+            except Exception as e:
+                print(f"{type(e).__name__} - {e} - {video_path}")
+
+        sample = dict(frames=chosen_frames, audio_samples=mel, y=y)
+
+        return sample
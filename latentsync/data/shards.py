@@ -0,0 +1,212 @@
+# Copyright (c) 2024 Bytedance Ltd. and/or its affiliates
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Packed training data: the aligned frames, mel spectrograms and whisper features of many videos are appended to a few
+large raw files per shard, and index.json records where each video starts. Windows are sliced from memory-mapped
+shards, so nothing has to be decoded at training time.
+
+<shards_dir>/index.json
+<shards_dir>/<shard>.frames.bin     uint8, (num_frames, resolution, resolution, 3)
+<shards_dir>/<shard>.mel.bin        float32, (num_mel_frames, 80)
+<shards_dir>/<shard>.whisper.bin    float16, (num_whisper_frames, layers, dim), optional
+"""
+
+import os
+import json
+
+import numpy as np
+import torch
+
+from .unet_dataset import UNetDataset
+from .syncnet_dataset import SyncNetDataset
+
+INDEX_NAME = "index.json"
+NUM_MELS = 80
+
+
+class ShardWriter:
+    """Appends videos to the files of the current shard, a new shard is started once max_shard_frames is reached"""
+
+    def __init__(self, shards_dir: str, prefix: str, resolution: int, max_shard_frames: int = 50000):
+        self.shards_dir = shards_dir
+        self.prefix = prefix
+        self.resolution = resolution
+        self.max_shard_frames = max_shard_frames
+        self.whisper_shape = None
+        self.entries = []
+        self.shard_idx = -1
+        self.files = {}
+        os.makedirs(shards_dir, exist_ok=True)
+        self.next_shard()
+
+    def next_shard(self):
+        self.close()
+        self.shard_idx += 1
+        self.shard_name = f"{self.prefix}_{self.shard_idx:05d}"
+        self.files = {
+            kind: open(os.path.join(self.shards_dir, f"{self.shard_name}.{kind}.bin"), "wb")
+            for kind in ("frames", "mel", "whisper")
+        }
+        self.offsets = {"frames": 0, "mel": 0, "whisper": 0}
+
+    def write(self, kind: str, array: np.ndarray):
+        offset = self.offsets[kind]
+        self.files[kind].write(np.ascontiguousarray(array).tobytes())
+        self.offsets[kind] += len(array)
+        return offset
+
+    def add(self, video_path: str, frames: np.ndarray, mel: np.ndarray, whisper_feature: np.ndarray = None):
+        """
+        frames: uint8 (num_frames, resolution, resolution, 3), mel: (80, num_mel_frames) as returned by
+        melspectrogram, whisper_feature: (num_whisper_frames, layers, dim) as returned by Audio2Feature
+        """
+        assert frames.shape[1:] == (self.resolution, self.resolution, 3), f"Unexpected frames shape {frames.shape}"
+        if self.offsets["frames"] > 0 and self.offsets["frames"] + len(frames) > self.max_shard_frames:
+            self.next_shard()
+
+        entry = dict(
+            video_path=video_path,
+            shard=self.shard_name,
+            frame_offset=self.write("frames", frames.astype(np.uint8)),
+            num_frames=len(frames),
+            mel_offset=self.write("mel", mel.T.astype(np.float32)),
+            mel_length=mel.shape[1],
+        )
+        if whisper_feature is not None:
+            self.whisper_shape = list(whisper_feature.shape[1:])
+            entry["whisper_offset"] = self.write("whisper", whisper_feature.astype(np.float16))
+            entry["whisper_length"] = len(whisper_feature)
+        self.entries.append(entry)
+
+    def close(self):
+        for file in self.files.values():
+            file.close()
+        self.files = {}
+
+
+def write_index(shards_dir: str, entries: list, resolution: int, whisper_shape=None):
+    index = dict(resolution=resolution, whisper_shape=whisper_shape, entries=entries)
+    with open(os.path.join(shards_dir, INDEX_NAME), "w") as f:
+        json.dump(index, f)
+
+
+class ShardReader:
+    """Memory-maps the shards lazily, so that every dataloader worker maps them in its own process"""
+
+    def __init__(self, shards_dir: str):
+        self.shards_dir = shards_dir
+        with open(os.path.join(shards_dir, INDEX_NAME)) as f:
+            index = json.load(f)
+        self.resolution = index["resolution"]
+        self.whisper_shape = index["whisper_shape"]
+        self.entries = index["entries"]
+        self.video_paths = [entry["video_path"] for entry in self.entries]
+        self.memmaps = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["memmaps"] = {}
+        return state
+
+    def memmap(self, shard: str, kind: str):
+        if (shard, kind) not in self.memmaps:
+            path = os.path.join(self.shards_dir, f"{shard}.{kind}.bin")
+            if kind == "frames":
+                dtype, row_shape = np.uint8, (self.resolution, self.resolution, 3)
+            elif kind == "mel":
+                dtype, row_shape = np.float32, (NUM_MELS,)
+            else:
+                if self.whisper_shape is None:
+                    raise ValueError(f"The shards in {self.shards_dir} were packed without whisper features")
+                dtype, row_shape = np.float16, tuple(self.whisper_shape)
+            self.memmaps[(shard, kind)] = np.memmap(path, dtype=dtype, mode="r").reshape(-1, *row_shape)
+        return self.memmaps[(shard, kind)]
+
+    def frames(self, idx: int) -> np.ndarray:
+        entry = self.entries[idx]
+        frames = self.memmap(entry["shard"], "frames")
+        return frames[entry["frame_offset"] : entry["frame_offset"] + entry["num_frames"]]
+
+    def mel(self, idx: int) -> torch.Tensor:
+        entry = self.entries[idx]
+        mel = self.memmap(entry["shard"], "mel")[entry["mel_offset"] : entry["mel_offset"] + entry["mel_length"]]
+        return torch.from_numpy(np.ascontiguousarray(mel.T))
+
+    def whisper_feature(self, idx: int) -> torch.Tensor:
+        entry = self.entries[idx]
+        feature = self.memmap(entry["shard"], "whisper")
+        feature = feature[entry["whisper_offset"] : entry["whisper_offset"] + entry["whisper_length"]]
+        return torch.from_numpy(np.array(feature))
+
+
+class ShardFrames:
+    def __init__(self, frames: np.ndarray):
+        self.frames = frames
+
+    def asnumpy(self):
+        return self.frames
+
+
+class ShardVideoReader:
+    """The part of decord's VideoReader interface used by the datasets, served from a memory-mapped shard"""
+
+    def __init__(self, frames: np.ndarray):
+        self.frames = frames
+
+    def __len__(self):
+        return len(self.frames)
+
+    def get_batch(self, indices):
+        # Fancy indexing copies only the requested frames out of the mapping
+        return ShardFrames(self.frames[np.asarray(indices)])
+
+    def seek(self, pos):
+        pass
+
+
+class ShardUNetDataset(UNetDataset):
+    def __init__(self, shards_dir: str, config):
+        self.shards = ShardReader(shards_dir)
+        super().__init__(shards_dir, config)
+
+    def load_video_paths(self, train_data_dir: str, config):
+        return self.shards.video_paths
+
+    def open_video(self, idx):
+        return ShardVideoReader(self.shards.frames(idx))
+
+    def load_mel(self, idx):
+        return self.shards.mel(idx)
+
+    def load_audio_feat(self, idx):
+        return self.shards.whisper_feature(idx)
+
+
+class ShardSyncNetDataset(SyncNetDataset):
+    def __init__(self, shards_dir: str, config):
+        self.shards = ShardReader(shards_dir)
+        super().__init__(shards_dir, "", config)
+
+    def load_video_paths(self, data_dir: str, fileslist: str):
+        return self.shards.video_paths
+
+    def open_video(self, idx):
+        return ShardVideoReader(self.shards.frames(idx))
+
+    def load_mel(self, idx):
+        return self.shards.mel(idx)
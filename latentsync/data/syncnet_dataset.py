@@ -20,20 +20,19 @@ import random
 from ..utils.util import gather_video_paths_recursively
 from ..utils.image_processor import ImageProcessor
 from ..utils.audio import melspectrogram
+from ..utils.feature_store import FeatureStore
+from .validity_index import apply_validity_index
 import math
 
 from decord import AudioReader, VideoReader, cpu
 
 
 class SyncNetDataset(Dataset):
+    # Source of the sampling randomness, the clip-locality sampler gives each worker a seeded random.Random
+    rng = random
+
     def __init__(self, data_dir: str, fileslist: str, config):
-        if fileslist != "":
-            with open(fileslist) as file:
-                self.video_paths = [line.rstrip() for line in file]
-        elif data_dir != "":
-            self.video_paths = gather_video_paths_recursively(data_dir)
-        else:
-            raise ValueError("data_dir and fileslist cannot be both empty")
+        self.video_paths = self.load_video_paths(data_dir, fileslist)
 
         self.resolution = config.data.resolution
         self.num_frames = config.data.num_frames
@@ -48,9 +47,67 @@ class SyncNetDataset(Dataset):
         self.image_processor = ImageProcessor(resolution=config.data.resolution, mask="half")
         self.audio_mel_cache_dir = config.data.audio_mel_cache_dir
         os.makedirs(self.audio_mel_cache_dir, exist_ok=True)
+        # A consolidated feature store replaces the per-video mel cache files when set
+        audio_mel_store_dir = config.data.get("audio_mel_store_dir", "")
+        self.mel_store = FeatureStore(audio_mel_store_dir) if audio_mel_store_dir != "" else None
+
+        # Videos and window starts checked offline by preprocess/build_validity_index.py, so no sample is rejected
+        self.indices = list(range(len(self.video_paths)))
+        self.start_ranges = {}
+        validity_index_path = config.data.get("validity_index_path", "")
+        if validity_index_path != "":
+            self.indices, self.start_ranges = apply_validity_index(
+                self.video_paths,
+                validity_index_path,
+                self.num_frames,
+                margin=0,
+                min_video_frames=2 * self.num_frames,
+                mel_window_length=self.mel_window_length,
+                video_fps=self.video_fps,
+            )
+
+    def load_video_paths(self, data_dir: str, fileslist: str):
+        if fileslist != "":
+            with open(fileslist) as file:
+                video_paths = [line.rstrip() for line in file]
+        elif data_dir != "":
+            video_paths = gather_video_paths_recursively(data_dir)
+        else:
+            raise ValueError("data_dir and fileslist cannot be both empty")
+        return video_paths
 
     def __len__(self):
-        return len(self.video_paths)
+        return len(self.indices)
+
+    def open_video(self, idx):
+        return VideoReader(self.video_paths[idx], ctx=cpu(self.worker_id))
+
+    def load_mel(self, idx):
+        video_path = self.video_paths[idx]
+        if self.mel_store is not None:
+            key = os.path.basename(video_path).replace(".mp4", "_mel")
+            original_mel = self.mel_store.get(key)
+            if original_mel is None:
+                original_mel = self.read_audio(video_path)
+                self.mel_store.put(key, original_mel)
+            return original_mel
+
+        mel_cache_path = os.path.join(
+            self.audio_mel_cache_dir, os.path.basename(video_path).replace(".mp4", "_mel.pt")
+        )
+
+        if os.path.isfile(mel_cache_path):
+            try:
+                original_mel = torch.load(mel_cache_path)
+            except Exception as e:
+                print(f"{type(e).__name__} - {e} - {mel_cache_path}")
+                os.remove(mel_cache_path)
+                original_mel = self.read_audio(video_path)
+                torch.save(original_mel, mel_cache_path)
+        else:
+            original_mel = self.read_audio(video_path)
+            torch.save(original_mel, mel_cache_path)
+        return original_mel
 
     def read_audio(self, video_path: str):
         ar = AudioReader(video_path, ctx=cpu(self.worker_id), sample_rate=self.audio_sample_rate)
@@ -62,14 +119,21 @@ class SyncNetDataset(Dataset):
         end_idx = start_idx + self.mel_window_length
         return original_mel[:, start_idx:end_idx].unsqueeze(0)
 
-    def get_frames(self, video_reader: VideoReader):
-        total_num_frames = len(video_reader)
+    def start_range(self, idx, total_num_frames: int, frame_offset: int = 0):
+        """The window starts of a reader of total_num_frames frames that give a complete sample, None when none do"""
+        low, high = 0, total_num_frames - self.num_frames
+        if idx in self.start_ranges:
+            index_low, index_high = self.start_ranges[idx]
+            low, high = max(low, index_low - frame_offset), min(high, index_high - frame_offset)
+        return (low, high) if low <= high else None
 
-        start_idx = random.randint(0, total_num_frames - self.num_frames)
-        frames_index = np.arange(start_idx, start_idx + self.num_frames, dtype=int)
+    def sample_start_indices(self, total_num_frames: int, start_range=None):
+        if start_range is None:
+            start_range = (0, total_num_frames - self.num_frames)
+        start_idx = self.rng.randint(*start_range)
 
         while True:
-            wrong_start_idx = random.randint(0, total_num_frames - self.num_frames)
+            wrong_start_idx = self.rng.randint(0, total_num_frames - self.num_frames)
             # wrong_start_idx = random.randint(
             #     max(0, start_idx - 25), min(total_num_frames - self.num_frames, start_idx + 25)
             # )
@@ -77,9 +141,15 @@ class SyncNetDataset(Dataset):
                 continue
             # if wrong_start_idx >= start_idx - self.num_frames and wrong_start_idx <= start_idx + self.num_frames:
             #     continue
-            wrong_frames_index = np.arange(wrong_start_idx, wrong_start_idx + self.num_frames, dtype=int)
             break
 
+        return start_idx, wrong_start_idx
+
+    def get_frames(self, video_reader: VideoReader, start_range=None):
+        start_idx, wrong_start_idx = self.sample_start_indices(len(video_reader), start_range)
+        frames_index = np.arange(start_idx, start_idx + self.num_frames, dtype=int)
+        wrong_frames_index = np.arange(wrong_start_idx, wrong_start_idx + self.num_frames, dtype=int)
+
         frames = video_reader.get_batch(frames_index).asnumpy()
         wrong_frames = video_reader.get_batch(wrong_frames_index).asnumpy()
 
@@ -91,63 +161,54 @@ class SyncNetDataset(Dataset):
         self.worker_id = worker_id
         # setattr(self, f"image_processor_{worker_id}", ImageProcessor(self.resolution, self.mask))
 
-    def __getitem__(self, idx):
-        # image_processor = getattr(self, f"image_processor_{self.worker_id}")
-        while True:
-            try:
-                idx = random.randint(0, len(self) - 1)
+    def sample_from_video(self, idx, video_reader, frame_offset: int = 0):
+        """
+        Samples one positive or negative pair from an opened video, returns None when the video can't give one.
+        frame_offset is the index in the video of the first frame of video_reader, when it only holds a decoded span
+        """
+        start_range = self.start_range(idx, len(video_reader), frame_offset)
+        if len(video_reader) < 2 * self.num_frames or start_range is None:
+            return None
 
-                # Get video file path
-                video_path = self.video_paths[idx]
-
-                vr = VideoReader(video_path, ctx=cpu(self.worker_id))
+        frames, wrong_frames, start_idx = self.get_frames(video_reader, start_range)
 
-                if len(vr) < 2 * self.num_frames:
-                    continue
+        original_mel = self.load_mel(idx)
+        mel = self.crop_audio_window(original_mel, start_idx + frame_offset)
 
-                frames, wrong_frames, start_idx = self.get_frames(vr)
+        if mel.shape[-1] != self.mel_window_length:
+            return None
 
-                mel_cache_path = os.path.join(
-                    self.audio_mel_cache_dir, os.path.basename(video_path).replace(".mp4", "_mel.pt")
-                )
-
-                if os.path.isfile(mel_cache_path):
-                    try:
-                        original_mel = torch.load(mel_cache_path)
-                    except Exception as e:
-                        print(f"{type(e).__name__} - {e} - {mel_cache_path}")
-                        os.remove(mel_cache_path)
-                        original_mel = self.read_audio(video_path)
-                        torch.save(original_mel, mel_cache_path)
-                else:
-                    original_mel = self.read_audio(video_path)
-                    torch.save(original_mel, mel_cache_path)
+        if self.rng.choice([True, False]):
+            y = torch.ones(1).float()
+            chosen_frames = frames
+        else:
+            y = torch.zeros(1).float()
+            chosen_frames = wrong_frames
 
-                mel = self.crop_audio_window(original_mel, start_idx)
+        chosen_frames = self.image_processor.process_images(chosen_frames)
+        # chosen_frames, _, _ = image_processor.prepare_masks_and_masked_images(
+        #     chosen_frames, affine_transform=True
+        # )
 
-                if mel.shape[-1] != self.mel_window_length:
-                    continue
+        return dict(frames=chosen_frames, audio_samples=mel, y=y)
 
-                if random.choice([True, False]):
-                    y = torch.ones(1).float()
-                    chosen_frames = frames
-                else:
-                    y = torch.zeros(1).float()
-                    chosen_frames = wrong_frames
+    def __getitem__(self, idx):
+        # image_processor = getattr(self, f"image_processor_{self.worker_id}")
+        while True:
+            try:
+                idx = self.rng.choice(self.indices)
 
-                chosen_frames = self.image_processor.process_images(chosen_frames)
-                # chosen_frames, _, _ = image_processor.prepare_masks_and_masked_images(
-                #     chosen_frames, affine_transform=True
-                # )
+                # Get video file path
+                video_path = self.video_paths[idx]
 
+                vr = self.open_video(idx)
+                sample = self.sample_from_video(idx, vr)
                 vr.seek(0)  # avoid memory leak
-                break
+
+                if sample is not None:
+                    return sample
 
             except Exception as e:  # Handle the exception of face not detcted
                 print(f"{type(e).__name__} - {e} - {video_path}")
                 if "vr" in locals():
                     vr.seek(0)  # avoid memory leak
-
-        sample = dict(frames=chosen_frames, audio_samples=mel, y=y)
-
-        return sample
@@ -20,21 +20,18 @@ import random
 import cv2
 from ..utils.image_processor import ImageProcessor, load_fixed_mask
 from ..utils.audio import melspectrogram
+from ..utils.feature_store import FeatureStore
+from .validity_index import apply_validity_index
+from ..whisper.audio2feature import get_sliced_features
 from decord import AudioReader, VideoReader, cpu
 
 
 class UNetDataset(Dataset):
+    # Source of the sampling randomness, the clip-locality sampler gives each worker a seeded random.Random
+    rng = random
+
     def __init__(self, train_data_dir: str, config):
-        if config.data.train_fileslist != "":
-            with open(config.data.train_fileslist) as file:
-                self.video_paths = [line.rstrip() for line in file]
-        elif train_data_dir != "":
-            self.video_paths = []
-            for file in os.listdir(train_data_dir):
-                if file.endswith(".mp4"):
-                    self.video_paths.append(os.path.join(train_data_dir, file))
-        else:
-            raise ValueError("data_dir and fileslist cannot be both empty")
+        self.video_paths = self.load_video_paths(train_data_dir, config)
 
         self.resolution = config.data.resolution
         self.num_frames = config.data.num_frames
@@ -53,9 +50,87 @@ class UNetDataset(Dataset):
         self.load_audio_data = config.model.add_audio_layer and config.run.use_syncnet
         self.audio_mel_cache_dir = config.data.audio_mel_cache_dir
         os.makedirs(self.audio_mel_cache_dir, exist_ok=True)
+        # A consolidated feature store replaces the per-video mel cache files when set
+        audio_mel_store_dir = config.data.get("audio_mel_store_dir", "")
+        self.mel_store = FeatureStore(audio_mel_store_dir) if audio_mel_store_dir != "" else None
+
+        # Serve the whisper windows from precomputed features, so the training step doesn't run whisper
+        self.load_audio_embeds = config.model.add_audio_layer and config.data.get("precomputed_audio_embeds", True)
+        self.audio_embeds_cache_dir = config.data.get("audio_embeds_cache_dir", "")
+        audio_embeds_store_dir = config.data.get("audio_embeds_store_dir", "")
+        self.audio_embeds_store = FeatureStore(audio_embeds_store_dir) if audio_embeds_store_dir != "" else None
+
+        # Videos and window starts checked offline by preprocess/build_validity_index.py, so no sample is rejected
+        self.indices = list(range(len(self.video_paths)))
+        self.start_ranges = {}
+        validity_index_path = config.data.get("validity_index_path", "")
+        if validity_index_path != "":
+            self.indices, self.start_ranges = apply_validity_index(
+                self.video_paths,
+                validity_index_path,
+                self.num_frames,
+                margin=self.num_frames // 2,
+                min_video_frames=3 * self.num_frames,
+                mel_window_length=self.mel_window_length if self.load_audio_data else 0,
+                video_fps=self.video_fps,
+            )
+
+    def load_video_paths(self, train_data_dir: str, config):
+        if config.data.train_fileslist != "":
+            with open(config.data.train_fileslist) as file:
+                video_paths = [line.rstrip() for line in file]
+        elif train_data_dir != "":
+            video_paths = []
+            for file in os.listdir(train_data_dir):
+                if file.endswith(".mp4"):
+                    video_paths.append(os.path.join(train_data_dir, file))
+        else:
+            raise ValueError("data_dir and fileslist cannot be both empty")
+        return video_paths
 
     def __len__(self):
-        return len(self.video_paths)
+        return len(self.indices)
+
+    def open_video(self, idx):
+        return VideoReader(self.video_paths[idx], ctx=cpu(self.worker_id))
+
+    def load_mel(self, idx):
+        video_path = self.video_paths[idx]
+        if self.mel_store is not None:
+            key = os.path.basename(video_path).replace(".mp4", "_mel")
+            original_mel = self.mel_store.get(key)
+            if original_mel is None:
+                original_mel = self.read_audio(video_path)
+                self.mel_store.put(key, original_mel)
+            return original_mel
+
+        mel_cache_path = os.path.join(
+            self.audio_mel_cache_dir, os.path.basename(video_path).replace(".mp4", "_mel.pt")
+        )
+
+        if os.path.isfile(mel_cache_path):
+            try:
+                original_mel = torch.load(mel_cache_path)
+            except Exception as e:
+                print(f"{type(e).__name__} - {e} - {mel_cache_path}")
+                os.remove(mel_cache_path)
+                original_mel = self.read_audio(video_path)
+                torch.save(original_mel, mel_cache_path)
+        else:
+            original_mel = self.read_audio(video_path)
+            torch.save(original_mel, mel_cache_path)
+        return original_mel
+
+    def load_audio_feat(self, idx):
+        video_path = self.video_paths[idx]
+        if self.audio_embeds_store is not None:
+            audio_feat = self.audio_embeds_store.get(os.path.basename(video_path))
+        else:
+            cache_path = os.path.join(self.audio_embeds_cache_dir, os.path.basename(video_path) + ".pt")
+            audio_feat = torch.load(cache_path) if os.path.isfile(cache_path) else None
+        if audio_feat is None:
+            raise RuntimeError("Whisper features are not precomputed, run preprocess/build_feature_store.py")
+        return audio_feat
 
     def read_audio(self, video_path: str):
         ar = AudioReader(video_path, ctx=cpu(self.worker_id), sample_rate=self.audio_sample_rate)
@@ -67,19 +142,32 @@ class UNetDataset(Dataset):
         end_idx = start_idx + self.mel_window_length
         return original_mel[:, start_idx:end_idx].unsqueeze(0)
 
-    def get_frames(self, video_reader: VideoReader):
-        total_num_frames = len(video_reader)
+    def start_range(self, idx, total_num_frames: int, frame_offset: int = 0):
+        """The window starts of a reader of total_num_frames frames that give a complete sample, None when none do"""
+        low, high = self.num_frames // 2, total_num_frames - self.num_frames - self.num_frames // 2
+        if idx in self.start_ranges:
+            index_low, index_high = self.start_ranges[idx]
+            low, high = max(low, index_low - frame_offset), min(high, index_high - frame_offset)
+        return (low, high) if low <= high else None
 
-        start_idx = random.randint(self.num_frames // 2, total_num_frames - self.num_frames - self.num_frames // 2)
-        frames_index = np.arange(start_idx, start_idx + self.num_frames, dtype=int)
+    def sample_start_indices(self, total_num_frames: int, start_range=None):
+        if start_range is None:
+            start_range = (self.num_frames // 2, total_num_frames - self.num_frames - self.num_frames // 2)
+        start_idx = self.rng.randint(*start_range)
 
         while True:
-            wrong_start_idx = random.randint(0, total_num_frames - self.num_frames)
+            wrong_start_idx = self.rng.randint(0, total_num_frames - self.num_frames)
             if wrong_start_idx > start_idx - self.num_frames and wrong_start_idx < start_idx + self.num_frames:
                 continue
-            wrong_frames_index = np.arange(wrong_start_idx, wrong_start_idx + self.num_frames, dtype=int)
             break
 
+        return start_idx, wrong_start_idx
+
+    def get_frames(self, video_reader: VideoReader, start_range=None):
+        start_idx, wrong_start_idx = self.sample_start_indices(len(video_reader), start_range)
+        frames_index = np.arange(start_idx, start_idx + self.num_frames, dtype=int)
+        wrong_frames_index = np.arange(wrong_start_idx, wrong_start_idx + self.num_frames, dtype=int)
+
         frames = video_reader.get_batch(frames_index).asnumpy()
         wrong_frames = video_reader.get_batch(wrong_frames_index).asnumpy()
 
@@ -95,70 +183,71 @@ class UNetDataset(Dataset):
             ImageProcessor(self.resolution, self.mask, mask_image=self.mask_image),
         )
 
-    def __getitem__(self, idx):
+    def sample_from_video(self, idx, video_reader, frame_offset: int = 0):
+        """
+        Samples one training window from an opened video, returns None when the video can't give one. frame_offset is
+        the index in the video of the first frame of video_reader, when it only holds a decoded span
+        """
         image_processor = getattr(self, f"image_processor_{self.worker_id}")
-        while True:
-            try:
-                idx = random.randint(0, len(self) - 1)
+        start_range = self.start_range(idx, len(video_reader), frame_offset)
+        if len(video_reader) < 3 * self.num_frames or start_range is None:
+            return None
 
-                # Get video file path
-                video_path = self.video_paths[idx]
+        continuous_frames, ref_frames, start_idx = self.get_frames(video_reader, start_range)
+        start_idx += frame_offset
 
-                vr = VideoReader(video_path, ctx=cpu(self.worker_id))
-
-                if len(vr) < 3 * self.num_frames:
-                    continue
-
-                continuous_frames, ref_frames, start_idx = self.get_frames(vr)
-
-                if self.load_audio_data:
-                    mel_cache_path = os.path.join(
-                        self.audio_mel_cache_dir, os.path.basename(video_path).replace(".mp4", "_mel.pt")
-                    )
-
-                    if os.path.isfile(mel_cache_path):
-                        try:
-                            original_mel = torch.load(mel_cache_path)
-                        except Exception as e:
-                            print(f"{type(e).__name__} - {e} - {mel_cache_path}")
-                            os.remove(mel_cache_path)
-                            original_mel = self.read_audio(video_path)
-                            torch.save(original_mel, mel_cache_path)
-                    else:
-                        original_mel = self.read_audio(video_path)
-                        torch.save(original_mel, mel_cache_path)
-
-                    mel = self.crop_audio_window(original_mel, start_idx)
-
-                    if mel.shape[-1] != self.mel_window_length:
-                        continue
-                else:
-                    mel = []
-
-                gt, masked_gt, mask = image_processor.prepare_masks_and_masked_images(
-                    continuous_frames, affine_transform=False
-                )
-
-                if self.mask == "fix_mask":
-                    ref, _, _ = image_processor.prepare_masks_and_masked_images(ref_frames, affine_transform=False)
-                else:
-                    ref = image_processor.process_images(ref_frames)
-                vr.seek(0)  # avoid memory leak
-                break
+        if self.load_audio_data:
+            original_mel = self.load_mel(idx)
+            mel = self.crop_audio_window(original_mel, start_idx)
 
-            except Exception as e:  # Handle the exception of face not detcted
-                print(f"{type(e).__name__} - {e} - {video_path}")
-                if "vr" in locals():
-                    vr.seek(0)  # avoid memory leak
+            if mel.shape[-1] != self.mel_window_length:
+                return None
+        else:
+            mel = []
 
-        sample = dict(
+        if self.load_audio_embeds:
+            audio_embeds = get_sliced_features(
+                self.load_audio_feat(idx), range(start_idx, start_idx + self.num_frames)
+            )
+        else:
+            audio_embeds = []
+
+        gt, masked_gt, mask = image_processor.prepare_masks_and_masked_images(
+            continuous_frames, affine_transform=False
+        )
+
+        if self.mask == "fix_mask":
+            ref, _, _ = image_processor.prepare_masks_and_masked_images(ref_frames, affine_transform=False)
+        else:
+            ref = image_processor.process_images(ref_frames)
+
+        return dict(
             gt=gt,
             masked_gt=masked_gt,
             ref=ref,
             mel=mel,
+            audio_embeds=audio_embeds,
             mask=mask,
-            video_path=video_path,
+            video_path=self.video_paths[idx],
             start_idx=start_idx,
         )
 
-        return sample
+    def __getitem__(self, idx):
+        while True:
+            try:
+                idx = self.rng.choice(self.indices)
+
+                # Get video file path
+                video_path = self.video_paths[idx]
+
+                vr = self.open_video(idx)
+                sample = self.sample_from_video(idx, vr)
+                vr.seek(0)  # avoid memory leak
+
+                if sample is not None:
+                    return sample
+
+            except Exception as e:  # Handle the exception of face not detcted
+                print(f"{type(e).__name__} - {e} - {video_path}")
+                if "vr" in locals():
+                    vr.seek(0)  # avoid memory leak
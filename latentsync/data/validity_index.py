@@ -0,0 +1,89 @@
+# Copyright (c) 2024 Bytedance Ltd. and/or its affiliates
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# The validity index built by preprocess/build_validity_index.py records, for every video, its frame count, the length
+# of its mel spectrogram and its decode error if any. A dataset turns them into the range of window starts that give a
+# complete sample for its own num_frames and mel window, so that it never draws a window it has to reject.
+
+import json
+import math
+import os
+
+
+def read_validity_index(index_path: str) -> dict:
+    entries = {}
+    if not os.path.isfile(index_path):
+        return entries
+    with open(index_path) as f:
+        for line in f:
+            entry = json.loads(line)
+            entries[entry["video_path"]] = entry
+    return entries
+
+
+def last_start_with_mel(mel_length: int, mel_window_length: int, video_fps: float) -> int:
+    """The last frame whose mel window, cropped like crop_audio_window, fits in the mel spectrogram"""
+    start = math.ceil((mel_length - mel_window_length + 1) * video_fps / 80.0)
+    while start >= 0 and int(80.0 * (start / float(video_fps))) + mel_window_length > mel_length:
+        start -= 1
+    return start
+
+
+def valid_start_range(
+    entry: dict, num_frames: int, margin: int, min_video_frames: int, mel_window_length: int, video_fps: float
+):
+    """
+    The inclusive range of the window starts of a video that give a complete sample, None when there is none.
+    margin is the number of frames kept free on both sides of the window, mel_window_length 0 when no mel is cropped.
+    """
+    if entry.get("error") is not None or entry["num_frames"] < min_video_frames:
+        return None
+    low, high = margin, entry["num_frames"] - num_frames - margin
+    if mel_window_length > 0:
+        high = min(high, last_start_with_mel(entry["mel_length"], mel_window_length, video_fps))
+    return (low, high) if low <= high else None
+
+
+def apply_validity_index(
+    video_paths: list,
+    index_path: str,
+    num_frames: int,
+    margin: int,
+    min_video_frames: int,
+    mel_window_length: int,
+    video_fps: float,
+):
+    """
+    Returns the indices of the videos to sample from and the valid start range of the indexed ones. The videos missing
+    from the index are kept, with no range, and sampled like without an index.
+    """
+    entries = read_validity_index(index_path)
+    indices, start_ranges = [], {}
+    num_missing = 0
+    for idx, video_path in enumerate(video_paths):
+        if video_path not in entries:
+            num_missing += 1
+            indices.append(idx)
+            continue
+        start_range = valid_start_range(
+            entries[video_path], num_frames, margin, min_video_frames, mel_window_length, video_fps
+        )
+        if start_range is not None:
+            indices.append(idx)
+            start_ranges[idx] = start_range
+    print(
+        f"Validity index: {len(start_ranges)} valid videos, {len(video_paths) - len(indices)} rejected, "
+        f"{num_missing} not indexed"
+    )
+    return indices, start_ranges
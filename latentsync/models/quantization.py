@@ -0,0 +1,141 @@
+# Copyright (c) 2024 Bytedance Ltd. and/or its affiliates
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from einops import rearrange
+
+from diffusers.utils import logging
+
+from .unet import UNet3DConditionModel
+from .resnet import InflatedConv3d
+from ..utils.checkpoint import load_checkpoint
+
+logger = logging.get_logger(__name__)  # pylint: disable=invalid-name
+
+# The first and the last convolutions are the most sensitive to quantization errors, they are always kept in fp32
+SKIPPED_MODULES = ("conv_in", "conv_out")
+
+
+class PointwiseConvAsLinear(nn.Module):
+    """
+    A 1x1 nn.Conv2d (the proj_in / proj_out of the transformer blocks) rewritten as a nn.Linear over the channel
+    dimension, so that it can be picked up by dynamic int8 quantization.
+    """
+
+    def __init__(self, in_features: int, out_features: int, bias: bool = True):
+        super().__init__()
+        self.linear = nn.Linear(in_features, out_features, bias=bias)
+
+    @classmethod
+    def from_conv(cls, conv: nn.Conv2d):
+        module = cls(conv.in_channels, conv.out_channels, bias=conv.bias is not None)
+        module.linear.weight.data.copy_(conv.weight.data.flatten(1))
+        if conv.bias is not None:
+            module.linear.bias.data.copy_(conv.bias.data)
+        return module
+
+    def forward(self, x):
+        x = rearrange(x, "b c h w -> b h w c")
+        x = self.linear(x)
+        return rearrange(x, "b h w c -> b c h w")
+
+
+class Int8WeightOnlyInflatedConv3d(nn.Module):
+    """
+    InflatedConv3d with int8 weights and per-output-channel scales. The weight is dequantized on the fly, so this
+    saves memory and bandwidth but the convolution itself still runs in fp32.
+    """
+
+    def __init__(self, conv: nn.Conv2d):
+        super().__init__()
+        weight = conv.weight.data.float()
+        scale = weight.abs().amax(dim=(1, 2, 3), keepdim=True).clamp(min=1e-8) / 127.0
+        self.register_buffer("weight_int8", torch.round(weight / scale).to(torch.int8))
+        self.register_buffer("weight_scale", scale)
+        self.register_buffer("bias", None if conv.bias is None else conv.bias.data.float().clone())
+        self.stride = conv.stride
+        self.padding = conv.padding
+        self.dilation = conv.dilation
+        self.groups = conv.groups
+
+    def forward(self, x):
+        video_length = x.shape[2]
+        weight = self.weight_int8.to(x.dtype) * self.weight_scale.to(x.dtype)
+        bias = None if self.bias is None else self.bias.to(x.dtype)
+
+        x = rearrange(x, "b c f h w -> (b f) c h w")
+        x = F.conv2d(x, weight, bias, self.stride, self.padding, self.dilation, self.groups)
+        x = rearrange(x, "(b f) c h w -> b c f h w", f=video_length)
+
+        return x
+
+
+def _replace_modules(model: nn.Module, include_conv: bool):
+    for name, module in list(model.named_modules()):
+        if name in SKIPPED_MODULES or name == "":
+            continue
+        parent_name, _, child_name = name.rpartition(".")
+        parent = model.get_submodule(parent_name) if parent_name else model
+        if isinstance(module, InflatedConv3d):
+            if include_conv:
+                setattr(parent, child_name, Int8WeightOnlyInflatedConv3d(module))
+        elif isinstance(module, nn.Conv2d) and module.kernel_size == (1, 1) and module.groups == 1:
+            setattr(parent, child_name, PointwiseConvAsLinear.from_conv(module))
+
+
+def quantize_unet(unet: UNet3DConditionModel, include_conv: bool = False) -> UNet3DConditionModel:
+    """
+    Dynamic int8 quantization for CPU inference: the nn.Linear layers of the attention and feed-forward blocks and the
+    1x1 projections are quantized with per-tensor activation scales computed at runtime. With include_conv=True the
+    InflatedConv3d layers additionally get int8 weights.
+    """
+    unet = unet.to(device="cpu", dtype=torch.float32).eval()
+    _replace_modules(unet, include_conv)
+    unet = torch.ao.quantization.quantize_dynamic(unet, {nn.Linear}, dtype=torch.qint8, inplace=True)
+    unet.quantization_config = {"mode": "dynamic_int8", "include_conv": include_conv}
+    return unet
+
+
+def save_quantized_unet(unet: UNet3DConditionModel, save_path: str, global_step: int = 0):
+    torch.save(
+        {
+            "global_step": global_step,
+            "quantization": unet.quantization_config,
+            "state_dict": unet.state_dict(),
+        },
+        save_path,
+    )
+
+
+def load_quantized_unet(model_config: dict, ckpt_path: str, include_conv: bool = False):
+    """
+    Load a pre-quantized checkpoint written by save_quantized_unet. A regular fp32 checkpoint is quantized on the fly
+    instead, which is slower at startup.
+    """
+    ckpt = load_checkpoint(ckpt_path, device="cpu")
+    if "quantization" not in ckpt:
+        logger.warning(f"{ckpt_path} is not pre-quantized, quantizing at startup")
+        # Same as from_pretrained, from the checkpoint already loaded instead of reading it again
+        unet = UNet3DConditionModel.from_config(model_config)
+        unet.load_state_dict(ckpt["state_dict"] if "state_dict" in ckpt else ckpt, strict=False)
+        del ckpt
+        return quantize_unet(unet, include_conv=include_conv)
+
+    # Build the quantized module structure, then fill it with the stored int8 weights
+    unet = UNet3DConditionModel.from_config(model_config)
+    unet = quantize_unet(unet, include_conv=ckpt["quantization"]["include_conv"])
+    nn.Module.load_state_dict(unet, ckpt["state_dict"])
+    return unet
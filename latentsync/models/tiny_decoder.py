@@ -0,0 +1,82 @@
+# Copyright (c) 2024 Bytedance Ltd. and/or its affiliates
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# A TAESD-style decoder (https://github.com/madebyollin/taesd), distilled from sd-vae-ft-mse with
+# scripts/train_tiny_decoder.py, for previews that don't need the full VAE decode quality
+
+import torch
+from torch import nn
+
+from ..utils.checkpoint import load_checkpoint
+
+
+def conv(in_channels, out_channels, **kwargs):
+    return nn.Conv2d(in_channels, out_channels, 3, padding=1, **kwargs)
+
+
+class Clamp(nn.Module):
+    def forward(self, x):
+        return torch.tanh(x / 3) * 3
+
+
+class Block(nn.Module):
+    def __init__(self, in_channels, out_channels):
+        super().__init__()
+        self.conv = nn.Sequential(
+            conv(in_channels, out_channels),
+            nn.ReLU(),
+            conv(out_channels, out_channels),
+            nn.ReLU(),
+            conv(out_channels, out_channels),
+        )
+        if in_channels != out_channels:
+            self.skip = nn.Conv2d(in_channels, out_channels, 1, bias=False)
+        else:
+            self.skip = nn.Identity()
+        self.fuse = nn.ReLU()
+
+    def forward(self, x):
+        return self.fuse(self.conv(x) + self.skip(x))
+
+
+class TinyDecoder(nn.Module):
+    """
+    Takes the scaled latents the UNet works on, like the pipeline latents before decode_latents, and returns images
+    in about [-1, 1] at 8x the latent resolution
+    """
+
+    def __init__(self, latent_channels: int = 4, channels: int = 64, num_upsamples: int = 3):
+        super().__init__()
+        layers = [Clamp(), conv(latent_channels, channels), nn.ReLU()]
+        for _ in range(num_upsamples):
+            layers += [
+                Block(channels, channels),
+                Block(channels, channels),
+                Block(channels, channels),
+                nn.Upsample(scale_factor=2),
+                conv(channels, channels, bias=False),
+            ]
+        layers += [Block(channels, channels), conv(channels, 3)]
+        self.layers = nn.Sequential(*layers)
+
+    def forward(self, latents):
+        return self.layers(latents)
+
+    @classmethod
+    def from_pretrained(cls, ckpt_path: str, device="cpu"):
+        ckpt = load_checkpoint(ckpt_path, device)
+        model = cls(**ckpt.get("config", {}))
+        model.load_state_dict(ckpt["state_dict"])
+        model.requires_grad_(False)
+        return model.to(device).eval()
@@ -2,7 +2,6 @@
 
 from dataclasses import dataclass
 from typing import List, Optional, Tuple, Union
-import copy
 
 import torch
 import torch.nn as nn
@@ -26,6 +25,7 @@ from .unet_blocks import (
 from .resnet import InflatedConv3d, InflatedGroupNorm
 
 from ..utils.util import zero_rank_log
+from ..utils.checkpoint import load_checkpoint, can_assign
 from einops import rearrange
 from .utils import zero_module
 
@@ -490,7 +490,8 @@ class UNet3DConditionModel(ModelMixin, ConfigMixin):
 
     def load_state_dict(self, state_dict, strict=True):
         # If the loaded checkpoint's in_channels or out_channels are different from config
-        temp_state_dict = copy.deepcopy(state_dict)
+        # Only the mapping is copied, the tensors are shared with the given state dict
+        temp_state_dict = dict(state_dict)
         if temp_state_dict["conv_in.weight"].shape[1] != self.config.in_channels:
             del temp_state_dict["conv_in.weight"]
             del temp_state_dict["conv_in.bias"]
@@ -508,6 +509,8 @@ class UNet3DConditionModel(ModelMixin, ConfigMixin):
         for key in keys_to_remove:
             del temp_state_dict[key]
 
+        if can_assign(self, temp_state_dict):
+            return super().load_state_dict(state_dict=temp_state_dict, strict=strict, assign=True)
         return super().load_state_dict(state_dict=temp_state_dict, strict=strict)
 
     @classmethod
@@ -515,7 +518,7 @@ class UNet3DConditionModel(ModelMixin, ConfigMixin):
         unet = cls.from_config(model_config).to(device)
         if ckpt_path != "":
             zero_rank_log(logger, f"Load from checkpoint: {ckpt_path}")
-            ckpt = torch.load(ckpt_path, map_location=device)
+            ckpt = load_checkpoint(ckpt_path, device=device)
             if "global_step" in ckpt:
                 zero_rank_log(logger, f"resume from global_step: {ckpt['global_step']}")
                 resume_global_step = ckpt["global_step"]
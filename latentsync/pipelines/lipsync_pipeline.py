@@ -31,6 +31,7 @@ import cv2
 
 from ..models.unet import UNet3DConditionModel
 from ..utils.image_processor import ImageProcessor
+from ..utils.vae_decode import decode_latent_region
 from ..utils.util import read_video, read_audio, write_video, check_ffmpeg_installed
 import latentsync.utils.util as util
 from ..whisper.audio2feature import Audio2Feature
@@ -158,6 +159,38 @@ class LipsyncPipeline(DiffusionPipeline):
         decoded_latents = self.vae.decode(latents).sample
         return decoded_latents
 
+    def enable_preview(self, preview_decoder):
+        """Set the lightweight decoder (e.g. TinyDecoder) used instead of the VAE decoder in preview mode"""
+        self.preview_decoder = preview_decoder
+
+    def decode_latents_preview(self, latents):
+        if getattr(self, "preview_decoder", None) is None:
+            logger.warning("No preview decoder is set, the preview is decoded with the VAE")
+            return self.decode_latents(latents)
+        # The preview decoder takes the scaled latents
+        latents = rearrange(latents, "b c f h w -> (b f) c h w")
+        self.preview_decoder.to(device=latents.device, dtype=latents.dtype)
+        return self.preview_decoder(latents).clamp(-1, 1)
+
+    def mask_latent_box(self, masks):
+        """The latent box (top, bottom, left, right) covering the pixels that are not pasted back from the face"""
+        region = (masks < 1).flatten(0, -3).any(dim=0)
+        rows = torch.nonzero(region.any(dim=1)).flatten()
+        cols = torch.nonzero(region.any(dim=0)).flatten()
+        if len(rows) == 0:
+            return 0, region.shape[0] // self.vae_scale_factor, 0, region.shape[1] // self.vae_scale_factor
+        return (
+            rows[0].item() // self.vae_scale_factor,
+            rows[-1].item() // self.vae_scale_factor + 1,
+            cols[0].item() // self.vae_scale_factor,
+            cols[-1].item() // self.vae_scale_factor + 1,
+        )
+
+    def decode_latents_region(self, latents, box):
+        latents = latents / self.vae.config.scaling_factor + self.vae.config.shift_factor
+        latents = rearrange(latents, "b c f h w -> (b f) c h w")
+        return decode_latent_region(self.vae, latents, *box)
+
     def prepare_extra_step_kwargs(self, generator, eta):
         # prepare extra kwargs for the scheduler step, since not all schedulers have the same signature
         # eta (η) is only used with the DDIMScheduler, it will be ignored for other schedulers.
@@ -256,6 +289,19 @@ class LipsyncPipeline(DiffusionPipeline):
         combined_pixel_values = decoded_latents * masks + pixel_values * (1 - masks)
         return combined_pixel_values
 
+    def paste_region_back(self, decoded_region, box, pixel_values, masks, device, weight_dtype):
+        # Everything outside the box comes from the original face anyway
+        top, bottom, left, right = (coordinate * self.vae_scale_factor for coordinate in box)
+        combined_pixel_values = pixel_values.to(device=device, dtype=weight_dtype).clone()
+        combined_pixel_values[:, :, top:bottom, left:right] = self.paste_surrounding_pixels_back(
+            decoded_region,
+            combined_pixel_values[:, :, top:bottom, left:right],
+            masks[:, :, top:bottom, left:right],
+            device,
+            weight_dtype,
+        )
+        return combined_pixel_values
+
     @staticmethod
     def pixel_values_to_images(pixel_values: torch.Tensor):
         pixel_values = rearrange(pixel_values, "f c h w -> f h w c")
@@ -279,7 +325,9 @@ class LipsyncPipeline(DiffusionPipeline):
         faces = torch.stack(faces)
         return faces, video_frames, boxes, affine_matrices
 
-    def restore_video(self, faces, video_frames, boxes, affine_matrices):
+    def restore_video(self, faces, video_frames, boxes, affine_matrices, fast=False):
+        # fast trades the antialiasing and Lanczos warps for bilinear ones, for previews
+        interpolation = cv2.INTER_LINEAR if fast else cv2.INTER_LANCZOS4
         video_frames = video_frames[: faces.shape[0]]
         out_frames = []
         print(f"Restoring {len(faces)} faces...")
@@ -287,12 +335,14 @@ class LipsyncPipeline(DiffusionPipeline):
             x1, y1, x2, y2 = boxes[index]
             height = int(y2 - y1)
             width = int(x2 - x1)
-            face = torchvision.transforms.functional.resize(face, size=(height, width), antialias=True)
+            face = torchvision.transforms.functional.resize(face, size=(height, width), antialias=not fast)
             face = rearrange(face, "c h w -> h w c")
             face = (face / 2 + 0.5).clamp(0, 1)
             face = (face * 255).to(torch.uint8).cpu().numpy()
             # face = cv2.resize(face, (width, height), interpolation=cv2.INTER_LANCZOS4)
-            out_frame = self.image_processor.restorer.restore_img(video_frames[index], face, affine_matrices[index])
+            out_frame = self.image_processor.restorer.restore_img(
+                video_frames[index], face, affine_matrices[index], interpolation=interpolation
+            )
             out_frames.append(out_frame)
         return np.stack(out_frames, axis=0)
 
@@ -316,6 +366,9 @@ class LipsyncPipeline(DiffusionPipeline):
         generator: Optional[Union[torch.Generator, List[torch.Generator]]] = None,
         callback: Optional[Callable[[int, int, torch.FloatTensor], None]] = None,
         callback_steps: Optional[int] = 1,
+        region_decode: bool = False,
+        preview: bool = False,
+        preview_steps: int = 5,
         **kwargs,
     ):
         is_train = self.unet.training
@@ -326,7 +379,7 @@ class LipsyncPipeline(DiffusionPipeline):
         # 0. Define call parameters
         batch_size = 1
         device = self._execution_device
-        self.image_processor = ImageProcessor(height, mask=mask, device="cuda")
+        self.image_processor = ImageProcessor(height, mask=mask, device=device.type)
         self.set_progress_bar_config(desc=f"Sample frames: {num_frames}")
 
         faces, original_video_frames, boxes, affine_matrices = self.affine_transform_video(video_path)
@@ -344,6 +397,10 @@ class LipsyncPipeline(DiffusionPipeline):
         # corresponds to doing no classifier free guidance.
         do_classifier_free_guidance = guidance_scale > 1.0
 
+        # Previews use fewer steps, the lightweight decoder, a cheaper restore and a low-bitrate output
+        if preview:
+            num_inference_steps = min(num_inference_steps, preview_steps)
+
         # 3. set timesteps
         self.scheduler.set_timesteps(num_inference_steps, device=device)
         timesteps = self.scheduler.timesteps
@@ -378,6 +435,11 @@ class LipsyncPipeline(DiffusionPipeline):
             generator,
         )
 
+        # Only decode the latents under the mask, the fixed mask is the same for every frame
+        latent_box = None
+        if region_decode and mask == "fix_mask":
+            latent_box = self.mask_latent_box(self.image_processor.mask_image[0:1])
+
         for i in tqdm.tqdm(range(num_inferences), desc="Doing inference..."):
             if self.unet.add_audio_layer:
                 audio_embeds = torch.stack(whisper_chunks[i * num_frames : (i + 1) * num_frames])
@@ -445,15 +507,26 @@ class LipsyncPipeline(DiffusionPipeline):
                             callback(j, t, latents)
 
             # Recover the pixel values
-            decoded_latents = self.decode_latents(latents)
-            decoded_latents = self.paste_surrounding_pixels_back(
-                decoded_latents, pixel_values, 1 - masks, device, weight_dtype
-            )
+            if preview:
+                decoded_latents = self.decode_latents_preview(latents)
+                decoded_latents = self.paste_surrounding_pixels_back(
+                    decoded_latents, pixel_values, 1 - masks, device, weight_dtype
+                )
+            elif region_decode:
+                box = latent_box if latent_box is not None else self.mask_latent_box(masks)
+                decoded_latents = self.paste_region_back(
+                    self.decode_latents_region(latents, box), box, pixel_values, 1 - masks, device, weight_dtype
+                )
+            else:
+                decoded_latents = self.decode_latents(latents)
+                decoded_latents = self.paste_surrounding_pixels_back(
+                    decoded_latents, pixel_values, 1 - masks, device, weight_dtype
+                )
             synced_video_frames.append(decoded_latents)
             masked_video_frames.append(masked_pixel_values)
         start_time_restore = time.time()
         synced_video_frames = self.restore_video(
-            torch.cat(synced_video_frames), original_video_frames, boxes, affine_matrices
+            torch.cat(synced_video_frames), original_video_frames, boxes, affine_matrices, fast=preview
         )
         # masked_video_frames = self.restore_video(
         #     torch.cat(masked_video_frames), original_video_frames, boxes, affine_matrices
@@ -470,4 +543,4 @@ class LipsyncPipeline(DiffusionPipeline):
 
 
 
-        util.process_and_save_video(synced_video_frames, audio_path, video_out_path)
\ No newline at end of file
+        util.process_and_save_video(synced_video_frames, audio_path, video_out_path, preview=preview)
\ No newline at end of file
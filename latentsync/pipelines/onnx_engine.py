@@ -0,0 +1,165 @@
+# Copyright (c) 2024 Bytedance Ltd. and/or its affiliates
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import json
+from dataclasses import dataclass
+from typing import Optional
+
+import numpy as np
+import torch
+import torch.nn as nn
+from omegaconf import OmegaConf
+
+from diffusers.models.vae import DiagonalGaussianDistribution
+from diffusers.utils import BaseOutput
+
+# File names written by scripts/export_onnx.py
+UNET_ONNX_NAME = "unet.onnx"
+VAE_ENCODER_ONNX_NAME = "vae_encoder.onnx"
+VAE_DECODER_ONNX_NAME = "vae_decoder.onnx"
+ENGINE_CONFIG_NAME = "engine_config.json"
+
+
+def create_session(onnx_path: str, num_threads: int = 0, optimized_model_path: Optional[str] = None):
+    """
+    Create an ONNX Runtime session on the CPU provider with all graph optimisations enabled.
+    num_threads: intra-op threads, 0 lets ONNX Runtime use all physical cores.
+    optimized_model_path: if given, the optimised graph is serialized there so later boots can skip the optimisation.
+    """
+    try:
+        import onnxruntime as ort
+    except ImportError:
+        raise ImportError("Please install onnxruntime via `pip install onnxruntime`")
+
+    sess_options = ort.SessionOptions()
+    sess_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    sess_options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+    sess_options.intra_op_num_threads = num_threads
+    sess_options.inter_op_num_threads = 1
+    sess_options.enable_mem_pattern = True
+    if optimized_model_path is not None:
+        sess_options.optimized_model_filepath = optimized_model_path
+
+    return ort.InferenceSession(onnx_path, sess_options=sess_options, providers=["CPUExecutionProvider"])
+
+
+def load_engine_config(onnx_dir: str) -> dict:
+    with open(os.path.join(onnx_dir, ENGINE_CONFIG_NAME)) as f:
+        return json.load(f)
+
+
+@dataclass
+class OnnxUNetOutput(BaseOutput):
+    sample: torch.FloatTensor
+
+
+@dataclass
+class OnnxDecoderOutput(BaseOutput):
+    sample: torch.FloatTensor
+
+
+@dataclass
+class OnnxEncoderOutput(BaseOutput):
+    latent_dist: DiagonalGaussianDistribution
+
+
+class OnnxEngineModule(nn.Module):
+    """
+    Base class of the exported-graph engines. It is an nn.Module without parameters so that it can be registered in
+    LipsyncPipeline in place of the torch module, the graph itself always runs on the CPU in float32.
+    """
+
+    def __init__(self, session, config: dict):
+        super().__init__()
+        self.session = session
+        self.config = OmegaConf.create(config)
+        self.input_shapes = {i.name: tuple(i.shape) for i in session.get_inputs()}
+
+    @property
+    def device(self):
+        return torch.device("cpu")
+
+    @property
+    def dtype(self):
+        return torch.float32
+
+    def run(self, **inputs):
+        feeds = {}
+        for name, value in inputs.items():
+            value = value.detach().cpu().numpy()
+            if value.dtype == np.float16 or value.dtype == np.float64:
+                value = value.astype(np.float32)
+            expected_shape = self.input_shapes[name]
+            if value.shape != expected_shape:
+                raise ValueError(
+                    f"Input {name} has shape {value.shape}, but the graph was exported with fixed shape {expected_shape}"
+                )
+            feeds[name] = value
+        return self.session.run(None, feeds)
+
+
+class OnnxUNet(OnnxEngineModule):
+    def __init__(self, onnx_dir: str, num_threads: int = 0):
+        engine_config = load_engine_config(onnx_dir)
+        session = create_session(os.path.join(onnx_dir, UNET_ONNX_NAME), num_threads)
+        super().__init__(session, engine_config["unet"])
+        self.add_audio_layer = self.config.add_audio_layer
+
+    def forward(self, sample, timestep, encoder_hidden_states=None, return_dict: bool = True):
+        if not torch.is_tensor(timestep):
+            timestep = torch.tensor([timestep])
+        timestep = timestep.reshape(1).to(torch.int64)
+        inputs = dict(sample=sample, timestep=timestep)
+        if self.add_audio_layer:
+            inputs["encoder_hidden_states"] = encoder_hidden_states
+        (noise_pred,) = self.run(**inputs)
+        noise_pred = torch.from_numpy(noise_pred).to(device=sample.device, dtype=sample.dtype)
+
+        if not return_dict:
+            return (noise_pred,)
+        return OnnxUNetOutput(sample=noise_pred)
+
+
+class OnnxAutoencoder(OnnxEngineModule):
+    def __init__(self, onnx_dir: str, num_threads: int = 0):
+        engine_config = load_engine_config(onnx_dir)
+        encoder_session = create_session(os.path.join(onnx_dir, VAE_ENCODER_ONNX_NAME), num_threads)
+        super().__init__(encoder_session, engine_config["vae"])
+        self.decoder = OnnxEngineModule(
+            create_session(os.path.join(onnx_dir, VAE_DECODER_ONNX_NAME), num_threads), engine_config["vae"]
+        )
+
+    def encode(self, x, return_dict: bool = True):
+        (moments,) = self.run(images=x)
+        moments = torch.from_numpy(moments).to(device=x.device, dtype=x.dtype)
+        posterior = DiagonalGaussianDistribution(moments)
+
+        if not return_dict:
+            return (posterior,)
+        return OnnxEncoderOutput(latent_dist=posterior)
+
+    def decode(self, z, return_dict: bool = True):
+        (images,) = self.decoder.run(latents=z)
+        images = torch.from_numpy(images).to(device=z.device, dtype=z.dtype)
+
+        if not return_dict:
+            return (images,)
+        return OnnxDecoderOutput(sample=images)
+
+    def enable_slicing(self):
+        pass
+
+    def disable_slicing(self):
+        pass
@@ -82,10 +82,10 @@ class AlignRestore(object):
         )
         return cropped_face, affine_matrix
 
-    def restore_img(self, input_img, face, affine_matrix):
+    def restore_img(self, input_img, face, affine_matrix, interpolation=cv2.INTER_LANCZOS4):
         h, w, _ = input_img.shape
         h_up, w_up = int(h * self.upscale_factor), int(w * self.upscale_factor)
-        upsample_img = cv2.resize(input_img, (w_up, h_up), interpolation=cv2.INTER_LANCZOS4)
+        upsample_img = cv2.resize(input_img, (w_up, h_up), interpolation=interpolation)
         inverse_affine = cv2.invertAffineTransform(affine_matrix)
         inverse_affine *= self.upscale_factor
         if self.upscale_factor > 1:
@@ -93,7 +93,7 @@ class AlignRestore(object):
         else:
             extra_offset = 0
         inverse_affine[:, 2] += extra_offset
-        inv_restored = cv2.warpAffine(face, inverse_affine, (w_up, h_up), flags=cv2.INTER_LANCZOS4)
+        inv_restored = cv2.warpAffine(face, inverse_affine, (w_up, h_up), flags=interpolation)
         mask = np.ones((self.face_size[1], self.face_size[0]), dtype=np.float32)
         inv_mask = cv2.warpAffine(mask, inverse_affine, (w_up, h_up))
         inv_mask_erosion = cv2.erode(
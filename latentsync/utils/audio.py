@@ -65,6 +65,85 @@ def melspectrogram(wav):
     return S
 
 
+def melspectrogram_torch(wavs, device=None):
+    """
+    Torch version of melspectrogram, on CPU or GPU, without librosa in the loop. Takes a (T,) waveform, a (B, T) batch
+    or a list of waveforms of different lengths, and returns (num_mels, frames), (B, num_mels, frames) or a list of
+    those. The computation runs in the dtype of the waveforms, float64 matches melspectrogram to float precision.
+    """
+    if isinstance(wavs, (list, tuple)):
+        wavs = [torch.as_tensor(wav, device=device) for wav in wavs]
+        # Pre-emphasized before the padding, so that the padding stays silent like the STFT padding
+        emphasized = [_preemphasis_torch(wav) for wav in wavs]
+        mels = _melspectrogram_torch(torch.nn.utils.rnn.pad_sequence(emphasized, batch_first=True))
+        return [mel[:, : len(wav) // get_hop_size() + 1] for mel, wav in zip(mels, wavs)]
+
+    wavs = torch.as_tensor(wavs, device=device)
+    return _melspectrogram_torch(_preemphasis_torch(wavs))
+
+
+def _preemphasis_torch(wav):
+    if not config.audio.preemphasize:
+        return wav
+    # signal.lfilter([1, -k], [1], wav) along the last dimension
+    return torch.cat([wav[..., :1], wav[..., 1:] - config.audio.preemphasis * wav[..., :-1]], dim=-1)
+
+
+def _melspectrogram_torch(wavs):
+    if config.audio.use_lws:
+        raise NotImplementedError("The torch melspectrogram only implements the librosa STFT")
+    # librosa.stft: centered frames with zero padding and a periodic Hann window
+    D = torch.stft(
+        wavs,
+        n_fft=config.audio.n_fft,
+        hop_length=get_hop_size(),
+        win_length=config.audio.win_size,
+        window=torch.hann_window(config.audio.win_size, periodic=True, dtype=wavs.dtype, device=wavs.device),
+        center=True,
+        pad_mode="constant",
+        return_complex=True,
+    )
+    mel_basis = _mel_basis_torch(wavs.device, wavs.dtype)
+    S = _amp_to_db_torch(torch.matmul(mel_basis, D.abs())) - config.audio.ref_level_db
+
+    if config.audio.signal_normalization:
+        return _normalize_torch(S)
+    return S
+
+
+_mel_basis_torch_cache = {}
+
+
+def _mel_basis_torch(device, dtype):
+    # The filter bank is only built once, with librosa, then kept on every device it is used on
+    global _mel_basis
+    key = (str(device), dtype)
+    if key not in _mel_basis_torch_cache:
+        if _mel_basis is None:
+            _mel_basis = _build_mel_basis()
+        _mel_basis_torch_cache[key] = torch.from_numpy(_mel_basis).to(device=device, dtype=dtype)
+    return _mel_basis_torch_cache[key]
+
+
+def _amp_to_db_torch(x):
+    min_level = np.exp(config.audio.min_level_db / 20 * np.log(10))
+    return 20 * torch.log10(torch.clamp(x, min=min_level))
+
+
+def _normalize_torch(S):
+    max_abs_value = config.audio.max_abs_value
+    S = (S - config.audio.min_level_db) / (-config.audio.min_level_db)
+    if config.audio.symmetric_mels:
+        S = (2 * max_abs_value) * S - max_abs_value
+        low = -max_abs_value
+    else:
+        S = max_abs_value * S
+        low = 0
+    if config.audio.allow_clipping_in_normalization:
+        return torch.clamp(S, low, max_abs_value)
+    return S
+
+
 def _lws_processor():
     import lws
 
@@ -73,7 +152,7 @@ def _lws_processor():
 
 def _stft(y):
     if config.audio.use_lws:
-        return _lws_processor(config.audio).stft(y).T
+        return _lws_processor().stft(y).T
     else:
         return librosa.stft(y=y, n_fft=config.audio.n_fft, hop_length=get_hop_size(), win_length=config.audio.win_size)
 
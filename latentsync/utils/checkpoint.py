@@ -0,0 +1,197 @@
+# Copyright (c) 2024 Bytedance Ltd. and/or its affiliates
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import re
+import json
+import time
+import queue
+import inspect
+import logging
+import threading
+
+import torch
+import torch.nn as nn
+from safetensors import safe_open
+from safetensors.torch import load_file, save_file
+
+logger = logging.getLogger(__name__)
+
+CHECKPOINT_PATTERN = re.compile(r"checkpoint-(\d+)\.pt$")
+
+
+def load_checkpoint(ckpt_path: str, device="cpu") -> dict:
+    """
+    Load a checkpoint without materializing an extra copy of the weights in host memory.
+    .safetensors files are memory-mapped, the tensors are returned under "state_dict" and the json metadata entries
+    (e.g. global_step, dims) as the other keys. .pt files are memory-mapped too when loaded on the CPU (torch>=2.1 and
+    zipfile format), otherwise they fall back to a regular torch.load.
+    """
+    if ckpt_path.endswith(".safetensors"):
+        state_dict = load_file(ckpt_path, device=str(device))
+        with safe_open(ckpt_path, framework="pt") as f:
+            metadata = f.metadata() or {}
+        ckpt = {key: json.loads(value) for key, value in metadata.items()}
+        ckpt["state_dict"] = state_dict
+        return ckpt
+
+    if torch.device(device).type == "cpu":
+        try:
+            return torch.load(ckpt_path, map_location="cpu", mmap=True)
+        except (TypeError, RuntimeError):
+            # Older torch without mmap support, or a checkpoint in the legacy (non-zipfile) format
+            pass
+    return torch.load(ckpt_path, map_location=device)
+
+
+def save_checkpoint_safetensors(state_dict: dict, save_path: str, **metadata):
+    """Save a state dict as safetensors, the extra keyword arguments are stored json-encoded in the metadata"""
+    state_dict = {key: value.contiguous() for key, value in state_dict.items()}
+    save_file(state_dict, save_path, metadata={key: json.dumps(value) for key, value in metadata.items()})
+
+
+def can_assign(module: nn.Module, state_dict: dict) -> bool:
+    """
+    Whether load_state_dict(assign=True) can be used, which swaps in the loaded tensors instead of copying them into
+    the already allocated parameters. Only possible with torch>=2.1 and when dtypes, devices and shapes already match.
+    """
+    if "assign" not in inspect.signature(nn.Module.load_state_dict).parameters:
+        return False
+    module_state_dict = module.state_dict()
+    for key, value in state_dict.items():
+        if key not in module_state_dict:
+            continue
+        target = module_state_dict[key]
+        if target.dtype != value.dtype or target.device != value.device or target.shape != value.shape:
+            return False
+    return True
+
+
+class AsyncCheckpointWriter:
+    """
+    Writes checkpoints from a background thread. save() only blocks for the device-to-host copy of the tensors into
+    pinned buffers, which are reused between saves. The thread writes a temporary file and renames it, so a checkpoint
+    is either complete or absent, and then keeps only the last keep_last checkpoints of the directory when set, and
+    up to max_unvalidated older ones for which removable(global_step) is False. At most max_pending checkpoints are
+    in flight, each set of buffers is a pinned host copy of the whole checkpoint, and save() waits with a warning for
+    a free set beyond that. A failed write is raised from the next save() or close().
+    """
+
+    def __init__(
+        self, checkpoints_dir: str, keep_last: int = 0, max_pending: int = 2, removable=None, max_unvalidated: int = 4
+    ):
+        self.checkpoints_dir = checkpoints_dir
+        self.keep_last = keep_last
+        self.removable = removable
+        self.max_unvalidated = max_unvalidated
+        self.max_pending = max_pending
+        self.pin_memory = torch.cuda.is_available()
+        self.free_buffers = queue.Queue()
+        for _ in range(self.max_pending):
+            self.free_buffers.put({})
+        self.pending = queue.Queue()
+        self.error = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def snapshot(self, obj, buffers: dict, key=()):
+        if isinstance(obj, torch.Tensor):
+            if obj.device.type == "cpu":
+                return obj.detach().clone()
+            buffer = buffers.get(key)
+            if buffer is None or buffer.shape != obj.shape or buffer.dtype != obj.dtype:
+                buffer = torch.empty(obj.shape, dtype=obj.dtype, pin_memory=self.pin_memory)
+                buffers[key] = buffer
+            buffer.copy_(obj.detach(), non_blocking=True)
+            return buffer
+        if isinstance(obj, dict):
+            return {k: self.snapshot(v, buffers, key + (k,)) for k, v in obj.items()}
+        if isinstance(obj, (list, tuple)):
+            return type(obj)(self.snapshot(v, buffers, key + (i,)) for i, v in enumerate(obj))
+        return obj
+
+    def save(self, checkpoint: dict, save_path: str):
+        self.raise_error()
+        start_time = time.time()
+        try:
+            buffers = self.free_buffers.get_nowait()
+        except queue.Empty:
+            logger.warning(
+                f"Saving {save_path} blocks the training until one of the {self.max_pending} pending checkpoints is "
+                "written, the storage is slower than the checkpoint interval (see ckpt.max_pending_ckpts)"
+            )
+            buffers = self.free_buffers.get()
+            logger.warning(f"The training step was blocked {time.time() - start_time:.1f}s by the checkpoint writes")
+        checkpoint = self.snapshot(checkpoint, buffers)
+        if torch.cuda.is_available():
+            # The non-blocking copies must be done before the next training step changes the weights
+            torch.cuda.synchronize()
+        blocking_time = time.time() - start_time
+        self.pending.put((checkpoint, save_path, buffers, start_time, blocking_time))
+
+    def run(self):
+        while True:
+            item = self.pending.get()
+            if item is None:
+                self.pending.task_done()
+                return
+            checkpoint, save_path, buffers, start_time, blocking_time = item
+            try:
+                torch.save(checkpoint, save_path + ".tmp")
+                os.replace(save_path + ".tmp", save_path)
+                self.remove_old_checkpoints()
+                logger.info(
+                    f"Saved checkpoint to {save_path} in {time.time() - start_time:.1f}s, "
+                    f"the training step was blocked for {blocking_time:.2f}s"
+                )
+            except Exception as e:
+                logger.error(f"Error saving checkpoint {save_path}: {e}")
+                self.error = e
+            finally:
+                del checkpoint
+                self.free_buffers.put(buffers)
+                self.pending.task_done()
+
+    def remove_old_checkpoints(self):
+        if self.keep_last <= 0:
+            return
+        checkpoints = []
+        for file in os.listdir(self.checkpoints_dir):
+            match = CHECKPOINT_PATTERN.match(file)
+            if match is not None:
+                checkpoints.append((int(match.group(1)), os.path.join(self.checkpoints_dir, file)))
+        kept = []
+        for global_step, path in sorted(checkpoints)[: -self.keep_last]:
+            if self.removable is None or self.removable(global_step):
+                os.remove(path)
+            else:
+                kept.append((global_step, path))
+        # Bounded even when the evaluator never gets to them
+        for global_step, path in kept[: max(len(kept) - self.max_unvalidated, 0)]:
+            logger.warning(
+                f"Removing checkpoint {global_step} unvalidated, more than {self.max_unvalidated} are waiting"
+            )
+            os.remove(path)
+
+    def raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError("A background checkpoint write failed") from error
+
+    def close(self):
+        """Wait for the pending writes"""
+        if self.thread.is_alive():
+            self.pending.put(None)
+            self.pending.join()
+        self.raise_error()
@@ -0,0 +1,122 @@
+# Copyright (c) 2024 Bytedance Ltd. and/or its affiliates
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import json
+import fcntl
+from typing import Optional
+
+import numpy as np
+import torch
+
+DATA_NAME = "data.bin"
+INDEX_NAME = "index.jsonl"
+LOCK_NAME = "store.lock"
+# numpy has no bfloat16, these tensors are stored as their int16 bit pattern and viewed back on read
+BFLOAT16 = "bfloat16"
+
+
+class FeatureStore:
+    """
+    A single append-only data file plus an offset index, replacing one torch.save pickle per video.
+    Writers append the bytes and then the index line while holding an exclusive lock, so a reader never sees a
+    partially written entry. Readers memory-map the data file and pick up entries appended by other processes lazily.
+    """
+
+    def __init__(self, store_dir: str):
+        self.store_dir = store_dir
+        os.makedirs(store_dir, exist_ok=True)
+        self.data_path = os.path.join(store_dir, DATA_NAME)
+        self.index_path = os.path.join(store_dir, INDEX_NAME)
+        self.lock_path = os.path.join(store_dir, LOCK_NAME)
+        for path in (self.data_path, self.index_path):
+            open(path, "ab").close()
+
+        self.entries = {}
+        self.index_position = 0
+        self.data = None
+
+    def __getstate__(self):
+        # The memory map is recreated in every dataloader worker
+        state = self.__dict__.copy()
+        state["data"] = None
+        return state
+
+    def __len__(self):
+        self.refresh_index()
+        return len(self.entries)
+
+    def __contains__(self, key: str):
+        if key not in self.entries:
+            self.refresh_index()
+        return key in self.entries
+
+    def refresh_index(self):
+        """Read the index lines appended since the last refresh"""
+        with open(self.index_path, "rb") as f:
+            f.seek(self.index_position)
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break  # Not completely written yet
+                entry = json.loads(line)
+                self.entries[entry["key"]] = entry
+                self.index_position += len(line)
+
+    def shape(self, key: str) -> Optional[tuple]:
+        if key not in self:
+            return None
+        return tuple(self.entries[key]["shape"])
+
+    def get(self, key: str, start: Optional[int] = None, stop: Optional[int] = None) -> Optional[torch.Tensor]:
+        """The tensor of key, or only its rows start:stop along the first dimension, the other rows aren't copied"""
+        if key not in self:
+            return None
+        entry = self.entries[key]
+        shape = list(entry["shape"])
+        offset, nbytes = entry["offset"], entry["nbytes"]
+        if start is not None or stop is not None:
+            start, stop, _ = slice(start, stop).indices(shape[0])
+            stop = max(start, stop)
+            row_nbytes = nbytes // shape[0] if shape[0] > 0 else 0
+            offset, nbytes = offset + start * row_nbytes, (stop - start) * row_nbytes
+            shape[0] = stop - start
+        end = offset + nbytes
+        if self.data is None or len(self.data) < entry["offset"] + entry["nbytes"]:
+            self.data = np.memmap(self.data_path, dtype=np.uint8, mode="r")
+        if entry["dtype"] == BFLOAT16:
+            array = np.frombuffer(self.data[offset:end], dtype=np.int16).reshape(shape)
+            return torch.from_numpy(array.copy()).view(torch.bfloat16)
+        array = np.frombuffer(self.data[offset:end], dtype=entry["dtype"]).reshape(shape)
+        return torch.from_numpy(array.copy())
+
+    def put(self, key: str, tensor: torch.Tensor):
+        tensor = tensor.detach().cpu()
+        if tensor.dtype == torch.bfloat16:
+            array = np.ascontiguousarray(tensor.view(torch.int16).numpy())
+            dtype = BFLOAT16
+        else:
+            array = np.ascontiguousarray(tensor.numpy())
+            dtype = str(array.dtype)
+        with open(self.lock_path, "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                with open(self.data_path, "ab") as f:
+                    offset = f.seek(0, os.SEEK_END)
+                    f.write(array.tobytes())
+                entry = dict(key=key, offset=offset, nbytes=array.nbytes, dtype=dtype, shape=array.shape)
+                with open(self.index_path, "a") as f:
+                    f.write(json.dumps(entry) + "\n")
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+        self.entries[key] = entry
@@ -117,7 +117,12 @@ class ImageProcessor:
 
     def affine_transform(self, image: torch.Tensor) -> np.ndarray:
         # image = rearrange(image, "c h w-> h w c").numpy()
-        if self.fa is None:
+        if getattr(self, "fa", None) is None and getattr(self, "face_mesh", None) is None:
+            # Lazily created on CPU-only hosts, so the processors of the dataset workers don't load the model
+            self.fa = face_alignment.FaceAlignment(
+                face_alignment.LandmarksType.TWO_D, flip_input=False, device="cpu"
+            )
+        if getattr(self, "fa", None) is None:
             landmark_coordinates = np.array(self.detect_facial_landmarks(image))
             lm68 = mediapipe_lm478_to_face_alignment_lm68(landmark_coordinates)
         else:
@@ -149,11 +154,25 @@ class ImageProcessor:
         masked_pixel_values = pixel_values * self.mask_image
         return pixel_values, masked_pixel_values, self.mask_image[0:1]
 
+    def prepare_fixed_masks_and_masked_images(self, images: torch.Tensor):
+        """
+        The fixed mask of a whole (F, C, H, W) chunk in one resize, normalize and multiply, on the device of the
+        images. The returned masks are the shared (1, H, W) mask broadcast to the F frames, not F copies of it
+        """
+        images = self.resize(images)
+        pixel_values = self.normalize(images / 255.0)
+        mask_image = self.mask_image.to(images.device)
+        masked_pixel_values = pixel_values * mask_image
+        masks = mask_image[0:1].expand(len(images), -1, -1, -1)
+        return pixel_values, masked_pixel_values, masks
+
     def prepare_masks_and_masked_images(self, images: Union[torch.Tensor, np.ndarray], affine_transform=False):
         if isinstance(images, np.ndarray):
             images = torch.from_numpy(images)
         if images.shape[3] == 3:
             images = rearrange(images, "b h w c -> b c h w")
+        if self.mask == "fix_mask" and not affine_transform:
+            return self.prepare_fixed_masks_and_masked_images(images)
         if self.mask == "fix_mask":
             results = [self.preprocess_fixed_mask_image(image, affine_transform=affine_transform) for image in images]
         else:
@@ -0,0 +1,142 @@
+# Copyright (c) 2024 Bytedance Ltd. and/or its affiliates
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import time
+from typing import Optional
+
+import torch
+import torch.distributed as dist
+
+
+class TrainingMetrics:
+    """
+    Training telemetry without a per-step device sync or collective. The losses are accumulated on the device, and
+    every interval steps the sums and the timings of all ranks go through one asynchronous all_reduce. Its result is
+    read at the end of the next interval, when it has long completed. The main process then appends a JSON line to
+    log_path with the mean losses, the step time, the samples/s and the dataloader wait versus compute time of every
+    rank. A run whose data_wait_fraction is high is input-bound.
+
+    The times are measured on the host: data wait is the time blocked on the dataloader, compute is the rest of the
+    step. Since the host can't run ahead of the device by more than the launch queue, they add up over an interval.
+    """
+
+    def __init__(self, names, device, batch_size: int, interval: int = 10, log_path: Optional[str] = None):
+        self.names = list(names)
+        self.device = torch.device(device)
+        self.batch_size = batch_size
+        self.interval = interval
+        self.log_path = log_path
+        self.world_size = dist.get_world_size() if dist.is_initialized() else 1
+        self.rank = dist.get_rank() if dist.is_initialized() else 0
+
+        self.history = {name: ([], []) for name in self.names}
+        self.latest = {}
+        self.pending = None
+        self.reset()
+
+    def reset(self):
+        self.sums = torch.zeros(len(self.names), device=self.device)
+        self.counts = torch.zeros(len(self.names), device=self.device)
+        self.num_steps = 0
+        self.data_wait = 0.0
+        self.interval_start = time.time()
+
+    def timed(self, dataloader):
+        """Iterate over the dataloader, measuring how long each batch is waited for"""
+        iterator = iter(dataloader)
+        while True:
+            start_time = time.time()
+            try:
+                batch = next(iterator)
+            except StopIteration:
+                return
+            self.data_wait += time.time() - start_time
+            yield batch
+
+    def update(self, name: str, value):
+        index = self.names.index(name)
+        if isinstance(value, torch.Tensor):
+            value = value.detach().float()
+        self.sums[index] += value
+        self.counts[index] += 1
+
+    def step(self, global_step: int):
+        self.num_steps += 1
+        if self.num_steps < self.interval:
+            return
+
+        wall_time = time.time() - self.interval_start
+        # Every rank fills its own row of the timings, so that the sum gathers them
+        timings = torch.zeros(self.world_size, 2, device=self.device)
+        timings[self.rank, 0] = self.data_wait
+        timings[self.rank, 1] = wall_time - self.data_wait
+        packed = torch.cat([self.sums, self.counts, timings.flatten()])
+
+        self.read_pending()
+        if self.world_size > 1:
+            # With NCCL, wait() only orders the current stream after the collective, the host doesn't block
+            dist.all_reduce(packed, async_op=True).wait()
+        if self.device.type == "cuda":
+            packed = packed.to("cpu", non_blocking=True)
+            done = torch.cuda.Event()
+            done.record()
+        else:
+            done = None
+        self.pending = (packed, done, global_step, self.num_steps, wall_time)
+        self.reset()
+
+    def read_pending(self):
+        if self.pending is None:
+            return
+        packed, done, global_step, num_steps, wall_time = self.pending
+        self.pending = None
+        if done is not None:
+            done.synchronize()
+        values = packed.tolist()
+
+        num_names = len(self.names)
+        sums, counts = values[:num_names], values[num_names : 2 * num_names]
+        timings = values[2 * num_names :]
+        data_wait = timings[0::2]
+        compute = timings[1::2]
+
+        losses = {}
+        for name, total, count in zip(self.names, sums, counts):
+            if count > 0:
+                losses[name] = total / count
+                self.history[name][0].append(global_step)
+                self.history[name][1].append(losses[name])
+        self.latest = losses
+
+        if self.rank != 0 or self.log_path is None:
+            return
+        mean_data_wait = sum(data_wait) / self.world_size
+        record = {
+            "step": global_step,
+            "time": time.time(),
+            **losses,
+            "step_time": wall_time / num_steps,
+            "samples_per_second": num_steps * self.batch_size * self.world_size / wall_time,
+            "data_wait": mean_data_wait,
+            "compute": sum(compute) / self.world_size,
+            "data_wait_fraction": mean_data_wait / wall_time,
+            "data_wait_per_rank": data_wait,
+            "compute_per_rank": compute,
+        }
+        with open(self.log_path, "a") as f:
+            f.write(json.dumps(record) + "\n")
+
+    def close(self):
+        self.read_pending()
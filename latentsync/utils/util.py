@@ -74,6 +74,43 @@ def read_video_decord(video_path: str):
     return video_frames
 
 
+def check_video_sampled(video_path: str, check_frame, sample_stride: int, chunk_size: int = 16):
+    """
+    Checks every sample_stride-th frame of a video and the last one, and stops at the first frame that fails.
+    check_frame returns (passed, borderline), all the frames around a borderline sample are checked too.
+    """
+    vr = VideoReader(video_path)
+    num_frames = len(vr)
+    if num_frames == 0:
+        return False
+
+    def check_frames(indices):
+        borderline = []
+        for i in range(0, len(indices), chunk_size):
+            chunk = indices[i : i + chunk_size]
+            for index, frame in zip(chunk, vr.get_batch(chunk).asnumpy()):
+                passed, is_borderline = check_frame(frame)
+                if not passed:
+                    return False, borderline
+                if is_borderline:
+                    borderline.append(index)
+        return True, borderline
+
+    sampled = list(range(0, num_frames, sample_stride))
+    if sampled[-1] != num_frames - 1:
+        sampled.append(num_frames - 1)
+    passed, borderline = check_frames(sampled)
+
+    if passed and len(borderline) > 0:
+        # Escalates to every frame between a borderline sample and its neighbouring samples
+        dense = set()
+        for index in borderline:
+            dense.update(range(max(index - sample_stride + 1, 0), min(index + sample_stride, num_frames)))
+        passed, _ = check_frames(sorted(dense - set(sampled)))
+    vr.seek(0)
+    return passed
+
+
 def read_video_cv2(video_path: str):
     # Open the video file
     cap = cv2.VideoCapture(video_path)
@@ -115,8 +152,17 @@ def read_audio(audio_path: str, audio_sample_rate: int = 16000):
 
     return audio_samples
 
-def process_and_save_video(synced_video_frames, audio_path, video_out_path):
+def process_and_save_video(synced_video_frames, audio_path, video_out_path, preview=False):
     temp_dir = create_temp_dir()
+    if preview:
+        # Low-bitrate proxy, at most 480p
+        video_codec = "-c:v libx264 -preset veryfast -crf 32 -vf \"scale=-2:'min(480,ih)'\""
+    elif torch.cuda.is_available():
+        video_codec = "-c:v h264_nvenc -preset slow -profile:v high -level:v 4.2 -rc vbr -cq 18 -b:v 0"
+    else:
+        # CPU-only hosts have no NVENC
+        video_codec = "-c:v libx264 -preset slow -profile:v high -level:v 4.2 -crf 18"
+    audio_bitrate = "64k" if preview else "320k"
     try:
         tmp_video_path = os.path.join(temp_dir, "video.mkv")
         write_video(tmp_video_path, synced_video_frames, fps=25)
@@ -125,9 +171,9 @@ def process_and_save_video(synced_video_frames, audio_path, video_out_path):
             ffmpeg -y -loglevel error -nostdin \
             -i {tmp_video_path} \
             -i {audio_path} \
-            -c:v h264_nvenc -preset slow -profile:v high -level:v 4.2 -rc vbr -cq 18 -b:v 0 \
+            {video_codec} \
             -pix_fmt yuv420p -movflags +faststart \
-            -c:a aac -b:a 320k -ar 48000 \
+            -c:a aac -b:a {audio_bitrate} -ar 48000 \
             {video_out_path}
             """
         subprocess.run(command, shell=True)
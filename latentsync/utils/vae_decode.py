@@ -0,0 +1,49 @@
+# Copyright (c) 2024 Bytedance Ltd. and/or its affiliates
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import torch
+
+# Latent pixels of context decoded around a region. The convolutions of the decoder only see a few latent pixels, but
+# its group norms and mid-block attention are computed over the whole input, so the result is close to the full decode
+# rather than identical. scripts/check_partial_decode.py measures the difference.
+DEFAULT_MARGIN = 4
+
+
+def vae_scale_factor(vae) -> int:
+    return 2 ** (len(vae.config.block_out_channels) - 1)
+
+
+def decode_latent_region(
+    vae, latents: torch.Tensor, top: int, bottom: int, left: int, right: int, margin: int = DEFAULT_MARGIN
+):
+    """
+    Decode latents[:, :, top:bottom, left:right] plus a margin of context, and return the pixels of the region only.
+    The latents are expected unscaled, as vae.decode takes them.
+    """
+    height, width = latents.shape[-2:]
+    crop_top, crop_bottom = max(top - margin, 0), min(bottom + margin, height)
+    crop_left, crop_right = max(left - margin, 0), min(right + margin, width)
+
+    images = vae.decode(latents[:, :, crop_top:crop_bottom, crop_left:crop_right]).sample
+
+    scale = vae_scale_factor(vae)
+    y = (top - crop_top) * scale
+    x = (left - crop_left) * scale
+    return images[:, :, y : y + (bottom - top) * scale, x : x + (right - left) * scale]
+
+
+def decode_lower_half(vae, latents: torch.Tensor, margin: int = DEFAULT_MARGIN):
+    """The lower half of vae.decode(latents).sample, which is all the LPIPS and lower-half SyncNet losses look at"""
+    height, width = latents.shape[-2:]
+    return decode_latent_region(vae, latents, height // 2, height, 0, width, margin)
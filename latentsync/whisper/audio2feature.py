@@ -1,9 +1,27 @@
 # Adapted from https://github.com/TMElyralab/MuseTalk/blob/main/musetalk/whisper/audio2feature.py
 
-from .whisper import load_model
+from .whisper import load_encoder
+from .whisper.audio import load_audio, log_mel_spectrogram, N_FRAMES
+from ..utils.feature_store import FeatureStore
 import numpy as np
 import torch
+import torch.nn.functional as F
 import os
+from einops import rearrange
+
+
+def get_sliced_features(feature_array, vid_indices, audio_feat_length=[2, 2], fps=25):
+    """
+    Vectorized Audio2Feature.get_sliced_feature: gathers the windows of all the given video indices with a single
+    indexing op, on the device of feature_array. Returns a tensor of shape (len(vid_indices), 50, embedding_dim).
+    It doesn't need the whisper model, so the dataset workers can crop precomputed features with it.
+    """
+    length = len(feature_array)
+    center_indices = torch.tensor([int(vid_idx * 50 / fps) for vid_idx in vid_indices])
+    offsets = torch.arange(-audio_feat_length[0] * 2, (audio_feat_length[1] + 1) * 2)
+    indices = (center_indices[:, None] + offsets[None, :]).clamp(0, length - 1)
+    selected_features = feature_array[indices.to(feature_array.device)]
+    return selected_features.reshape(len(vid_indices), -1, feature_array.shape[-1])
 
 
 class Audio2Feature:
@@ -13,9 +31,21 @@ class Audio2Feature:
         device=None,
         audio_embeds_cache_dir=None,
         num_frames=16,
+        dtype=None,
+        fast_encoder=False,
+        audio_embeds_store_dir=None,
     ):
-        self.model = load_model(model_path, device)
+        self.model = load_encoder(model_path, device)
+        if dtype is None:
+            dtype = torch.float16 if self.model.device.type == "cuda" else torch.float32
+        self.dtype = dtype
+        if fast_encoder:
+            self.model.enable_fast_path(dtype)
         self.audio_embeds_cache_dir = audio_embeds_cache_dir
+        # A consolidated feature store replaces the per-file cache when set
+        self.audio_embeds_store = None
+        if audio_embeds_store_dir is not None and audio_embeds_store_dir != "":
+            self.audio_embeds_store = FeatureStore(audio_embeds_store_dir)
         self.num_frames = num_frames
         self.embedding_dim = self.model.dims.n_audio_state
 
@@ -80,70 +110,110 @@ class Audio2Feature:
         selected_feature = torch.from_numpy(selected_feature)
         return selected_feature, selected_idx
 
+    def get_sliced_features(self, feature_array, vid_indices, audio_feat_length=[2, 2], fps=25):
+        return get_sliced_features(feature_array, vid_indices, audio_feat_length, fps)
+
     def feature2chunks(self, feature_array, fps, audio_feat_length=[2, 2]):
-        whisper_chunks = []
         whisper_idx_multiplier = 50.0 / fps
-        i = 0
         print(f"video in {fps} FPS, audio idx in 50FPS")
 
-        while True:
-            start_idx = int(i * whisper_idx_multiplier)
-            selected_feature, selected_idx = self.get_sliced_feature(
-                feature_array=feature_array, vid_idx=i, audio_feat_length=audio_feat_length, fps=fps
-            )
-            # print(f"i:{i},selected_idx {selected_idx}")
-            whisper_chunks.append(selected_feature)
-            i += 1
-            if start_idx > len(feature_array):
-                break
+        # Same number of chunks as stepping until the start index is past the end of the features
+        num_chunks = 0
+        while int(num_chunks * whisper_idx_multiplier) <= len(feature_array):
+            num_chunks += 1
+        num_chunks += 1
 
-        return whisper_chunks
+        whisper_chunks = self.get_sliced_features(feature_array, range(num_chunks), audio_feat_length, fps)
+        return list(whisper_chunks)
 
     def _audio2feat(self, audio_path: str):
-        # get the sample rate of the audio
-        result = self.model.transcribe(audio_path)
-        embed_list = []
-        for emb in result["segments"]:
-            encoder_embeddings = emb["encoder_embeddings"]
-            encoder_embeddings = encoder_embeddings.transpose(0, 2, 1, 3)
-            encoder_embeddings = encoder_embeddings.squeeze(0)
-            start_idx = int(emb["start"])
-            end_idx = int(emb["end"])
-            emb_end_idx = int((end_idx - start_idx) / 2)
-            embed_list.append(encoder_embeddings[:emb_end_idx])
-        concatenated_array = torch.from_numpy(np.concatenate(embed_list, axis=0))
-        return concatenated_array
-
-    def audio2feat(self, audio_path):
-        if self.audio_embeds_cache_dir == "" or self.audio_embeds_cache_dir is None:
-            return self._audio2feat(audio_path)
+        return self.extract_features([audio_path])[0]
 
-        audio_embeds_cache_path = os.path.join(self.audio_embeds_cache_dir, os.path.basename(audio_path) + ".pt")
+    @torch.no_grad()
+    def extract_features(self, audio_paths, batch_size=8):
+        """
+        The 30s windows of all the given files go through the encoder together and the layer embeddings never leave
+        the device, instead of one window at a time with a copy to numpy as in transcribe.
+        Returns one (T, layers, D) tensor per file, with T at 50 fps.
+        """
+        device = self.model.device
+
+        windows = []
+        num_valid_frames = []
+        num_file_windows = []
+        for audio_path in audio_paths:
+            mel = log_mel_spectrogram(torch.from_numpy(load_audio(audio_path)).to(device))
+            num_mel_frames = mel.shape[-1]
+            seeks = range(0, num_mel_frames, N_FRAMES)
+            for seek in seeks:
+                segment = mel[:, seek : seek + N_FRAMES]
+                windows.append(F.pad(segment, (0, N_FRAMES - segment.shape[-1])))
+                # The encoder downsamples the mel frames by 2
+                num_valid_frames.append(segment.shape[-1] // 2)
+            num_file_windows.append(len(seeks))
+
+        embeddings = []
+        for i in range(0, len(windows), batch_size):
+            batch = torch.stack(windows[i : i + batch_size]).to(self.dtype)
+            embeddings.append(self.model.encoder.forward_embeddings(batch))
+        embeddings = rearrange(torch.cat(embeddings), "w l t d -> w t l d")
+
+        features = []
+        window_idx = 0
+        for num_windows in num_file_windows:
+            file_windows = range(window_idx, window_idx + num_windows)
+            features.append(torch.cat([embeddings[w, : num_valid_frames[w]] for w in file_windows]))
+            window_idx += num_windows
+        return features
 
-        if os.path.isfile(audio_embeds_cache_path):
-            try:
-                audio_feat = torch.load(audio_embeds_cache_path)
-            except Exception as e:
-                print(f"{type(e).__name__} - {e} - {audio_embeds_cache_path}")
-                os.remove(audio_embeds_cache_path)
-                audio_feat = self._audio2feat(audio_path)
-                torch.save(audio_feat, audio_embeds_cache_path)
-        else:
-            audio_feat = self._audio2feat(audio_path)
-            torch.save(audio_feat, audio_embeds_cache_path)
+    def audio2feat(self, audio_path):
+        return self.audio2feat_batch([audio_path])[0]
 
-        return audio_feat
+    def audio2feat_batch(self, audio_paths):
+        """Features of several files, the ones missing from the cache are extracted in a single batched pass"""
+        if self.audio_embeds_store is not None:
+            return self.audio2feat_store(audio_paths)
+        if self.audio_embeds_cache_dir == "" or self.audio_embeds_cache_dir is None:
+            return self.extract_features(audio_paths)
+
+        audio_feats = [None] * len(audio_paths)
+        missing = []
+        for i, audio_path in enumerate(audio_paths):
+            audio_embeds_cache_path = self.cache_path(audio_path)
+            if os.path.isfile(audio_embeds_cache_path):
+                try:
+                    audio_feats[i] = torch.load(audio_embeds_cache_path)
+                    continue
+                except Exception as e:
+                    print(f"{type(e).__name__} - {e} - {audio_embeds_cache_path}")
+                    os.remove(audio_embeds_cache_path)
+            missing.append(i)
+
+        if len(missing) > 0:
+            extracted = self.extract_features([audio_paths[i] for i in missing])
+            for i, audio_feat in zip(missing, extracted):
+                torch.save(audio_feat.cpu(), self.cache_path(audio_paths[i]))
+                audio_feats[i] = audio_feat
+
+        return audio_feats
+
+    def audio2feat_store(self, audio_paths):
+        audio_feats = [self.audio_embeds_store.get(os.path.basename(audio_path)) for audio_path in audio_paths]
+        missing = [i for i, audio_feat in enumerate(audio_feats) if audio_feat is None]
+        if len(missing) > 0:
+            extracted = self.extract_features([audio_paths[i] for i in missing])
+            for i, audio_feat in zip(missing, extracted):
+                self.audio_embeds_store.put(os.path.basename(audio_paths[i]), audio_feat)
+                audio_feats[i] = audio_feat
+        return audio_feats
+
+    def cache_path(self, audio_path):
+        return os.path.join(self.audio_embeds_cache_dir, os.path.basename(audio_path) + ".pt")
 
     def crop_overlap_audio_window(self, audio_feat, start_index):
-        selected_feature_list = []
-        for i in range(start_index, start_index + self.num_frames):
-            selected_feature, selected_idx = self.get_sliced_feature(
-                feature_array=audio_feat, vid_idx=i, audio_feat_length=[2, 2], fps=25
-            )
-            selected_feature_list.append(selected_feature)
-        mel_overlap = torch.stack(selected_feature_list)
-        return mel_overlap
-
+        return self.get_sliced_features(
+            audio_feat, range(start_index, start_index + self.num_frames), audio_feat_length=[2, 2], fps=25
+        )
 
 if __name__ == "__main__":
     audio_encoder = Audio2Feature(model_path="checkpoints/whisper/tiny.pt")
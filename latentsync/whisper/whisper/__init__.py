@@ -9,9 +9,26 @@ import torch
 from tqdm import tqdm
 
 from .audio import load_audio, log_mel_spectrogram, pad_or_trim
-from .decoding import DecodingOptions, DecodingResult, decode, detect_language
-from .model import Whisper, ModelDimensions
-from .transcribe import transcribe
+from .model import Whisper, WhisperEncoder, ModelDimensions
+from ...utils.checkpoint import load_checkpoint
+
+# The decoding and transcription API is imported on first access, so that the encoder-only path never loads the
+# tokenizer (and transformers)
+_LAZY_ATTRIBUTES = {
+    "DecodingOptions": ".decoding",
+    "DecodingResult": ".decoding",
+    "decode": ".decoding",
+    "detect_language": ".decoding",
+    "transcribe": ".transcribe",
+}
+
+
+def __getattr__(name):
+    if name in _LAZY_ATTRIBUTES:
+        import importlib
+
+        return getattr(importlib.import_module(_LAZY_ATTRIBUTES[name], __name__), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 _MODELS = {
@@ -30,6 +47,15 @@ _MODELS = {
 }
 
 
+def _sha256(path: str) -> str:
+    """Hash the file in chunks, so that checking a large checkpoint doesn't read it into memory"""
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
 def _download(url: str, root: str, in_memory: bool) -> Union[bytes, str]:
     os.makedirs(root, exist_ok=True)
 
@@ -40,9 +66,8 @@ def _download(url: str, root: str, in_memory: bool) -> Union[bytes, str]:
         raise RuntimeError(f"{download_target} exists and is not a regular file")
 
     if os.path.isfile(download_target):
-        model_bytes = open(download_target, "rb").read()
-        if hashlib.sha256(model_bytes).hexdigest() == expected_sha256:
-            return model_bytes if in_memory else download_target
+        if _sha256(download_target) == expected_sha256:
+            return open(download_target, "rb").read() if in_memory else download_target
         else:
             warnings.warn(f"{download_target} exists, but the SHA256 checksum does not match; re-downloading the file")
 
@@ -58,13 +83,12 @@ def _download(url: str, root: str, in_memory: bool) -> Union[bytes, str]:
                 output.write(buffer)
                 loop.update(len(buffer))
 
-    model_bytes = open(download_target, "rb").read()
-    if hashlib.sha256(model_bytes).hexdigest() != expected_sha256:
+    if _sha256(download_target) != expected_sha256:
         raise RuntimeError(
             "Model has been downloaded but the SHA256 checksum does not not match. Please retry loading the model."
         )
 
-    return model_bytes if in_memory else download_target
+    return open(download_target, "rb").read() if in_memory else download_target
 
 
 def available_models() -> List[str]:
@@ -72,6 +96,30 @@ def available_models() -> List[str]:
     return list(_MODELS.keys())
 
 
+def _load_checkpoint(name: str, download_root: str, in_memory: bool) -> dict:
+    if download_root is None:
+        download_root = os.getenv("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache", "whisper"))
+
+    if name in _MODELS:
+        checkpoint_file = _download(_MODELS[name], download_root, in_memory)
+    elif os.path.isfile(name):
+        checkpoint_file = open(name, "rb").read() if in_memory else name
+    else:
+        raise RuntimeError(f"Model {name} not found; available models = {available_models()}")
+
+    if in_memory:
+        with io.BytesIO(checkpoint_file) as fp:
+            checkpoint = torch.load(fp, map_location="cpu")
+    else:
+        # Memory-mapped, the weights are paged in while being copied into the model
+        checkpoint = load_checkpoint(checkpoint_file, device="cpu")
+
+    # Checkpoints converted to safetensors store the weights under "state_dict"
+    if "model_state_dict" not in checkpoint:
+        checkpoint["model_state_dict"] = checkpoint.pop("state_dict")
+    return checkpoint
+
+
 def load_model(
     name: str, device: Optional[Union[str, torch.device]] = None, download_root: str = None, in_memory: bool = False
 ) -> Whisper:
@@ -98,22 +146,40 @@ def load_model(
 
     if device is None:
         device = "cuda" if torch.cuda.is_available() else "cpu"
-    if download_root is None:
-        download_root = os.getenv("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache", "whisper"))
 
-    if name in _MODELS:
-        checkpoint_file = _download(_MODELS[name], download_root, in_memory)
-    elif os.path.isfile(name):
-        checkpoint_file = open(name, "rb").read() if in_memory else name
-    else:
-        raise RuntimeError(f"Model {name} not found; available models = {available_models()}")
-
-    with (io.BytesIO(checkpoint_file) if in_memory else open(checkpoint_file, "rb")) as fp:
-        checkpoint = torch.load(fp, map_location=device)
-    del checkpoint_file
+    checkpoint = _load_checkpoint(name, download_root, in_memory)
+    if checkpoint.get("encoder_only", False):
+        raise RuntimeError(f"{name} is an encoder-only checkpoint, load it with `whisper.load_encoder`")
 
     dims = ModelDimensions(**checkpoint["dims"])
     model = Whisper(dims)
     model.load_state_dict(checkpoint["model_state_dict"])
+    del checkpoint
+
+    return model.to(device)
+
+
+def load_encoder(
+    name: str, device: Optional[Union[str, torch.device]] = None, download_root: str = None, in_memory: bool = False
+) -> WhisperEncoder:
+    """
+    Load only the audio encoder of a Whisper model, from a full or an encoder-only checkpoint. The decoder weights of
+    a full checkpoint are skipped, with a memory-mapped checkpoint they are never read from disk.
+
+    The parameters are the same as for `load_model`.
+    """
+
+    if device is None:
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+
+    checkpoint = _load_checkpoint(name, download_root, in_memory)
+    state_dict = {
+        key: value for key, value in checkpoint["model_state_dict"].items() if key.startswith("encoder.")
+    }
+
+    dims = ModelDimensions(**checkpoint["dims"])
+    model = WhisperEncoder(dims)
+    model.load_state_dict(state_dict)
+    del checkpoint, state_dict
 
     return model.to(device)
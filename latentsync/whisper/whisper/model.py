@@ -8,9 +8,6 @@ import torch.nn.functional as F
 from torch import Tensor
 from torch import nn
 
-from .transcribe import transcribe as transcribe_function
-from .decoding import detect_language as detect_language_function, decode as decode_function
-
 
 @dataclass
 class ModelDimensions:
@@ -27,7 +24,12 @@ class ModelDimensions:
 
 
 class LayerNorm(nn.LayerNorm):
+    # Set by enable_fast_path, the weights are then already in the compute dtype
+    fast = False
+
     def forward(self, x: Tensor) -> Tensor:
+        if self.fast:
+            return super().forward(x)
         return super().forward(x.float()).type(x.dtype)
 
 
@@ -55,6 +57,9 @@ def sinusoids(length, channels, max_timescale=10000):
 
 
 class MultiHeadAttention(nn.Module):
+    # Set by enable_fast_path, uses the fused scaled_dot_product_attention kernel
+    fast = False
+
     def __init__(self, n_state: int, n_head: int):
         super().__init__()
         self.n_head = n_head
@@ -87,6 +92,15 @@ class MultiHeadAttention(nn.Module):
 
     def qkv_attention(self, q: Tensor, k: Tensor, v: Tensor, mask: Optional[Tensor] = None):
         n_batch, n_ctx, n_state = q.shape
+        if self.fast:
+            q = q.view(*q.shape[:2], self.n_head, -1).permute(0, 2, 1, 3)
+            k = k.view(*k.shape[:2], self.n_head, -1).permute(0, 2, 1, 3)
+            v = v.view(*v.shape[:2], self.n_head, -1).permute(0, 2, 1, 3)
+            attn_mask = None if mask is None else mask[:n_ctx, : k.shape[2]].to(q.dtype)
+            # The default scale 1 / sqrt(head_dim) is the same as scaling both q and k by head_dim ** -0.25
+            wv = F.scaled_dot_product_attention(q, k, v, attn_mask=attn_mask)
+            return wv.permute(0, 2, 1, 3).flatten(start_dim=2)
+
         scale = (n_state // self.n_head) ** -0.25
         q = q.view(*q.shape[:2], self.n_head, -1).permute(0, 2, 1, 3) * scale
         k = k.view(*k.shape[:2], self.n_head, -1).permute(0, 2, 3, 1) * scale
@@ -170,6 +184,25 @@ class AudioEncoder(nn.Module):
         else:
             return x
 
+    def forward_embeddings(self, x: Tensor) -> Tensor:
+        """
+        Same embeddings as forward(x, include_embeddings=True), but they stay on the device as a single tensor
+        of shape = (batch_size, n_layer + 1, n_ctx, n_state)
+        """
+        x = F.gelu(self.conv1(x))
+        x = F.gelu(self.conv2(x))
+        x = x.permute(0, 2, 1)
+
+        assert x.shape[1:] == self.positional_embedding.shape, "incorrect audio shape"
+        x = (x + self.positional_embedding).to(x.dtype)
+
+        embeddings = [x]
+        for block in self.blocks:
+            x = block(x)
+            embeddings.append(x)
+
+        return torch.stack(embeddings, dim=1)
+
 
 class TextDecoder(nn.Module):
     def __init__(self, n_vocab: int, n_ctx: int, n_state: int, n_head: int, n_layer: int):
@@ -217,6 +250,52 @@ class TextDecoder(nn.Module):
             return logits
 
 
+class WhisperEncoder(nn.Module):
+    """
+    Only the audio encoder of Whisper, with the same parameter names as in the full model so that it can be loaded from
+    a regular checkpoint. This is all that is needed to extract the encoder embeddings.
+    """
+
+    def __init__(self, dims: ModelDimensions):
+        super().__init__()
+        self.dims = dims
+        self.encoder = AudioEncoder(
+            self.dims.n_mels,
+            self.dims.n_audio_ctx,
+            self.dims.n_audio_state,
+            self.dims.n_audio_head,
+            self.dims.n_audio_layer,
+        )
+
+    def embed_audio(self, mel: torch.Tensor):
+        return self.encoder.forward(mel)
+
+    def forward(self, mel: torch.Tensor):
+        return self.encoder(mel)
+
+    def enable_fast_path(self, dtype: torch.dtype = torch.float32):
+        """
+        Cast the weights to dtype once, so that the Linear / Conv1d / LayerNorm wrappers no longer cast on every call,
+        and compute the attention with scaled_dot_product_attention (torch>=2.0).
+        """
+        if not hasattr(F, "scaled_dot_product_attention"):
+            raise RuntimeError("The fast whisper encoder path requires torch>=2.0")
+        self.to(dtype)
+        for module in self.modules():
+            if isinstance(module, (LayerNorm, MultiHeadAttention)):
+                module.fast = True
+        return self
+
+    @property
+    def device(self):
+        return next(self.parameters()).device
+
+    def transcribe(self, *args, **kwargs):
+        from .transcribe import transcribe
+
+        return transcribe(self, *args, **kwargs)
+
+
 class Whisper(nn.Module):
     def __init__(self, dims: ModelDimensions):
         super().__init__()
@@ -285,6 +364,18 @@ class Whisper(nn.Module):
         self.decoder.apply(install_hooks)
         return cache, hooks
 
-    detect_language = detect_language_function
-    transcribe = transcribe_function
-    decode = decode_function
+    # Imported lazily, so that loading the model doesn't pull in the tokenizer
+    def detect_language(self, *args, **kwargs):
+        from .decoding import detect_language
+
+        return detect_language(self, *args, **kwargs)
+
+    def transcribe(self, *args, **kwargs):
+        from .transcribe import transcribe
+
+        return transcribe(self, *args, **kwargs)
+
+    def decode(self, *args, **kwargs):
+        from .decoding import decode
+
+        return decode(self, *args, **kwargs)
@@ -22,19 +22,23 @@ import subprocess
 from multiprocessing import Process
 import shutil
 
+from preprocess.manifest import STATUS_DONE, STATUS_REJECTED, open_manifest, run_task
+
+STAGE = "affine_transform"
+
 paths = []
 
 
-def gather_video_paths(input_dir, output_dir):
+def gather_video_paths(input_dir, output_dir, skip_existing=True):
     for video in sorted(os.listdir(input_dir)):
         if video.endswith(".mp4"):
             video_input = os.path.join(input_dir, video)
             video_output = os.path.join(output_dir, video)
-            if os.path.isfile(video_output):
+            if skip_existing and os.path.isfile(video_output):
                 continue
             paths.append((video_input, video_output))
         elif os.path.isdir(os.path.join(input_dir, video)):
-            gather_video_paths(os.path.join(input_dir, video), os.path.join(output_dir, video))
+            gather_video_paths(os.path.join(input_dir, video), os.path.join(output_dir, video), skip_existing)
 
 
 class FaceDetector:
@@ -64,32 +68,47 @@ def combine_video_audio(video_frames, video_input_path, video_output_path, proce
     write_video(video_temp, video_frames, fps=25)
 
     command = f"ffmpeg -y -loglevel error -i {video_input_path} -q:a 0 -map a {audio_temp}"
-    subprocess.run(command, shell=True)
+    subprocess.run(command, shell=True, check=True)
 
     os.makedirs(os.path.dirname(video_output_path), exist_ok=True)
-    command = f"ffmpeg -y -loglevel error -i {video_temp} -i {audio_temp} -c:v libx264 -c:a aac -map 0:v -map 1:a -q:v 0 -q:a 0 {video_output_path}"
-    subprocess.run(command, shell=True)
+    # Written under a temporary name, so that a failed or interrupted encode doesn't look like a finished video
+    video_output_temp = video_output_path + ".part"
+    command = (
+        f"ffmpeg -y -loglevel error -i {video_temp} -i {audio_temp} "
+        f"-c:v libx264 -c:a aac -map 0:v -map 1:a -q:v 0 -q:a 0 -f mp4 {video_output_temp}"
+    )
+    subprocess.run(command, shell=True, check=True)
+    os.replace(video_output_temp, video_output_path)
 
     os.remove(audio_temp)
     os.remove(video_temp)
 
 
-def func(paths, process_temp_dir, device_id, resolution):
+def affine_transform_video(video_input, video_output, face_detector, process_temp_dir):
+    try:
+        video_frames = face_detector.affine_transform_video(video_input)
+    except RuntimeError as e:  # Handle the exception of face not detcted
+        if str(e) != "Face not detected":
+            raise
+        print(f"Exception: {e} - {video_input}")
+        return STATUS_REJECTED, []
+
+    os.makedirs(os.path.dirname(video_output), exist_ok=True)
+    combine_video_audio(video_frames, video_input, video_output, process_temp_dir)
+    print(f"Saved: {video_output}")
+    return STATUS_DONE, [video_output]
+
+
+def func(paths, process_temp_dir, device_id, resolution, manifest_path=None):
     os.makedirs(process_temp_dir, exist_ok=True)
     face_detector = FaceDetector(resolution, f"cuda:{device_id}")
+    # Every process records its videos through its own connection
+    manifest = open_manifest(manifest_path)
 
     for video_input, video_output in paths:
-        if os.path.isfile(video_output):
-            continue
-        try:
-            video_frames = face_detector.affine_transform_video(video_input)
-        except Exception as e:  # Handle the exception of face not detcted
-            print(f"Exception: {e} - {video_input}")
-            continue
-
-        os.makedirs(os.path.dirname(video_output), exist_ok=True)
-        combine_video_audio(video_frames, video_input, video_output, process_temp_dir)
-        print(f"Saved: {video_output}")
+        result = run_task(affine_transform_video, video_input, video_output, face_detector, process_temp_dir)
+        if manifest is not None:
+            manifest.record(STAGE, result)
 
     face_detector.close()
 
@@ -99,9 +118,12 @@ def split(a, n):
     return (a[i * k + min(i, m) : (i + 1) * k + min(i + 1, m)] for i in range(n))
 
 
-def affine_transform_multi_gpus(input_dir, output_dir, temp_dir, resolution, num_workers):
+def affine_transform_multi_gpus(input_dir, output_dir, temp_dir, resolution, num_workers, manifest_path=None):
     print(f"Recursively gathering video paths of {input_dir} ...")
-    gather_video_paths(input_dir, output_dir)
+    manifest = open_manifest(manifest_path)
+    # With a manifest, an existing output may be a partial one, only the recorded videos are finished
+    gather_video_paths(input_dir, output_dir, skip_existing=manifest is None)
+    tasks = paths if manifest is None else manifest.pending(STAGE, paths)
     num_devices = torch.cuda.device_count()
     if num_devices == 0:
         raise RuntimeError("No GPUs found")
@@ -110,7 +132,7 @@ def affine_transform_multi_gpus(input_dir, output_dir, temp_dir, resolution, num
         shutil.rmtree(temp_dir)
     os.makedirs(temp_dir, exist_ok=True)
 
-    split_paths = list(split(paths, num_workers * num_devices))
+    split_paths = list(split(tasks, num_workers * num_devices))
 
     processes = []
 
@@ -118,7 +140,14 @@ def affine_transform_multi_gpus(input_dir, output_dir, temp_dir, resolution, num
         for j in range(num_workers):
             process_index = i * num_workers + j
             process = Process(
-                target=func, args=(split_paths[process_index], os.path.join(temp_dir, f"process_{i}"), i, resolution)
+                target=func,
+                args=(
+                    split_paths[process_index],
+                    os.path.join(temp_dir, f"process_{i}"),
+                    i,
+                    resolution,
+                    manifest_path,
+                ),
             )
             process.start()
             processes.append(process)
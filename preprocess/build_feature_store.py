@@ -0,0 +1,174 @@
+# Copyright (c) 2024 Bytedance Ltd. and/or its affiliates
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import os
+import multiprocessing
+
+import torch
+import tqdm
+from decord import AudioReader, cpu
+
+from latentsync.utils.audio import melspectrogram, melspectrogram_torch
+from latentsync.utils.feature_store import FeatureStore
+
+
+def compute_mel(video_path):
+    try:
+        ar = AudioReader(video_path, ctx=cpu(0), sample_rate=16000)
+        return video_path, torch.from_numpy(melspectrogram(ar[:].asnumpy().squeeze(0)))
+    except Exception as e:
+        print(f"{type(e).__name__} - {e} - {video_path}")
+        return video_path, None
+
+
+def read_wav(video_path):
+    try:
+        ar = AudioReader(video_path, ctx=cpu(0), sample_rate=16000)
+        return video_path, ar[:].asnumpy().squeeze(0)
+    except Exception as e:
+        print(f"{type(e).__name__} - {e} - {video_path}")
+        return video_path, None
+
+
+def put_mels(store, batch, device):
+    # In float64 like melspectrogram, so that the store holds the same values whichever way it was built
+    mels = melspectrogram_torch([torch.from_numpy(wav).double() for _, wav in batch], device=device)
+    for (video_path, _), mel in zip(batch, mels):
+        store.put(os.path.basename(video_path).replace(".mp4", "_mel"), mel.cpu())
+
+
+def build_mel_store_torch(video_paths, store, num_workers, device, batch_size):
+    # The audio is decoded in parallel, the mel spectrograms are computed a batch at a time on the device
+    batch = []
+    with multiprocessing.Pool(num_workers) as pool:
+        for video_path, wav in tqdm.tqdm(pool.imap_unordered(read_wav, video_paths), total=len(video_paths)):
+            if wav is not None:
+                batch.append((video_path, wav))
+            if len(batch) == batch_size:
+                put_mels(store, batch, device)
+                batch = []
+    if len(batch) > 0:
+        put_mels(store, batch, device)
+
+
+def build_mel_store(video_paths, store, num_workers):
+    # The mel spectrograms are computed in parallel and appended by this process only
+    with multiprocessing.Pool(num_workers) as pool:
+        for video_path, mel in tqdm.tqdm(pool.imap_unordered(compute_mel, video_paths), total=len(video_paths)):
+            if mel is not None:
+                store.put(os.path.basename(video_path).replace(".mp4", "_mel"), mel)
+
+
+def build_whisper_store_worker(rank, video_paths, store_dir, whisper_model_path, batch_size, cache_files):
+    from latentsync.whisper.audio2feature import Audio2Feature
+
+    device = f"cuda:{rank % torch.cuda.device_count()}" if torch.cuda.is_available() else "cpu"
+    if cache_files:
+        # The per-file cache read by Audio2Feature's audio_embeds_cache_dir
+        audio_encoder = Audio2Feature(model_path=whisper_model_path, device=device, audio_embeds_cache_dir=store_dir)
+        for i in tqdm.tqdm(range(0, len(video_paths), batch_size), disable=rank != 0):
+            try:
+                audio_encoder.audio2feat_batch(video_paths[i : i + batch_size])
+            except Exception as e:
+                print(f"{type(e).__name__} - {e} - {video_paths[i : i + batch_size]}")
+        return
+
+    audio_encoder = Audio2Feature(model_path=whisper_model_path, device=device)
+    # Several workers append to the same store, the writes are serialized by its lock
+    store = FeatureStore(store_dir)
+    for i in tqdm.tqdm(range(0, len(video_paths), batch_size), disable=rank != 0):
+        batch_paths = video_paths[i : i + batch_size]
+        try:
+            features = audio_encoder.extract_features(batch_paths)
+        except Exception as e:
+            print(f"{type(e).__name__} - {e} - {batch_paths}")
+            continue
+        for video_path, feature in zip(batch_paths, features):
+            store.put(os.path.basename(video_path), feature)
+
+
+def build_whisper_store(video_paths, store_dir, whisper_model_path, num_workers, batch_size, cache_files=False):
+    jobs = [
+        (rank, video_paths[rank::num_workers], store_dir, whisper_model_path, batch_size, cache_files)
+        for rank in range(num_workers)
+    ]
+    with multiprocessing.get_context("spawn").Pool(num_workers) as pool:
+        pool.starmap(build_whisper_store_worker, jobs)
+
+
+def build_feature_store(
+    fileslist,
+    store_dir,
+    feature,
+    num_workers,
+    whisper_model_path=None,
+    batch_size=8,
+    cache_files=False,
+    mel_device="",
+):
+    with open(fileslist) as file:
+        video_paths = [line.rstrip() for line in file]
+
+    if cache_files:
+        assert feature == "whisper", "Only the whisper features can be written as per-file cache"
+        os.makedirs(store_dir, exist_ok=True)
+        video_paths = [
+            path for path in video_paths if not os.path.isfile(os.path.join(store_dir, os.path.basename(path) + ".pt"))
+        ]
+        print(f"Computing the whisper features of {len(video_paths)} videos ...")
+        build_whisper_store(video_paths, store_dir, whisper_model_path, num_workers, batch_size, cache_files=True)
+        return
+
+    store = FeatureStore(store_dir)
+    if feature == "mel":
+        # Resumable, the videos already in the store are skipped
+        video_paths = [path for path in video_paths if os.path.basename(path).replace(".mp4", "_mel") not in store]
+        print(f"Computing the mel spectrograms of {len(video_paths)} videos ...")
+        if mel_device != "":
+            build_mel_store_torch(video_paths, store, num_workers, mel_device, batch_size)
+        else:
+            build_mel_store(video_paths, store, num_workers)
+    else:
+        video_paths = [path for path in video_paths if os.path.basename(path) not in store]
+        print(f"Computing the whisper features of {len(video_paths)} videos ...")
+        build_whisper_store(video_paths, store_dir, whisper_model_path, num_workers, batch_size)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build a consolidated mel or whisper feature store from a fileslist")
+    parser.add_argument("--fileslist", type=str, required=True)
+    parser.add_argument("--store_dir", type=str, required=True)
+    parser.add_argument("--feature", type=str, default="mel", choices=["mel", "whisper"])
+    parser.add_argument("--num_workers", type=int, default=16)
+    parser.add_argument("--whisper_model_path", type=str, default="checkpoints/whisper/tiny.pt")
+    parser.add_argument("--batch_size", type=int, default=8, help="files per whisper encoder or torch mel call")
+    parser.add_argument(
+        "--cache_files", action="store_true", help="fill a per-file audio_embeds_cache_dir instead of a store"
+    )
+    parser.add_argument(
+        "--mel_device", type=str, default="", help="compute the mel spectrograms in batches with torch on this device"
+    )
+    args = parser.parse_args()
+
+    build_feature_store(
+        args.fileslist,
+        args.store_dir,
+        args.feature,
+        args.num_workers,
+        args.whisper_model_path,
+        args.batch_size,
+        args.cache_files,
+        args.mel_device,
+    )
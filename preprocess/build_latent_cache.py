@@ -0,0 +1,88 @@
+# Copyright (c) 2024 Bytedance Ltd. and/or its affiliates
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import multiprocessing
+
+import torch
+import tqdm
+from decord import VideoReader, cpu
+from diffusers import AutoencoderKL
+
+from latentsync.data.latent_dataset import latents_cache_key
+from latentsync.utils.feature_store import FeatureStore
+from latentsync.utils.image_processor import ImageProcessor
+
+
+@torch.no_grad()
+def encode_posterior(vae, images, chunk_size):
+    means, stds = [], []
+    for i in range(0, len(images), chunk_size):
+        chunk = images[i : i + chunk_size].to(vae.device, dtype=vae.dtype)
+        latent_dist = vae.encode(chunk).latent_dist
+        means.append(latent_dist.mean)
+        stds.append(latent_dist.std)
+    return torch.cat(means), torch.cat(stds)
+
+
+def build_latent_cache_worker(rank, video_paths, cache_dir, resolution, chunk_size):
+    device = f"cuda:{rank % torch.cuda.device_count()}" if torch.cuda.is_available() else "cpu"
+    dtype = torch.float16 if device != "cpu" else torch.float32
+    vae = AutoencoderKL.from_pretrained("stabilityai/sd-vae-ft-mse", torch_dtype=dtype)
+    vae.requires_grad_(False)
+    vae.to(device)
+
+    image_processor = ImageProcessor(resolution, mask="fix_mask")
+    # Several workers append to the same store, the writes are serialized by its lock
+    store = FeatureStore(cache_dir)
+    for video_path in tqdm.tqdm(video_paths, disable=rank != 0):
+        try:
+            frames = VideoReader(video_path, ctx=cpu(0))[:].asnumpy()
+            pixel_values, masked_pixel_values, _ = image_processor.prepare_masks_and_masked_images(
+                frames, affine_transform=False
+            )
+            mean, std = encode_posterior(vae, pixel_values, chunk_size)
+            masked_mean, masked_std = encode_posterior(vae, masked_pixel_values, chunk_size)
+        except Exception as e:
+            print(f"{type(e).__name__} - {e} - {video_path}")
+            continue
+        # The slots follow LATENT_MEAN, LATENT_STD, MASKED_LATENT_MEAN and MASKED_LATENT_STD
+        latents = torch.stack([mean, std, masked_mean, masked_std], dim=1)
+        store.put(latents_cache_key(video_path), latents.half())
+
+
+def build_latent_cache(fileslist, cache_dir, resolution, num_workers, chunk_size):
+    with open(fileslist) as file:
+        video_paths = [line.rstrip() for line in file]
+
+    # Resumable, the videos already in the cache are skipped
+    store = FeatureStore(cache_dir)
+    video_paths = [path for path in video_paths if latents_cache_key(path) not in store]
+    print(f"Encoding the frames of {len(video_paths)} videos ...")
+
+    jobs = [(rank, video_paths[rank::num_workers], cache_dir, resolution, chunk_size) for rank in range(num_workers)]
+    with multiprocessing.get_context("spawn").Pool(num_workers) as pool:
+        pool.starmap(build_latent_cache_worker, jobs)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Cache the VAE posterior of every frame of the training videos")
+    parser.add_argument("--fileslist", type=str, required=True)
+    parser.add_argument("--cache_dir", type=str, required=True)
+    parser.add_argument("--resolution", type=int, default=256, help="must match data.resolution of the config")
+    parser.add_argument("--num_workers", type=int, default=8, help="the workers are spread over the visible GPUs")
+    parser.add_argument("--chunk_size", type=int, default=64, help="frames per VAE encoder call")
+    args = parser.parse_args()
+
+    build_latent_cache(args.fileslist, args.cache_dir, args.resolution, args.num_workers, args.chunk_size)
@@ -0,0 +1,66 @@
+# Copyright (c) 2024 Bytedance Ltd. and/or its affiliates
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import json
+import multiprocessing
+
+import tqdm
+from decord import AudioReader, VideoReader, cpu
+
+from latentsync.data.validity_index import read_validity_index
+from latentsync.utils.audio import get_hop_size
+
+
+def index_video(video_path, sample_rate=16000):
+    entry = {"video_path": video_path, "num_frames": 0, "mel_length": 0, "error": None}
+    try:
+        vr = VideoReader(video_path, ctx=cpu(0))
+        entry["num_frames"] = len(vr)
+        # Decoding the last frame catches the truncated files, whose index promises frames that can't be decoded
+        vr[len(vr) - 1]
+        vr.seek(0)
+        ar = AudioReader(video_path, ctx=cpu(0), sample_rate=sample_rate)
+        # The number of frames of a centered STFT, like the librosa one of melspectrogram
+        entry["mel_length"] = ar.shape[-1] // get_hop_size() + 1
+    except Exception as e:
+        entry["error"] = f"{type(e).__name__} - {e}"
+    return entry
+
+
+def build_validity_index(fileslist, index_path, num_workers):
+    with open(fileslist) as file:
+        video_paths = [line.rstrip() for line in file]
+
+    # Resumable, the videos already in the index are skipped
+    indexed = read_validity_index(index_path)
+    video_paths = [path for path in video_paths if path not in indexed]
+    print(f"Indexing {len(video_paths)} videos ...")
+
+    num_errors = 0
+    with multiprocessing.Pool(num_workers) as pool, open(index_path, "a") as f:
+        for entry in tqdm.tqdm(pool.imap_unordered(index_video, video_paths), total=len(video_paths)):
+            f.write(json.dumps(entry) + "\n")
+            num_errors += entry["error"] is not None
+    print(f"{num_errors} videos failed to decode")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Record the frame count, mel length and decode errors of the videos")
+    parser.add_argument("--fileslist", type=str, required=True)
+    parser.add_argument("--index_path", type=str, required=True, help="the JSON lines file set as validity_index_path")
+    parser.add_argument("--num_workers", type=int, default=16)
+    args = parser.parse_args()
+
+    build_validity_index(args.fileslist, args.index_path, args.num_workers)
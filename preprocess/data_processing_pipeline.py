@@ -23,46 +23,103 @@ from preprocess.segment_videos import segment_videos_multiprocessing
 from preprocess.sync_av import sync_av_multi_gpus
 from preprocess.filter_visual_quality import filter_visual_quality_multi_gpus
 from preprocess.remove_incorrect_affined import remove_incorrect_affined_multiprocessing
+from preprocess.fused_pipeline import fused_pipeline_multi_gpus
+from preprocess.manifest import print_summary
 
 
 def data_processing_pipeline(
-    total_num_workers, per_gpu_num_workers, resolution, sync_conf_threshold, temp_dir, input_dir
+    total_num_workers,
+    per_gpu_num_workers,
+    resolution,
+    sync_conf_threshold,
+    temp_dir,
+    input_dir,
+    fused=False,
+    manifest_path=None,
+    face_sample_stride=0,
+    sync_in_memory=False,
 ):
+    if fused:
+        fused_data_processing_pipeline(
+            per_gpu_num_workers, resolution, sync_conf_threshold, temp_dir, input_dir, manifest_path, sync_in_memory
+        )
+        return
+
     print("Removing broken videos...")
-    remove_broken_videos_multiprocessing(input_dir, total_num_workers)
+    remove_broken_videos_multiprocessing(input_dir, total_num_workers, manifest_path)
 
     print("Resampling FPS hz...")
     resampled_dir = os.path.join(os.path.dirname(input_dir), "resampled")
-    resample_fps_hz_multiprocessing(input_dir, resampled_dir, total_num_workers)
+    resample_fps_hz_multiprocessing(input_dir, resampled_dir, total_num_workers, manifest_path)
 
     print("Detecting shot...")
     shot_dir = os.path.join(os.path.dirname(input_dir), "shot")
-    detect_shot_multiprocessing(resampled_dir, shot_dir, total_num_workers)
+    detect_shot_multiprocessing(resampled_dir, shot_dir, total_num_workers, manifest_path)
 
     print("Segmenting videos...")
     segmented_dir = os.path.join(os.path.dirname(input_dir), "segmented")
-    segment_videos_multiprocessing(shot_dir, segmented_dir, total_num_workers)
+    segment_videos_multiprocessing(shot_dir, segmented_dir, total_num_workers, manifest_path)
 
     print("Filtering high resolution...")
     high_resolution_dir = os.path.join(os.path.dirname(input_dir), "high_resolution")
-    filter_high_resolution_multiprocessing(segmented_dir, high_resolution_dir, resolution, total_num_workers)
+    filter_high_resolution_multiprocessing(
+        segmented_dir, high_resolution_dir, resolution, total_num_workers, manifest_path, face_sample_stride
+    )
 
     print("Affine transforming videos...")
     affine_transformed_dir = os.path.join(os.path.dirname(input_dir), "affine_transformed")
     affine_transform_multi_gpus(
-        high_resolution_dir, affine_transformed_dir, temp_dir, resolution, per_gpu_num_workers // 2
+        high_resolution_dir, affine_transformed_dir, temp_dir, resolution, per_gpu_num_workers // 2, manifest_path
     )
 
     print("Removing incorrect affined videos...")
-    remove_incorrect_affined_multiprocessing(affine_transformed_dir, total_num_workers)
+    remove_incorrect_affined_multiprocessing(
+        affine_transformed_dir, total_num_workers, manifest_path, face_sample_stride
+    )
 
     print("Syncing audio and video...")
     av_synced_dir = os.path.join(os.path.dirname(input_dir), f"av_synced_{sync_conf_threshold}")
-    sync_av_multi_gpus(affine_transformed_dir, av_synced_dir, temp_dir, per_gpu_num_workers, sync_conf_threshold)
+    sync_av_multi_gpus(
+        affine_transformed_dir,
+        av_synced_dir,
+        temp_dir,
+        per_gpu_num_workers,
+        sync_conf_threshold,
+        manifest_path,
+        sync_in_memory,
+    )
 
     print("Filtering visual quality...")
     high_visual_quality_dir = os.path.join(os.path.dirname(input_dir), "high_visual_quality")
-    filter_visual_quality_multi_gpus(av_synced_dir, high_visual_quality_dir, per_gpu_num_workers)
+    filter_visual_quality_multi_gpus(av_synced_dir, high_visual_quality_dir, per_gpu_num_workers, manifest_path)
+
+    if manifest_path is not None:
+        print_summary(manifest_path)
+
+
+def fused_data_processing_pipeline(
+    per_gpu_num_workers, resolution, sync_conf_threshold, temp_dir, input_dir, manifest_path=None, sync_in_memory=False
+):
+    # Every source is decoded once, the broken ones are skipped instead of removed
+    print("Processing videos in a single pass...")
+    fused_dir = os.path.join(os.path.dirname(input_dir), "fused")
+    fused_pipeline_multi_gpus(input_dir, fused_dir, temp_dir, resolution, per_gpu_num_workers // 2, manifest_path)
+
+    # The quality is already filtered, the synced videos are the final ones
+    print("Syncing audio and video...")
+    high_visual_quality_dir = os.path.join(os.path.dirname(input_dir), "high_visual_quality")
+    sync_av_multi_gpus(
+        fused_dir,
+        high_visual_quality_dir,
+        temp_dir,
+        per_gpu_num_workers,
+        sync_conf_threshold,
+        manifest_path,
+        sync_in_memory,
+    )
+
+    if manifest_path is not None:
+        print_summary(manifest_path)
 
 
 if __name__ == "__main__":
@@ -73,6 +130,20 @@ if __name__ == "__main__":
     parser.add_argument("--sync_conf_threshold", type=int, default=3)
     parser.add_argument("--temp_dir", type=str, default="temp")
     parser.add_argument("--input_dir", type=str, required=True)
+    parser.add_argument("--fused", action="store_true", help="decode every source once and encode only the kept clips")
+    parser.add_argument(
+        "--manifest_path",
+        type=str,
+        default="",
+        help="SQLite manifest of the status of every video at every stage, the stages resume from it when given",
+    )
+    parser.add_argument(
+        "--face_sample_stride",
+        type=int,
+        default=0,
+        help="the face filters check every n-th frame, and every frame around the borderline ones, 0 checks all",
+    )
+    parser.add_argument("--sync_in_memory", action="store_true", help="evaluate SyncNet without temp frames on disk")
     args = parser.parse_args()
 
     data_processing_pipeline(
@@ -82,4 +153,8 @@ if __name__ == "__main__":
         args.sync_conf_threshold,
         args.temp_dir,
         args.input_dir,
+        args.fused,
+        args.manifest_path or None,
+        args.face_sample_stride,
+        args.sync_in_memory,
     )
@@ -13,23 +13,33 @@
 # limitations under the License.
 
 import os
+import glob
 import subprocess
 import tqdm
 from multiprocessing import Pool
 
+from preprocess.manifest import STATUS_DONE, open_manifest, run_task
+
+STAGE = "detect_shot"
+
 paths = []
 
 
-def gather_paths(input_dir, output_dir):
+def shot_paths(video_input, output_dir):
+    video = os.path.basename(video_input)[:-4]
+    return sorted(glob.glob(os.path.join(glob.escape(output_dir), f"{glob.escape(video)}_shot_*.mp4")))
+
+
+def gather_paths(input_dir, output_dir, skip_existing=True):
     for video in sorted(os.listdir(input_dir)):
         if video.endswith(".mp4"):
             video_input = os.path.join(input_dir, video)
-            video_output = os.path.join(output_dir, video)
-            if os.path.isfile(video_output):
+            # The shots are named after the video, the video itself is never in the output directory
+            if skip_existing and len(shot_paths(video_input, output_dir)) > 0:
                 continue
             paths.append([video_input, output_dir])
         elif os.path.isdir(os.path.join(input_dir, video)):
-            gather_paths(os.path.join(input_dir, video), os.path.join(output_dir, video))
+            gather_paths(os.path.join(input_dir, video), os.path.join(output_dir, video), skip_existing)
 
 
 def detect_shot(video_input, output_dir):
@@ -37,21 +47,26 @@ def detect_shot(video_input, output_dir):
     video = os.path.basename(video_input)[:-4]
     command = f"scenedetect --quiet -i {video_input} detect-adaptive --threshold 2 split-video --filename '{video}_shot_$SCENE_NUMBER' --output {output_dir}"
     # command = f"scenedetect --quiet -i {video_input} detect-adaptive --threshold 2 split-video --high-quality --filename '{video}_shot_$SCENE_NUMBER' --output {output_dir}"
-    subprocess.run(command, shell=True)
+    subprocess.run(command, shell=True, check=True)
+    return STATUS_DONE, shot_paths(video_input, output_dir)
 
 
 def multi_run_wrapper(args):
-    return detect_shot(*args)
+    return run_task(detect_shot, *args)
 
 
-def detect_shot_multiprocessing(input_dir, output_dir, num_workers):
+def detect_shot_multiprocessing(input_dir, output_dir, num_workers, manifest_path=None):
     print(f"Recursively gathering video paths of {input_dir} ...")
-    gather_paths(input_dir, output_dir)
+    manifest = open_manifest(manifest_path)
+    # With a manifest, existing outputs may be partial ones, only the recorded videos are finished
+    gather_paths(input_dir, output_dir, skip_existing=manifest is None)
+    tasks = paths if manifest is None else manifest.pending(STAGE, paths)
 
     print(f"Detecting shot of {input_dir} ...")
     with Pool(num_workers) as pool:
-        for _ in tqdm.tqdm(pool.imap_unordered(multi_run_wrapper, paths), total=len(paths)):
-            pass
+        for result in tqdm.tqdm(pool.imap_unordered(multi_run_wrapper, tasks), total=len(tasks)):
+            if manifest is not None:
+                manifest.record(STAGE, result)
 
 
 if __name__ == "__main__":
@@ -13,25 +13,36 @@
 # limitations under the License.
 
 import mediapipe as mp
-from latentsync.utils.util import read_video
+from latentsync.utils.util import read_video, check_video_sampled
 import os
 import tqdm
 import shutil
+from functools import partial
 from multiprocessing import Pool
 
+from preprocess.manifest import STATUS_DONE, STATUS_REJECTED, open_manifest, run_task
+
+STAGE = "filter_high_resolution"
+# With sampled checks, the frames around a sample this close to the thresholds are all checked
+BORDERLINE_SIZE_MARGIN = 0.1
+BORDERLINE_SCORE = 0.7
+
 paths = []
+face_detector = None
 
 
-def gather_video_paths(input_dir, output_dir, resolution):
+def gather_video_paths(input_dir, output_dir, resolution, skip_existing=True):
     for video in sorted(os.listdir(input_dir)):
         if video.endswith(".mp4"):
             video_input = os.path.join(input_dir, video)
             video_output = os.path.join(output_dir, video)
-            if os.path.isfile(video_output):
+            if skip_existing and os.path.isfile(video_output):
                 continue
             paths.append([video_input, video_output, resolution])
         elif os.path.isdir(os.path.join(input_dir, video)):
-            gather_video_paths(os.path.join(input_dir, video), os.path.join(output_dir, video), resolution)
+            gather_video_paths(
+                os.path.join(input_dir, video), os.path.join(output_dir, video), resolution, skip_existing
+            )
 
 
 class FaceDetector:
@@ -41,7 +52,8 @@ class FaceDetector:
         )
         self.resolution = resolution
 
-    def detect_face(self, image):
+    def check_face(self, image):
+        """Returns whether the face passes, and whether it is borderline"""
         height, width = image.shape[:2]
         # Process the image and detect faces.
         results = self.face_detection.process(image)
@@ -50,17 +62,26 @@ class FaceDetector:
             raise Exception("Face not detected")
 
         if len(results.detections) != 1:
-            return False
+            return False, False
         detection = results.detections[0]  # Only use the first face in the image
 
         bounding_box = detection.location_data.relative_bounding_box
         face_width = int(bounding_box.width * width)
         face_height = int(bounding_box.height * height)
         if face_width < self.resolution or face_height < self.resolution:
-            return False
-        return True
+            return False, False
+        borderline = (
+            min(face_width, face_height) < self.resolution * (1 + BORDERLINE_SIZE_MARGIN)
+            or detection.score[0] < BORDERLINE_SCORE
+        )
+        return True, borderline
+
+    def detect_face(self, image):
+        return self.check_face(image)[0]
 
-    def detect_video(self, video_path):
+    def detect_video(self, video_path, sample_stride=0):
+        if sample_stride > 1:
+            return check_video_sampled(video_path, self.check_face, sample_stride)
         video_frames = read_video(video_path, change_fps=False)
         if len(video_frames) == 0:
             return False
@@ -73,34 +94,47 @@ class FaceDetector:
         self.face_detection.close()
 
 
-def filter_video(video_input, video_out, resolution):
-    if os.path.isfile(video_out):
-        return
-    face_detector = FaceDetector(resolution)
+def get_face_detector(resolution):
+    # One detector per worker process, reused for all its videos
+    global face_detector
+    if face_detector is None or face_detector.resolution != resolution:
+        face_detector = FaceDetector(resolution)
+    return face_detector
+
+
+def filter_video(video_input, video_out, resolution, sample_stride=0):
     try:
-        save = face_detector.detect_video(video_input)
+        save = get_face_detector(resolution).detect_video(video_input, sample_stride)
     except Exception as e:
         # print(f"Exception: {e} Input video: {video_input}")
-        face_detector.close()
-        return
-    if save:
-        os.makedirs(os.path.dirname(video_out), exist_ok=True)
-        shutil.copy(video_input, video_out)
-    face_detector.close()
+        return STATUS_REJECTED, []
+    if not save:
+        return STATUS_REJECTED, []
+    os.makedirs(os.path.dirname(video_out), exist_ok=True)
+    shutil.copy(video_input, video_out)
+    return STATUS_DONE, [video_out]
 
 
-def multi_run_wrapper(args):
-    return filter_video(*args)
+def multi_run_wrapper(args, sample_stride=0):
+    return run_task(filter_video, *args, sample_stride)
 
 
-def filter_high_resolution_multiprocessing(input_dir, output_dir, resolution, num_workers):
+def filter_high_resolution_multiprocessing(
+    input_dir, output_dir, resolution, num_workers, manifest_path=None, sample_stride=0
+):
+    """sample_stride > 1 checks every sample_stride-th frame only, and the frames around the borderline ones"""
     print(f"Recursively gathering video paths of {input_dir} ...")
-    gather_video_paths(input_dir, output_dir, resolution)
+    manifest = open_manifest(manifest_path)
+    # With a manifest, an existing output may be a partial copy, only the recorded videos are finished
+    gather_video_paths(input_dir, output_dir, resolution, skip_existing=manifest is None)
+    tasks = paths if manifest is None else manifest.pending(STAGE, paths)
 
     print(f"Filtering high resolution videos in {input_dir} ...")
     with Pool(num_workers) as pool:
-        for _ in tqdm.tqdm(pool.imap_unordered(multi_run_wrapper, paths), total=len(paths)):
-            pass
+        results = pool.imap_unordered(partial(multi_run_wrapper, sample_stride=sample_stride), tasks)
+        for result in tqdm.tqdm(results, total=len(tasks)):
+            if manifest is not None:
+                manifest.record(STAGE, result)
 
 
 if __name__ == "__main__":
@@ -22,23 +22,27 @@ import numpy as np
 from decord import VideoReader
 from einops import rearrange
 from eval.hyper_iqa import HyperNet, TargetNet
+from preprocess.manifest import STATUS_DONE, STATUS_REJECTED, open_manifest, run_task
 
+STAGE = "filter_visual_quality"
+# Quality scores range from 0 to 100, the videos below are dropped
+QUALITY_THRESHOLD = 40
 
 paths = []
 
 
-def gather_paths(input_dir, output_dir):
+def gather_paths(input_dir, output_dir, skip_existing=True):
     # os.makedirs(output_dir, exist_ok=True)
 
     for video in tqdm.tqdm(sorted(os.listdir(input_dir))):
         if video.endswith(".mp4"):
             video_input = os.path.join(input_dir, video)
             video_output = os.path.join(output_dir, video)
-            if os.path.isfile(video_output):
+            if skip_existing and os.path.isfile(video_output):
                 continue
             paths.append((video_input, video_output))
         elif os.path.isdir(os.path.join(input_dir, video)):
-            gather_paths(os.path.join(input_dir, video), os.path.join(output_dir, video))
+            gather_paths(os.path.join(input_dir, video), os.path.join(output_dir, video), skip_existing)
 
 
 def read_video(video_path: str):
@@ -53,46 +57,65 @@ def read_video(video_path: str):
     return video_frames
 
 
-def func(paths, device_id):
-    device = f"cuda:{device_id}"
-
+def load_quality_model(device):
     model_hyper = HyperNet(16, 112, 224, 112, 56, 28, 14, 7).to(device)
     model_hyper.train(False)
 
     # load the pre-trained model on the koniq-10k dataset
     model_hyper.load_state_dict((torch.load("checkpoints/auxiliary/koniq_pretrained.pkl", map_location=device)))
+    return model_hyper
 
-    transforms = torchvision.transforms.Compose(
-        [
-            torchvision.transforms.CenterCrop(size=224),
-            torchvision.transforms.Normalize(mean=(0.485, 0.456, 0.406), std=(0.229, 0.224, 0.225)),
-        ]
-    )
 
-    for video_input, video_output in paths:
-        try:
-            video_frames = read_video(video_input)
-            video_frames = transforms(video_frames)
-            video_frames = video_frames.clone().detach().to(device)
-            paras = model_hyper(video_frames)  # 'paras' contains the network weights conveyed to target network
+quality_transforms = torchvision.transforms.Compose(
+    [
+        torchvision.transforms.CenterCrop(size=224),
+        torchvision.transforms.Normalize(mean=(0.485, 0.456, 0.406), std=(0.229, 0.224, 0.225)),
+    ]
+)
+
+
+def quality_score(model_hyper, video_frames, device):
+    """video_frames: (b, c, h, w) in [0, 1], the first, middle and last frames of a video"""
+    video_frames = quality_transforms(video_frames)
+    video_frames = video_frames.clone().detach().to(device)
+    paras = model_hyper(video_frames)  # 'paras' contains the network weights conveyed to target network
+
+    # Building target network
+    model_target = TargetNet(paras).to(device)
+    for param in model_target.parameters():
+        param.requires_grad = False
 
-            # Building target network
-            model_target = TargetNet(paras).to(device)
-            for param in model_target.parameters():
-                param.requires_grad = False
+    # Quality prediction
+    pred = model_target(paras["target_in_vec"])  # 'paras['target_in_vec']' is the input to target net
 
-            # Quality prediction
-            pred = model_target(paras["target_in_vec"])  # 'paras['target_in_vec']' is the input to target net
+    # quality score ranges from 0-100, a higher score indicates a better quality
+    return pred.mean().item()
 
-            # quality score ranges from 0-100, a higher score indicates a better quality
-            quality_score = pred.mean().item()
-            print(f"Input video: {video_input}\nVisual quality score: {quality_score:.2f}")
 
-            if quality_score >= 40:
-                os.makedirs(os.path.dirname(video_output), exist_ok=True)
-                shutil.copy(video_input, video_output)
-        except Exception as e:
-            print(e)
+def filter_video(video_input, video_output, model_hyper, device):
+    video_frames = read_video(video_input)
+    score = quality_score(model_hyper, video_frames, device)
+    print(f"Input video: {video_input}\nVisual quality score: {score:.2f}")
+
+    if score < QUALITY_THRESHOLD:
+        return STATUS_REJECTED, [], score
+    os.makedirs(os.path.dirname(video_output), exist_ok=True)
+    shutil.copy(video_input, video_output)
+    return STATUS_DONE, [video_output], score
+
+
+def func(paths, device_id, manifest_path=None):
+    device = f"cuda:{device_id}"
+    model_hyper = load_quality_model(device)
+    # Every process records its videos through its own connection
+    manifest = open_manifest(manifest_path)
+
+    for video_input, video_output in paths:
+        result = run_task(filter_video, video_input, video_output, model_hyper, device)
+        if result.error is not None:
+            print(result.error)
+        if manifest is not None:
+            manifest.record(STAGE, result)
 
 
 def split(a, n):
@@ -100,18 +123,21 @@ def split(a, n):
     return (a[i * k + min(i, m) : (i + 1) * k + min(i + 1, m)] for i in range(n))
 
 
-def filter_visual_quality_multi_gpus(input_dir, output_dir, num_workers):
-    gather_paths(input_dir, output_dir)
+def filter_visual_quality_multi_gpus(input_dir, output_dir, num_workers, manifest_path=None):
+    manifest = open_manifest(manifest_path)
+    # With a manifest, an existing output may be a partial copy, only the recorded videos are finished
+    gather_paths(input_dir, output_dir, skip_existing=manifest is None)
+    tasks = paths if manifest is None else manifest.pending(STAGE, paths)
     num_devices = torch.cuda.device_count()
     if num_devices == 0:
         raise RuntimeError("No GPUs found")
-    split_paths = list(split(paths, num_workers * num_devices))
+    split_paths = list(split(tasks, num_workers * num_devices))
     processes = []
 
     for i in range(num_devices):
         for j in range(num_workers):
             process_index = i * num_workers + j
-            process = Process(target=func, args=(split_paths[process_index], i))
+            process = Process(target=func, args=(split_paths[process_index], i, manifest_path))
             process.start()
             processes.append(process)
 
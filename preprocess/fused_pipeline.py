@@ -0,0 +1,287 @@
+# Copyright (c) 2024 Bytedance Ltd. and/or its affiliates
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Single-pass version of the stages of data_processing_pipeline.py up to the visual quality filter, sync excepted. Every
+source video is decoded once, its frames are resampled to 25 fps and streamed through the shot detection and the
+segmentation, and every segment goes through the resolution filter, the affine transform, the affined face check and
+the quality scoring in memory. Only the accepted segments are encoded, nothing is written for the intermediate stages.
+"""
+
+import os
+import shutil
+import subprocess
+from multiprocessing import Process
+
+import cv2
+import numpy as np
+import torch
+from einops import rearrange
+from scipy.io import wavfile
+from decord import AudioReader, VideoReader, cpu
+
+from latentsync.utils.affine_transform import laplacianSmooth
+from latentsync.utils.image_processor import ImageProcessor
+from latentsync.utils.util import gather_video_paths_recursively
+from preprocess.filter_high_resolution import FaceDetector as HighResolutionFaceDetector
+from preprocess.remove_incorrect_affined import FaceDetector as AffinedFaceDetector
+from preprocess.filter_visual_quality import QUALITY_THRESHOLD, load_quality_model, quality_score
+from preprocess.manifest import STATUS_DONE, STATUS_REJECTED, open_manifest, run_task
+
+STAGE = "fused_pipeline"
+
+VIDEO_FPS = 25
+AUDIO_SAMPLE_RATE = 16000
+# 5 s segments, like segment_videos.py
+SEGMENT_FRAMES = 5 * VIDEO_FPS
+# The adaptive shot detector reports a cut a few frames after it, a segment is only closed this far behind
+SHOT_DETECTION_LAG = 10
+
+
+def resampled_frames(video_reader: VideoReader, fps: int = VIDEO_FPS, chunk_size: int = 100):
+    """Yields the frames at fps, dropping or repeating source frames like ffmpeg -r"""
+    source_fps = video_reader.get_avg_fps()
+    num_frames = int(len(video_reader) * fps / source_fps)
+    indices = np.minimum(np.round(np.arange(num_frames) * source_fps / fps).astype(int), len(video_reader) - 1)
+    for i in range(0, num_frames, chunk_size):
+        yield from video_reader.get_batch(indices[i : i + chunk_size]).asnumpy()
+
+
+class ShotDetector:
+    """The detect-adaptive --threshold 2 of detect_shot.py, fed one frame at a time"""
+
+    def __init__(self, frame_width: int, threshold: float = 2):
+        from scenedetect.detectors import AdaptiveDetector
+        from scenedetect.scene_manager import compute_downscale_factor
+
+        self.detector = AdaptiveDetector(adaptive_threshold=threshold)
+        # The frames are downscaled to about 256 pixels wide, like the CLI does by default
+        self.downscale = compute_downscale_factor(frame_width)
+
+    def process(self, frame_num: int, frame: np.ndarray):
+        frame = cv2.cvtColor(frame, cv2.COLOR_RGB2BGR)
+        if self.downscale > 1:
+            height, width = frame.shape[:2]
+            size = (round(width / self.downscale), round(height / self.downscale))
+            frame = cv2.resize(frame, size, interpolation=cv2.INTER_LINEAR)
+        return self.detector.process_frame(frame_num, frame)
+
+    def flush(self, frame_num: int):
+        return self.detector.post_process(frame_num)
+
+
+def stream_segments(frames, shot_detector: ShotDetector):
+    """Yields (shot number, segment number, start frame, frames) of the segments of every shot, as soon as known"""
+    buffer, buffer_start = [], 0
+    shot, segment = 1, 0
+    frame_num = -1
+
+    def close_segments(end, end_of_shot):
+        """Yields the segments before frame end, the last one shorter at the end of a shot"""
+        nonlocal buffer, buffer_start, segment
+        while end - buffer_start >= SEGMENT_FRAMES or (end_of_shot and end > buffer_start):
+            length = min(SEGMENT_FRAMES, end - buffer_start)
+            yield shot, segment, buffer_start, buffer[:length]
+            buffer, buffer_start = buffer[length:], buffer_start + length
+            segment += 1
+
+    for frame_num, frame in enumerate(frames):
+        buffer.append(frame)
+        for cut in shot_detector.process(frame_num, frame):
+            yield from close_segments(cut, end_of_shot=True)
+            shot, segment = shot + 1, 0
+        # A cut can't split the segments that are far enough behind the newest frame anymore
+        yield from close_segments(frame_num - SHOT_DETECTION_LAG + 1, end_of_shot=False)
+
+    for cut in shot_detector.flush(frame_num + 1):
+        yield from close_segments(cut, end_of_shot=True)
+        shot, segment = shot + 1, 0
+    yield from close_segments(frame_num + 1, end_of_shot=True)
+
+
+class SegmentFilter:
+    """The filters of the pipeline, one instance per worker, returns the affined frames of the accepted segments"""
+
+    def __init__(self, resolution: int, device: str):
+        self.device = device
+        self.high_resolution_detector = HighResolutionFaceDetector(resolution)
+        self.affined_face_detector = AffinedFaceDetector()
+        self.image_processor = ImageProcessor(resolution, "fix_mask", device)
+        self.quality_model = load_quality_model(device)
+
+    def is_high_resolution(self, frames):
+        for frame in frames:
+            try:
+                if not self.high_resolution_detector.detect_face(frame):
+                    return False
+            except Exception:  # Face not detected
+                return False
+        return True
+
+    def affine_transform(self, frames):
+        # Every segment starts with fresh landmark smoothing, it isn't carried over from the previous clip
+        self.image_processor.smoother = laplacianSmooth()
+        self.image_processor.restorer.p_bias = None
+        faces = [self.image_processor.affine_transform(frame)[0] for frame in frames]
+        return rearrange(torch.stack(faces), "f c h w -> f h w c").numpy()
+
+    def __call__(self, frames):
+        if len(frames) == 0 or not self.is_high_resolution(frames):
+            return None
+        try:
+            faces = self.affine_transform(frames)
+        except Exception:  # Face not detected
+            return None
+        if not all(self.affined_face_detector.detect_face(face) for face in faces):
+            return None
+
+        # Scored on the first, middle and last frames, like filter_visual_quality.py
+        quality_frames = faces[[0, len(faces) // 2, -1]]
+        quality_frames = torch.from_numpy(rearrange(quality_frames, "b h w c -> b c h w")) / 255.0
+        if quality_score(self.quality_model, quality_frames, self.device) < QUALITY_THRESHOLD:
+            return None
+        return faces
+
+    def close(self):
+        self.high_resolution_detector.close()
+        self.affined_face_detector.close()
+        self.image_processor.close()
+
+
+def write_segment(frames, audio, video_output, process_temp_dir):
+    """The only encode of the pipeline, the frames are piped to ffmpeg"""
+    audio_temp = os.path.join(process_temp_dir, "segment.wav")
+    wavfile.write(audio_temp, AUDIO_SAMPLE_RATE, audio)
+
+    # Written under a temporary name, so that an interrupted encode doesn't look like a finished segment
+    video_temp = video_output + ".part"
+    height, width = frames.shape[1:3]
+    command = (
+        f"ffmpeg -y -loglevel error -f rawvideo -pix_fmt rgb24 -s {width}x{height} -r {VIDEO_FPS} -i - "
+        f"-i {audio_temp} -c:v libx264 -pix_fmt yuv420p -c:a aac -map 0:v -map 1:a -q:v 0 -q:a 0 -f mp4 {video_temp}"
+    )
+    subprocess.run(command, shell=True, input=np.ascontiguousarray(frames).tobytes(), check=True)
+    os.replace(video_temp, video_output)
+    os.remove(audio_temp)
+
+
+def process_video(video_input, output_dir, segment_filter, process_temp_dir):
+    video_name = os.path.basename(video_input)[:-4]
+    vr = VideoReader(video_input, ctx=cpu(0))
+    audio = AudioReader(video_input, ctx=cpu(0), sample_rate=AUDIO_SAMPLE_RATE)[:].asnumpy().squeeze(0)
+    samples_per_frame = AUDIO_SAMPLE_RATE // VIDEO_FPS
+
+    video_outputs = []
+    shot_detector = ShotDetector(vr[0].shape[1])
+    for shot, segment, start, frames in stream_segments(resampled_frames(vr), shot_detector):
+        faces = segment_filter(np.stack(frames))
+        if faces is None:
+            continue
+        # The names of the segments written by detect_shot.py and segment_videos.py
+        video_output = os.path.join(output_dir, f"{video_name}_shot_{shot:03d}_{segment:03d}.mp4")
+        os.makedirs(output_dir, exist_ok=True)
+        segment_audio = audio[start * samples_per_frame : (start + len(frames)) * samples_per_frame]
+        write_segment(faces, segment_audio, video_output, process_temp_dir)
+        video_outputs.append(video_output)
+    vr.seek(0)
+    return STATUS_DONE if len(video_outputs) > 0 else STATUS_REJECTED, video_outputs
+
+
+def read_done(done_path):
+    if not os.path.isfile(done_path):
+        return set()
+    with open(done_path) as f:
+        return {line.rstrip() for line in f}
+
+
+def func(paths, process_temp_dir, device_id, resolution, done_path, manifest_path=None):
+    os.makedirs(process_temp_dir, exist_ok=True)
+    segment_filter = SegmentFilter(resolution, f"cuda:{device_id}")
+    manifest = open_manifest(manifest_path)
+
+    for video_input, output_dir in paths:
+        result = run_task(process_video, video_input, output_dir, segment_filter, process_temp_dir)
+        if result.error is not None:  # Broken video or missing audio
+            print(f"Exception: {result.error} - {video_input}")
+        else:
+            print(f"Processed: {video_input}, {len(result.outputs)} segments accepted")
+        if manifest is not None:
+            manifest.record(STAGE, result)
+            continue
+        # Short lines appended with O_APPEND don't interleave between the processes
+        with open(done_path, "a") as f:
+            f.write(video_input + "\n")
+
+    segment_filter.close()
+
+
+def split(a, n):
+    k, m = divmod(len(a), n)
+    return (a[i * k + min(i, m) : (i + 1) * k + min(i + 1, m)] for i in range(n))
+
+
+def fused_pipeline_multi_gpus(input_dir, output_dir, temp_dir, resolution, num_workers, manifest_path=None):
+    print(f"Recursively gathering video paths of {input_dir} ...")
+    os.makedirs(output_dir, exist_ok=True)
+    # Resumable, the source videos already processed are skipped
+    done_path = os.path.join(output_dir, "fused_done.txt")
+    manifest = open_manifest(manifest_path)
+    done = read_done(done_path) if manifest is None else manifest.finished(STAGE)
+    paths = [
+        (video_input, os.path.join(output_dir, os.path.relpath(os.path.dirname(video_input), input_dir)))
+        for video_input in gather_video_paths_recursively(input_dir)
+        if video_input not in done
+    ]
+    print(f"Processing {len(paths)} videos in a single pass ...")
+
+    num_devices = torch.cuda.device_count()
+    if num_devices == 0:
+        raise RuntimeError("No GPUs found")
+
+    if os.path.exists(temp_dir):
+        shutil.rmtree(temp_dir)
+    os.makedirs(temp_dir, exist_ok=True)
+
+    split_paths = list(split(paths, num_workers * num_devices))
+    processes = []
+
+    for i in range(num_devices):
+        for j in range(num_workers):
+            process_index = i * num_workers + j
+            process = Process(
+                target=func,
+                args=(
+                    split_paths[process_index],
+                    os.path.join(temp_dir, f"process_{process_index}"),
+                    i,
+                    resolution,
+                    done_path,
+                    manifest_path,
+                ),
+            )
+            process.start()
+            processes.append(process)
+
+    for process in processes:
+        process.join()
+
+
+if __name__ == "__main__":
+    input_dir = "/mnt/bn/maliva-gen-ai-v2/chunyu.li/HDTF/original/train"
+    output_dir = "/mnt/bn/maliva-gen-ai-v2/chunyu.li/HDTF/fused/train"
+    temp_dir = "temp"
+    resolution = 256
+    num_workers = 10  # How many processes per device
+
+    fused_pipeline_multi_gpus(input_dir, output_dir, temp_dir, resolution, num_workers)
@@ -0,0 +1,140 @@
+# Copyright (c) 2024 Bytedance Ltd. and/or its affiliates
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+SQLite manifest of the preprocessing stages. Every stage records, for each of its input videos, whether it was kept
+(done), filtered out (rejected) or failed, with its outputs, the processing time, the score of the filter and the
+error. A video is only recorded once its outputs are complete, so a stage that crashed redoes the videos it didn't
+record, and a stage run again on a grown input directory only processes the new videos.
+"""
+
+import os
+import json
+import time
+import sqlite3
+import argparse
+from typing import NamedTuple, Optional
+
+STATUS_DONE = "done"
+STATUS_REJECTED = "rejected"
+STATUS_FAILED = "failed"
+
+
+class TaskResult(NamedTuple):
+    video_path: str
+    status: str
+    outputs: list = []
+    score: Optional[float] = None
+    error: Optional[str] = None
+    duration: float = 0.0
+
+
+def run_task(func, video_path, *args):
+    """
+    Runs the task of a stage on one video, func returns (status, outputs) or (status, outputs, score). Runs in the
+    workers, the result is recorded by the process that owns the manifest connection
+    """
+    start_time = time.time()
+    try:
+        status, outputs, *score = func(video_path, *args)
+        error = None
+    except Exception as e:
+        status, outputs, score, error = STATUS_FAILED, [], [], f"{type(e).__name__} - {e}"
+    score = score[0] if len(score) > 0 else None
+    return TaskResult(video_path, status, list(outputs), score, error, time.time() - start_time)
+
+
+class Manifest:
+    def __init__(self, manifest_path: str):
+        if os.path.dirname(manifest_path) != "":
+            os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
+        # The GPU stages write from several processes, each with its own connection
+        self.connection = sqlite3.connect(manifest_path, timeout=600)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS tasks (
+                stage TEXT NOT NULL,
+                video_path TEXT NOT NULL,
+                status TEXT NOT NULL,
+                outputs TEXT NOT NULL,
+                score REAL,
+                error TEXT,
+                duration REAL,
+                updated_at REAL,
+                PRIMARY KEY (stage, video_path)
+            )
+            """
+        )
+        self.connection.commit()
+
+    def finished(self, stage: str) -> set:
+        """The videos the stage doesn't have to process again, the failed ones are retried"""
+        rows = self.connection.execute(
+            "SELECT video_path FROM tasks WHERE stage = ? AND status IN (?, ?)", (stage, STATUS_DONE, STATUS_REJECTED)
+        )
+        return {row[0] for row in rows}
+
+    def pending(self, stage: str, tasks: list) -> list:
+        """Filters a work list whose items are the input video paths, or sequences starting with them"""
+        finished = self.finished(stage)
+        return [task for task in tasks if (task if isinstance(task, str) else task[0]) not in finished]
+
+    def record(self, stage: str, result: TaskResult):
+        self.connection.execute(
+            "INSERT OR REPLACE INTO tasks VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                stage,
+                result.video_path,
+                result.status,
+                json.dumps(result.outputs),
+                result.score,
+                result.error,
+                result.duration,
+                time.time(),
+            ),
+        )
+        self.connection.commit()
+
+    def summary(self) -> list:
+        return self.connection.execute(
+            """
+            SELECT stage, status, COUNT(*), SUM(duration), AVG(score) FROM tasks
+            GROUP BY stage, status ORDER BY MIN(updated_at), status
+            """
+        ).fetchall()
+
+    def close(self):
+        self.connection.close()
+
+
+def open_manifest(manifest_path: Optional[str]):
+    return Manifest(manifest_path) if manifest_path else None
+
+
+def print_summary(manifest_path: str):
+    manifest = Manifest(manifest_path)
+    print(f"{'stage':<28}{'status':<10}{'videos':>8}{'task hours':>12}{'mean score':>12}")
+    for stage, status, count, duration, score in manifest.summary():
+        score = f"{score:.2f}" if score is not None else "-"
+        print(f"{stage:<28}{status:<10}{count:>8}{(duration or 0) / 3600:>12.2f}{score:>12}")
+    manifest.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Summarize a preprocessing manifest")
+    parser.add_argument("--manifest_path", type=str, required=True)
+    args = parser.parse_args()
+
+    print_summary(args.manifest_path)
@@ -0,0 +1,98 @@
+# Copyright (c) 2024 Bytedance Ltd. and/or its affiliates
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import multiprocessing
+
+import cv2
+import numpy as np
+import torch
+import tqdm
+from decord import AudioReader, VideoReader, cpu
+
+from latentsync.data.shards import ShardWriter, write_index
+from latentsync.utils.audio import melspectrogram
+
+
+def read_frames(video_path, resolution):
+    vr = VideoReader(video_path, ctx=cpu(0))
+    frames = vr[:].asnumpy()
+    if frames.shape[1:3] != (resolution, resolution):
+        frames = np.stack(
+            [cv2.resize(frame, (resolution, resolution), interpolation=cv2.INTER_AREA) for frame in frames]
+        )
+    return frames
+
+
+def pack_shards_worker(rank, video_paths, shards_dir, resolution, max_shard_frames, whisper_model_path):
+    audio_encoder = None
+    if whisper_model_path is not None:
+        from latentsync.whisper.audio2feature import Audio2Feature
+
+        device = f"cuda:{rank % torch.cuda.device_count()}" if torch.cuda.is_available() else "cpu"
+        audio_encoder = Audio2Feature(model_path=whisper_model_path, device=device)
+
+    writer = ShardWriter(shards_dir, f"worker{rank:03d}", resolution, max_shard_frames)
+    for video_path in tqdm.tqdm(video_paths, disable=rank != 0):
+        try:
+            frames = read_frames(video_path, resolution)
+            ar = AudioReader(video_path, ctx=cpu(0), sample_rate=16000)
+            mel = melspectrogram(ar[:].asnumpy().squeeze(0))
+            whisper_feature = None
+            if audio_encoder is not None:
+                whisper_feature = audio_encoder.extract_features([video_path])[0].cpu().numpy()
+            writer.add(video_path, frames, mel, whisper_feature)
+        except Exception as e:
+            print(f"{type(e).__name__} - {e} - {video_path}")
+    writer.close()
+    return writer.entries, writer.whisper_shape
+
+
+def pack_shards(fileslist, shards_dir, resolution, num_workers, max_shard_frames, whisper_model_path=None):
+    with open(fileslist) as file:
+        video_paths = [line.rstrip() for line in file]
+
+    print(f"Packing {len(video_paths)} videos into {shards_dir} ...")
+    jobs = [
+        (rank, video_paths[rank::num_workers], shards_dir, resolution, max_shard_frames, whisper_model_path)
+        for rank in range(num_workers)
+    ]
+    # Spawned, so that every worker can initialize CUDA for the whisper encoder
+    with multiprocessing.get_context("spawn").Pool(num_workers) as pool:
+        results = pool.starmap(pack_shards_worker, jobs)
+
+    entries = [entry for worker_entries, _ in results for entry in worker_entries]
+    whisper_shapes = [whisper_shape for _, whisper_shape in results if whisper_shape is not None]
+    write_index(shards_dir, entries, resolution, whisper_shapes[0] if len(whisper_shapes) > 0 else None)
+    print(f"Packed {len(entries)} videos")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pack the videos of a fileslist into memory-mappable shards")
+    parser.add_argument("--fileslist", type=str, required=True)
+    parser.add_argument("--shards_dir", type=str, required=True)
+    parser.add_argument("--resolution", type=int, default=256)
+    parser.add_argument("--num_workers", type=int, default=16)
+    parser.add_argument("--max_shard_frames", type=int, default=50000)
+    parser.add_argument("--whisper_model_path", type=str, default=None, help="also store the whisper features")
+    args = parser.parse_args()
+
+    pack_shards(
+        args.fileslist,
+        args.shards_dir,
+        args.resolution,
+        args.num_workers,
+        args.max_shard_frames,
+        args.whisper_model_path,
+    )
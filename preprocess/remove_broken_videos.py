@@ -18,6 +18,9 @@ import tqdm
 
 from latentsync.utils.av_reader import AVReader
 from latentsync.utils.util import gather_video_paths_recursively
+from preprocess.manifest import STATUS_DONE, STATUS_REJECTED, open_manifest, run_task
+
+STAGE = "remove_broken_videos"
 
 
 def remove_broken_video(video_path):
@@ -25,15 +28,25 @@ def remove_broken_video(video_path):
         AVReader(video_path)
     except Exception:
         os.remove(video_path)
+        return STATUS_REJECTED, []
+    return STATUS_DONE, [video_path]
+
+
+def remove_broken_video_task(video_path):
+    return run_task(remove_broken_video, video_path)
 
 
-def remove_broken_videos_multiprocessing(input_dir, num_workers):
+def remove_broken_videos_multiprocessing(input_dir, num_workers, manifest_path=None):
     video_paths = gather_video_paths_recursively(input_dir)
+    manifest = open_manifest(manifest_path)
+    if manifest is not None:
+        video_paths = manifest.pending(STAGE, video_paths)
 
     print("Removing broken videos...")
     with Pool(num_workers) as pool:
-        for _ in tqdm.tqdm(pool.imap_unordered(remove_broken_video, video_paths), total=len(video_paths)):
-            pass
+        for result in tqdm.tqdm(pool.imap_unordered(remove_broken_video_task, video_paths), total=len(video_paths)):
+            if manifest is not None:
+                manifest.record(STAGE, result)
 
 
 if __name__ == "__main__":
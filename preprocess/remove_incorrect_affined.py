@@ -13,11 +13,20 @@
 # limitations under the License.
 
 import mediapipe as mp
-from latentsync.utils.util import read_video, gather_video_paths_recursively
+from latentsync.utils.util import read_video, gather_video_paths_recursively, check_video_sampled
 import os
 import tqdm
+from functools import partial
 from multiprocessing import Pool
 
+from preprocess.manifest import STATUS_DONE, STATUS_REJECTED, open_manifest, run_task
+
+STAGE = "remove_incorrect_affined"
+# With sampled checks, the frames around a sample detected with a lower confidence are all checked
+BORDERLINE_SCORE = 0.7
+
+face_detector = None
+
 
 class FaceDetector:
     def __init__(self):
@@ -25,19 +34,25 @@ class FaceDetector:
             model_selection=0, min_detection_confidence=0.5
         )
 
-    def detect_face(self, image):
+    def check_face(self, image):
+        """Returns whether the face passes, and whether it is borderline"""
         # Process the image and detect faces.
         results = self.face_detection.process(image)
 
         if not results.detections:  # Face not detected
-            return False
+            return False, False
 
         if len(results.detections) != 1:
-            return False
-        return True
+            return False, False
+        return True, results.detections[0].score[0] < BORDERLINE_SCORE
 
-    def detect_video(self, video_path):
+    def detect_face(self, image):
+        return self.check_face(image)[0]
+
+    def detect_video(self, video_path, sample_stride=0):
         try:
+            if sample_stride > 1:
+                return check_video_sampled(video_path, self.check_face, sample_stride)
             video_frames = read_video(video_path, change_fps=False)
         except Exception as e:
             print(f"Exception: {e} - {video_path}")
@@ -53,25 +68,44 @@ class FaceDetector:
         self.face_detection.close()
 
 
-def remove_incorrect_affined(video_path):
+def get_face_detector():
+    # One detector per worker process, reused for all its videos
+    global face_detector
+    if face_detector is None:
+        face_detector = FaceDetector()
+    return face_detector
+
+
+def remove_incorrect_affined(video_path, sample_stride=0):
     if not os.path.isfile(video_path):
-        return
-    face_detector = FaceDetector()
-    has_face = face_detector.detect_video(video_path)
+        return STATUS_REJECTED, []
+    has_face = get_face_detector().detect_video(video_path, sample_stride)
     if not has_face:
         os.remove(video_path)
         print(f"Removed: {video_path}")
-    face_detector.close()
+        return STATUS_REJECTED, []
+    return STATUS_DONE, [video_path]
+
+
+def remove_incorrect_affined_task(video_path, sample_stride=0):
+    return run_task(remove_incorrect_affined, video_path, sample_stride)
 
 
-def remove_incorrect_affined_multiprocessing(input_dir, num_workers):
+def remove_incorrect_affined_multiprocessing(input_dir, num_workers, manifest_path=None, sample_stride=0):
+    """sample_stride > 1 checks every sample_stride-th frame only, and the frames around the borderline ones"""
     video_paths = gather_video_paths_recursively(input_dir)
     print(f"Total videos: {len(video_paths)}")
+    manifest = open_manifest(manifest_path)
+    if manifest is not None:
+        # The videos are checked in place, the ones already checked are kept as they are
+        video_paths = manifest.pending(STAGE, video_paths)
 
     print(f"Removing incorrect affined videos in {input_dir} ...")
     with Pool(num_workers) as pool:
-        for _ in tqdm.tqdm(pool.imap_unordered(remove_incorrect_affined, video_paths), total=len(video_paths)):
-            pass
+        tasks = pool.imap_unordered(partial(remove_incorrect_affined_task, sample_stride=sample_stride), video_paths)
+        for result in tqdm.tqdm(tasks, total=len(video_paths)):
+            if manifest is not None:
+                manifest.record(STAGE, result)
 
 
 if __name__ == "__main__":
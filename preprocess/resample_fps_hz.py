@@ -18,19 +18,23 @@ import tqdm
 from multiprocessing import Pool
 import cv2
 
+from preprocess.manifest import STATUS_DONE, open_manifest, run_task
+
+STAGE = "resample_fps_hz"
+
 paths = []
 
 
-def gather_paths(input_dir, output_dir):
+def gather_paths(input_dir, output_dir, skip_existing=True):
     for video in sorted(os.listdir(input_dir)):
         if video.endswith(".mp4"):
             video_input = os.path.join(input_dir, video)
             video_output = os.path.join(output_dir, video)
-            if os.path.isfile(video_output):
+            if skip_existing and os.path.isfile(video_output):
                 continue
             paths.append([video_input, video_output])
         elif os.path.isdir(os.path.join(input_dir, video)):
-            gather_paths(os.path.join(input_dir, video), os.path.join(output_dir, video))
+            gather_paths(os.path.join(input_dir, video), os.path.join(output_dir, video), skip_existing)
 
 
 def get_video_fps(video_path: str):
@@ -45,21 +49,26 @@ def resample_fps_hz(video_input, video_output):
         command = f"ffmpeg -loglevel error -y -i {video_input} -c:v copy -ar 16000 -q:a 0 {video_output}"
     else:
         command = f"ffmpeg -loglevel error -y -i {video_input} -r 25 -ar 16000 -q:a 0 {video_output}"
-    subprocess.run(command, shell=True)
+    subprocess.run(command, shell=True, check=True)
+    return STATUS_DONE, [video_output]
 
 
 def multi_run_wrapper(args):
-    return resample_fps_hz(*args)
+    return run_task(resample_fps_hz, *args)
 
 
-def resample_fps_hz_multiprocessing(input_dir, output_dir, num_workers):
+def resample_fps_hz_multiprocessing(input_dir, output_dir, num_workers, manifest_path=None):
     print(f"Recursively gathering video paths of {input_dir} ...")
-    gather_paths(input_dir, output_dir)
+    manifest = open_manifest(manifest_path)
+    # With a manifest, an existing output may be a partial one, only the recorded videos are finished
+    gather_paths(input_dir, output_dir, skip_existing=manifest is None)
+    tasks = paths if manifest is None else manifest.pending(STAGE, paths)
 
     print(f"Resampling FPS and Hz of {input_dir} ...")
     with Pool(num_workers) as pool:
-        for _ in tqdm.tqdm(pool.imap_unordered(multi_run_wrapper, paths), total=len(paths)):
-            pass
+        for result in tqdm.tqdm(pool.imap_unordered(multi_run_wrapper, tasks), total=len(tasks)):
+            if manifest is not None:
+                manifest.record(STAGE, result)
 
 
 if __name__ == "__main__":
@@ -13,45 +13,57 @@
 # limitations under the License.
 
 import os
+import glob
 import subprocess
 import tqdm
 from multiprocessing import Pool
 
+from preprocess.manifest import STATUS_DONE, open_manifest, run_task
+
+STAGE = "segment_videos"
+
 paths = []
 
 
-def gather_paths(input_dir, output_dir):
+def gather_paths(input_dir, output_dir, skip_existing=True):
     for video in sorted(os.listdir(input_dir)):
         if video.endswith(".mp4"):
             video_basename = video[:-4]
             video_input = os.path.join(input_dir, video)
             video_output = os.path.join(output_dir, f"{video_basename}_%03d.mp4")
-            if os.path.isfile(video_output):
+            # video_output is the pattern given to ffmpeg, the first segment is what exists once segmented
+            if skip_existing and os.path.isfile(video_output % 0):
                 continue
             paths.append([video_input, video_output])
         elif os.path.isdir(os.path.join(input_dir, video)):
-            gather_paths(os.path.join(input_dir, video), os.path.join(output_dir, video))
+            gather_paths(os.path.join(input_dir, video), os.path.join(output_dir, video), skip_existing)
 
 
 def segment_video(video_input, video_output):
     os.makedirs(os.path.dirname(video_output), exist_ok=True)
     command = f"ffmpeg -loglevel error -y -i {video_input} -map 0 -c:v copy -segment_time 5 -f segment -reset_timestamps 1 -q:a 0 {video_output}"
     # command = f'ffmpeg -loglevel error -y -i {video_input} -map 0 -segment_time 5 -f segment -reset_timestamps 1 -force_key_frames "expr:gte(t,n_forced*5)" -crf 18 -q:a 0 {video_output}'
-    subprocess.run(command, shell=True)
+    subprocess.run(command, shell=True, check=True)
+    segments = glob.glob(glob.escape(video_output).replace("%03d", "[0-9][0-9][0-9]"))
+    return STATUS_DONE, sorted(segments)
 
 
 def multi_run_wrapper(args):
-    return segment_video(*args)
+    return run_task(segment_video, *args)
 
 
-def segment_videos_multiprocessing(input_dir, output_dir, num_workers):
+def segment_videos_multiprocessing(input_dir, output_dir, num_workers, manifest_path=None):
     print(f"Recursively gathering video paths of {input_dir} ...")
-    gather_paths(input_dir, output_dir)
+    manifest = open_manifest(manifest_path)
+    # With a manifest, existing outputs may be partial ones, only the recorded videos are finished
+    gather_paths(input_dir, output_dir, skip_existing=manifest is None)
+    tasks = paths if manifest is None else manifest.pending(STAGE, paths)
 
     print(f"Segmenting videos of {input_dir} ...")
     with Pool(num_workers) as pool:
-        for _ in tqdm.tqdm(pool.imap_unordered(multi_run_wrapper, paths), total=len(paths)):
-            pass
+        for result in tqdm.tqdm(pool.imap_unordered(multi_run_wrapper, tasks), total=len(tasks)):
+            if manifest is not None:
+                manifest.record(STAGE, result)
 
 
 if __name__ == "__main__":
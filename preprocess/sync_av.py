@@ -22,29 +22,58 @@ import subprocess
 import shutil
 from multiprocessing import Process
 
+from preprocess.manifest import STATUS_DONE, STATUS_REJECTED, open_manifest, run_task
+
+STAGE = "sync_av"
+
 paths = []
 
 
-def gather_paths(input_dir, output_dir):
+def gather_paths(input_dir, output_dir, skip_existing=True):
     # os.makedirs(output_dir, exist_ok=True)
 
     for video in tqdm.tqdm(sorted(os.listdir(input_dir))):
         if video.endswith(".mp4"):
             video_input = os.path.join(input_dir, video)
             video_output = os.path.join(output_dir, video)
-            if os.path.isfile(video_output):
+            if skip_existing and os.path.isfile(video_output):
                 continue
             paths.append((video_input, video_output))
         elif os.path.isdir(os.path.join(input_dir, video)):
-            gather_paths(os.path.join(input_dir, video), os.path.join(output_dir, video))
+            gather_paths(os.path.join(input_dir, video), os.path.join(output_dir, video), skip_existing)
 
 
 def adjust_offset(video_input: str, video_output: str, av_offset: int, fps: int = 25):
-    command = f"ffmpeg -loglevel error -y -i {video_input} -itsoffset {av_offset/fps} -i {video_input} -map 0:v -map 1:a -c copy -q:v 0 -q:a 0 {video_output}"
-    subprocess.run(command, shell=True)
-
-
-def func(sync_conf_threshold, paths, device_id, process_temp_dir):
+    # Written under a temporary name, so that a failed or interrupted ffmpeg doesn't look like a finished video
+    video_output_temp = video_output + ".part"
+    command = (
+        f"ffmpeg -loglevel error -y -i {video_input} -itsoffset {av_offset/fps} -i {video_input} "
+        f"-map 0:v -map 1:a -c copy -q:v 0 -q:a 0 -f mp4 {video_output_temp}"
+    )
+    subprocess.run(command, shell=True, check=True)
+    os.replace(video_output_temp, video_output)
+
+
+def sync_video(
+    video_input, video_output, sync_conf_threshold, syncnet, syncnet_detector, process_temp_dir, in_memory=False
+):
+    detect_results_dir = os.path.join(process_temp_dir, "detect_results")
+    syncnet_eval_results_dir = os.path.join(process_temp_dir, "syncnet_eval_results")
+    av_offset, conf = syncnet_eval(
+        syncnet, syncnet_detector, video_input, syncnet_eval_results_dir, detect_results_dir, in_memory
+    )
+    if conf < sync_conf_threshold or abs(av_offset) > 6:
+        return STATUS_REJECTED, [], conf
+    os.makedirs(os.path.dirname(video_output), exist_ok=True)
+    if av_offset == 0:
+        shutil.copy(video_input, video_output + ".part")
+        os.replace(video_output + ".part", video_output)
+    else:
+        adjust_offset(video_input, video_output, av_offset)
+    return STATUS_DONE, [video_output], conf
+
+
+def func(sync_conf_threshold, paths, device_id, process_temp_dir, manifest_path=None, in_memory=False):
     os.makedirs(process_temp_dir, exist_ok=True)
     device = f"cuda:{device_id}"
 
@@ -52,23 +81,25 @@ def func(sync_conf_threshold, paths, device_id, process_temp_dir):
     syncnet.loadParameters("checkpoints/auxiliary/syncnet_v2.model")
 
     detect_results_dir = os.path.join(process_temp_dir, "detect_results")
-    syncnet_eval_results_dir = os.path.join(process_temp_dir, "syncnet_eval_results")
-
     syncnet_detector = SyncNetDetector(device=device, detect_results_dir=detect_results_dir)
+    # Every process records its videos through its own connection
+    manifest = open_manifest(manifest_path)
 
     for video_input, video_output in paths:
-        try:
-            av_offset, conf = syncnet_eval(
-                syncnet, syncnet_detector, video_input, syncnet_eval_results_dir, detect_results_dir
-            )
-            if conf >= sync_conf_threshold and abs(av_offset) <= 6:
-                os.makedirs(os.path.dirname(video_output), exist_ok=True)
-                if av_offset == 0:
-                    shutil.copy(video_input, video_output)
-                else:
-                    adjust_offset(video_input, video_output, av_offset)
-        except Exception as e:
-            print(e)
+        result = run_task(
+            sync_video,
+            video_input,
+            video_output,
+            sync_conf_threshold,
+            syncnet,
+            syncnet_detector,
+            process_temp_dir,
+            in_memory,
+        )
+        if result.error is not None:
+            print(result.error)
+        if manifest is not None:
+            manifest.record(STAGE, result)
 
 
 def split(a, n):
@@ -76,12 +107,18 @@ def split(a, n):
     return (a[i * k + min(i, m) : (i + 1) * k + min(i + 1, m)] for i in range(n))
 
 
-def sync_av_multi_gpus(input_dir, output_dir, temp_dir, num_workers, sync_conf_threshold):
-    gather_paths(input_dir, output_dir)
+def sync_av_multi_gpus(
+    input_dir, output_dir, temp_dir, num_workers, sync_conf_threshold, manifest_path=None, in_memory=False
+):
+    """in_memory evaluates SyncNet on frames decoded once, without writing frames and crops to temp_dir"""
+    manifest = open_manifest(manifest_path)
+    # With a manifest, an existing output may be a partial one, only the recorded videos are finished
+    gather_paths(input_dir, output_dir, skip_existing=manifest is None)
+    tasks = paths if manifest is None else manifest.pending(STAGE, paths)
     num_devices = torch.cuda.device_count()
     if num_devices == 0:
         raise RuntimeError("No GPUs found")
-    split_paths = list(split(paths, num_workers * num_devices))
+    split_paths = list(split(tasks, num_workers * num_devices))
     processes = []
 
     for i in range(num_devices):
@@ -94,6 +131,8 @@ def sync_av_multi_gpus(input_dir, output_dir, temp_dir, num_workers, sync_conf_t
                     split_paths[process_index],
                     i,
                     os.path.join(temp_dir, f"process_{process_index}"),
+                    manifest_path,
+                    in_memory,
                 ),
             )
             process.start()
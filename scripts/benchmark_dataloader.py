@@ -0,0 +1,207 @@
+# Copyright (c) 2024 Bytedance Ltd. and/or its affiliates
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Measures the dataloader of the UNet or SyncNet training without any model, for a sweep of worker counts: the samples/s,
+the time per sample of every stage (open, decode, mel load, mask prep, collate) and the peak memory of the workers.
+It runs on CPU, on a fileslist of synthetic videos it generates when none is given, so that it can serve as a
+regression benchmark of the data path.
+"""
+
+import os
+import json
+import time
+import argparse
+import resource
+import subprocess
+from contextlib import contextmanager
+
+import torch
+from torch.utils.data.dataloader import default_collate
+from omegaconf import OmegaConf
+
+from latentsync.data.unet_dataset import UNetDataset
+from latentsync.data.syncnet_dataset import SyncNetDataset
+
+STAGES = ["open", "decode", "mel_load", "mask_prep", "collate"]
+
+
+def generate_synthetic_fileslist(output_dir, num_videos, num_frames, resolution, video_fps=25):
+    """Test pattern videos with a tone, which need no face detection with the fixed mask"""
+    os.makedirs(output_dir, exist_ok=True)
+    video_paths = []
+    for i in range(num_videos):
+        video_path = os.path.join(output_dir, f"synthetic_{i:04d}.mp4")
+        if not os.path.isfile(video_path):
+            command = (
+                f"ffmpeg -loglevel error -y -nostdin "
+                f"-f lavfi -i testsrc2=size={resolution}x{resolution}:rate={video_fps} "
+                f"-f lavfi -i sine=frequency={220 + 20 * i}:sample_rate=16000 "
+                f"-frames:v {num_frames} -shortest -c:v libx264 -pix_fmt yuv420p -c:a aac {video_path}"
+            )
+            subprocess.run(command, shell=True, check=True)
+        video_paths.append(video_path)
+
+    fileslist = os.path.join(output_dir, "fileslist.txt")
+    with open(fileslist, "w") as f:
+        f.write("\n".join(video_paths) + "\n")
+    return fileslist
+
+
+def timed_dataset_class(base):
+    """A subclass of a dataset that returns the time spent in each stage with every sample"""
+
+    class TimedDataset(base):
+        @contextmanager
+        def timer(self, stage):
+            start_time = time.perf_counter()
+            yield
+            self.stage_times[stage] += time.perf_counter() - start_time
+
+        def open_video(self, idx):
+            with self.timer("open"):
+                return super().open_video(idx)
+
+        def get_frames(self, *args, **kwargs):
+            with self.timer("decode"):
+                return super().get_frames(*args, **kwargs)
+
+        def load_mel(self, idx):
+            with self.timer("mel_load"):
+                return super().load_mel(idx)
+
+        def sample_from_video(self, *args, **kwargs):
+            # What remains of the sample once the frames and the mel are loaded is the image processing
+            decode_time, mel_time = self.stage_times["decode"], self.stage_times["mel_load"]
+            with self.timer("mask_prep"):
+                sample = super().sample_from_video(*args, **kwargs)
+            self.stage_times["mask_prep"] -= (self.stage_times["decode"] - decode_time) + (
+                self.stage_times["mel_load"] - mel_time
+            )
+            return sample
+
+        def __getitem__(self, idx):
+            self.stage_times = {stage: 0.0 for stage in STAGES}
+            sample = super().__getitem__(idx)
+            sample["stage_times"] = self.stage_times
+            # Peak resident memory of the process serving the sample, in MB
+            sample["max_rss"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+            return sample
+
+    return TimedDataset
+
+
+def timed_collate(samples):
+    start_time = time.perf_counter()
+    stage_times = [sample.pop("stage_times") for sample in samples]
+    max_rss = max(sample.pop("max_rss") for sample in samples)
+    batch = default_collate(samples)
+    batch["stage_times"] = {stage: sum(times[stage] for times in stage_times) for stage in STAGES}
+    batch["stage_times"]["collate"] = time.perf_counter() - start_time
+    batch["max_rss"] = max_rss
+    return batch
+
+
+def build_dataset(config, dataset_name):
+    if dataset_name == "unet":
+        return timed_dataset_class(UNetDataset)(config.data.train_data_dir, config)
+    return timed_dataset_class(SyncNetDataset)(config.data.train_data_dir, config.data.train_fileslist, config)
+
+
+def measure(dataset, batch_size, num_workers, num_batches):
+    if num_workers == 0:
+        dataset.worker_init_fn(0)
+    dataloader = torch.utils.data.DataLoader(
+        dataset,
+        batch_size=batch_size,
+        shuffle=True,
+        num_workers=num_workers,
+        drop_last=True,
+        worker_init_fn=dataset.worker_init_fn,
+        collate_fn=timed_collate,
+    )
+    iterator = iter(dataloader)
+    next(iterator)  # Exclude the worker startup
+    stage_times = {stage: 0.0 for stage in STAGES}
+    max_rss = 0.0
+    start_time = time.time()
+    for _ in range(num_batches):
+        batch = next(iterator)
+        for stage in STAGES:
+            stage_times[stage] += batch["stage_times"][stage]
+        max_rss = max(max_rss, batch["max_rss"])
+    elapsed = time.time() - start_time
+
+    num_samples = num_batches * batch_size
+    return {
+        "num_workers": num_workers,
+        "batch_size": batch_size,
+        "samples_per_second": num_samples / elapsed,
+        # Per sample, summed over the workers, so they don't shrink when workers are added
+        **{f"{stage}_ms": 1000 * stage_times[stage] / num_samples for stage in STAGES},
+        "worker_max_rss_mb": max_rss,
+    }
+
+
+def main(args):
+    config = OmegaConf.load(args.config_path)
+    if args.fileslist == "":
+        args.fileslist = generate_synthetic_fileslist(
+            args.synthetic_dir, args.num_videos, args.video_frames, config.data.resolution
+        )
+    # Never the cache path of the config, which usually points at the training machines' storage
+    if args.mel_cache_dir == "":
+        args.mel_cache_dir = os.path.join(args.synthetic_dir, "mel_cache")
+    config.data.audio_mel_cache_dir = args.mel_cache_dir
+    # The benchmark reads the videos of the fileslist only, none of the caches built for training
+    config.data.train_fileslist = args.fileslist
+    config.data.train_data_dir = ""
+    config.data.audio_mel_store_dir = ""
+    config.data.validity_index_path = ""
+    config.data.precomputed_audio_embeds = False
+
+    batch_size = args.batch_size if args.batch_size > 0 else config.data.batch_size
+    dataset = build_dataset(config, args.dataset)
+
+    results = []
+    for num_workers in [int(num_workers) for num_workers in args.num_workers.split(",")]:
+        result = measure(dataset, batch_size, num_workers, args.num_batches)
+        results.append(result)
+        stages = ", ".join(f"{stage} {result[f'{stage}_ms']:.1f}ms" for stage in STAGES)
+        print(
+            f"{num_workers} workers: {result['samples_per_second']:.1f} samples/s, {stages}, "
+            f"worker peak RSS {result['worker_max_rss_mb']:.0f}MB"
+        )
+
+    if args.output_path != "":
+        with open(args.output_path, "w") as f:
+            json.dump({"config_path": args.config_path, "dataset": args.dataset, "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the training dataloader over a sweep of worker counts")
+    parser.add_argument("--config_path", type=str, default="configs/unet/second_stage.yaml")
+    parser.add_argument("--dataset", type=str, default="unet", choices=["unet", "syncnet"])
+    parser.add_argument("--fileslist", type=str, default="", help="generates synthetic videos when empty")
+    parser.add_argument("--synthetic_dir", type=str, default="benchmark_data")
+    parser.add_argument("--mel_cache_dir", type=str, default="", help="defaults to mel_cache in the synthetic_dir")
+    parser.add_argument("--num_videos", type=int, default=16)
+    parser.add_argument("--video_frames", type=int, default=125)
+    parser.add_argument("--batch_size", type=int, default=0, help="defaults to the batch size of the config")
+    parser.add_argument("--num_workers", type=str, default="0,2,4,8", help="comma separated worker counts")
+    parser.add_argument("--num_batches", type=int, default=20)
+    parser.add_argument("--output_path", type=str, default="", help="JSON file for the results")
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,81 @@
+# Copyright (c) 2024 Bytedance Ltd. and/or its affiliates
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import time
+
+import torch
+from omegaconf import OmegaConf
+
+from latentsync.data.unet_dataset import UNetDataset
+from latentsync.data.syncnet_dataset import SyncNetDataset
+from latentsync.data.shards import ShardUNetDataset, ShardSyncNetDataset
+
+
+def build_datasets(config, args):
+    if args.dataset == "unet":
+        return {
+            "decord": UNetDataset(config.data.train_data_dir, config),
+            "shards": ShardUNetDataset(args.shards_dir, config),
+        }
+    return {
+        "decord": SyncNetDataset(config.data.train_data_dir, config.data.train_fileslist, config),
+        "shards": ShardSyncNetDataset(args.shards_dir, config),
+    }
+
+
+def measure_throughput(dataset, batch_size, num_workers, num_batches):
+    if num_workers == 0:
+        # The DataLoader only calls worker_init_fn in worker processes
+        dataset.worker_init_fn(0)
+    dataloader = torch.utils.data.DataLoader(
+        dataset,
+        batch_size=batch_size,
+        shuffle=True,
+        num_workers=num_workers,
+        drop_last=True,
+        worker_init_fn=dataset.worker_init_fn,
+    )
+    iterator = iter(dataloader)
+    next(iterator)  # Exclude the worker startup
+    start_time = time.time()
+    for _ in range(num_batches):
+        next(iterator)
+    return num_batches * batch_size / (time.time() - start_time)
+
+
+def main(args):
+    config = OmegaConf.load(args.config_path)
+    batch_size = args.batch_size if args.batch_size > 0 else config.data.batch_size
+    num_workers = args.num_workers if args.num_workers >= 0 else config.data.num_workers
+
+    results = {}
+    for name, dataset in build_datasets(config, args).items():
+        results[name] = measure_throughput(dataset, batch_size, num_workers, args.num_batches)
+        print(f"{name}: {results[name]:.1f} samples/s")
+
+    print(f"Speedup of shards over decord: {results['shards'] / results['decord']:.2f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the dataloader throughput of decord videos and shards")
+    parser.add_argument("--config_path", type=str, default="configs/unet/second_stage.yaml")
+    parser.add_argument("--dataset", type=str, default="unet", choices=["unet", "syncnet"])
+    parser.add_argument("--shards_dir", type=str, required=True)
+    parser.add_argument("--batch_size", type=int, default=0, help="defaults to the batch size of the config")
+    parser.add_argument("--num_workers", type=int, default=-1, help="defaults to the workers of the config")
+    parser.add_argument("--num_batches", type=int, default=50)
+    args = parser.parse_args()
+
+    main(args)
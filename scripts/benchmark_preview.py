@@ -0,0 +1,119 @@
+# Copyright (c) 2024 Bytedance Ltd. and/or its affiliates
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import time
+
+import torch
+from omegaconf import OmegaConf
+from diffusers import AutoencoderKL, DDIMScheduler
+
+from latentsync.models.unet import UNet3DConditionModel
+from latentsync.models.tiny_decoder import TinyDecoder
+from latentsync.pipelines.lipsync_pipeline import LipsyncPipeline
+from latentsync.whisper.audio2feature import Audio2Feature
+
+
+def synchronize(device):
+    if device == "cuda":
+        torch.cuda.synchronize()
+
+
+@torch.no_grad()
+def benchmark_decoders(vae, tiny_decoder, latent_size, num_frames, dtype, device, repeats):
+    latents = torch.randn(num_frames, vae.config.latent_channels, latent_size, latent_size, device=device, dtype=dtype)
+    results = {}
+    for name, decode in (
+        ("vae", lambda x: vae.decode(x / vae.config.scaling_factor).sample),
+        ("tiny", tiny_decoder),
+    ):
+        decode(latents)  # Warmup
+        synchronize(device)
+        start_time = time.time()
+        for _ in range(repeats):
+            decode(latents)
+        synchronize(device)
+        results[name] = (time.time() - start_time) / repeats
+    return results
+
+
+def timed_call(pipeline, args, config, dtype, preview):
+    start_time = time.time()
+    pipeline(
+        video_path=args.video_path,
+        audio_path=args.audio_path,
+        video_out_path=args.video_out_path.replace(".mp4", "_preview.mp4" if preview else ".mp4"),
+        num_frames=config.data.num_frames,
+        num_inference_steps=args.inference_steps,
+        guidance_scale=args.guidance_scale,
+        weight_dtype=dtype,
+        width=config.data.resolution,
+        height=config.data.resolution,
+        preview=preview,
+        preview_steps=args.preview_steps,
+    )
+    return time.time() - start_time
+
+
+def main(args):
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    dtype = torch.float16 if device == "cuda" else torch.float32
+    config = OmegaConf.load(args.unet_config_path)
+
+    vae = AutoencoderKL.from_pretrained("stabilityai/sd-vae-ft-mse", torch_dtype=dtype)
+    vae.config.scaling_factor = 0.18215
+    vae.config.shift_factor = 0
+    vae.to(device)
+    tiny_decoder = TinyDecoder.from_pretrained(args.preview_decoder_path, device=device).to(dtype=dtype)
+
+    num_frames = config.data.num_frames
+    latent_size = config.data.resolution // 8
+    decode_times = benchmark_decoders(vae, tiny_decoder, latent_size, num_frames, dtype, device, args.repeats)
+    print(f"Decode time of {num_frames} frames: vae {decode_times['vae']:.3f}s, tiny {decode_times['tiny']:.3f}s")
+    print(f"Decoder speedup: {decode_times['vae'] / decode_times['tiny']:.2f}x")
+
+    if args.video_path == "":
+        return
+
+    whisper_model_path = "small" if config.model.cross_attention_dim == 768 else "tiny"
+    audio_encoder = Audio2Feature(model_path=whisper_model_path, device=device, num_frames=num_frames)
+    unet, _ = UNet3DConditionModel.from_pretrained(OmegaConf.to_container(config.model), args.inference_ckpt_path)
+    pipeline = LipsyncPipeline(
+        vae=vae,
+        audio_encoder=audio_encoder,
+        unet=unet.to(dtype=dtype),
+        scheduler=DDIMScheduler.from_pretrained("configs"),
+    ).to(device)
+    pipeline.enable_preview(tiny_decoder)
+
+    full_time = timed_call(pipeline, args, config, dtype, preview=False)
+    preview_time = timed_call(pipeline, args, config, dtype, preview=True)
+    print(f"Full render: {full_time:.2f}s, preview: {preview_time:.2f}s ({preview_time / full_time:.0%} of the time)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the preview mode against the full render")
+    parser.add_argument("--unet_config_path", type=str, default="configs/unet/second_stage.yaml")
+    parser.add_argument("--inference_ckpt_path", type=str, default="checkpoints/latentsync_unet.pt")
+    parser.add_argument("--preview_decoder_path", type=str, default="checkpoints/tiny_decoder.pt")
+    parser.add_argument("--video_path", type=str, default="", help="also time the whole pipeline when set")
+    parser.add_argument("--audio_path", type=str, default="")
+    parser.add_argument("--video_out_path", type=str, default="benchmark_out.mp4")
+    parser.add_argument("--inference_steps", type=int, default=20)
+    parser.add_argument("--preview_steps", type=int, default=5)
+    parser.add_argument("--guidance_scale", type=float, default=1.0)
+    parser.add_argument("--repeats", type=int, default=10)
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,72 @@
+# Copyright (c) 2024 Bytedance Ltd. and/or its affiliates
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import sys
+import time
+
+import torch
+
+from latentsync.utils.image_processor import ImageProcessor
+
+
+def per_image(image_processor, images):
+    results = [image_processor.preprocess_fixed_mask_image(image) for image in images]
+    pixel_values_list, masked_pixel_values_list, masks_list = list(zip(*results))
+    return torch.stack(pixel_values_list), torch.stack(masked_pixel_values_list), torch.stack(masks_list)
+
+
+def timed(function, images, device, repeats):
+    function(images)  # Warmup
+    start_time = time.time()
+    for _ in range(repeats):
+        outputs = function(images)
+    if device == "cuda":
+        torch.cuda.synchronize()
+    return outputs, (time.time() - start_time) / repeats
+
+
+def main(args):
+    image_processor = ImageProcessor(args.resolution, mask="fix_mask")
+    # Faces as they come out of the affine transform, uint8 (F, C, H, W)
+    images = torch.randint(0, 256, (args.num_frames, 3, args.input_size, args.input_size), dtype=torch.uint8)
+
+    reference, per_image_time = timed(lambda x: per_image(image_processor, x), images, "cpu", args.repeats)
+    images = images.to(args.device)
+    batched, batched_time = timed(image_processor.prepare_masks_and_masked_images, images, args.device, args.repeats)
+
+    failed = False
+    for name, expected, actual in zip(["pixel_values", "masked_pixel_values", "masks"], reference, batched):
+        error = (actual.cpu().double() - expected.double()).abs().max().item()
+        print(f"{name}: shape {tuple(actual.shape)}, max abs error {error:.3e}")
+        failed |= expected.shape != actual.shape or error > args.atol
+    print(f"Per image: {per_image_time * 1000:.1f}ms, batched on {args.device}: {batched_time * 1000:.1f}ms")
+
+    if failed:
+        print(f"FAILED: outputs differ by more than {args.atol}")
+        sys.exit(1)
+    print("PASSED")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the batched fixed-mask preprocessing with the per-frame one")
+    parser.add_argument("--resolution", type=int, default=256)
+    parser.add_argument("--input_size", type=int, default=512, help="size of the faces before the resize")
+    parser.add_argument("--num_frames", type=int, default=16)
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--repeats", type=int, default=10)
+    parser.add_argument("--atol", type=float, default=1e-5, help="raise it on GPU, its resize may round differently")
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,79 @@
+# Copyright (c) 2024 Bytedance Ltd. and/or its affiliates
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import sys
+import time
+
+import numpy as np
+import torch
+from decord import AudioReader, cpu
+
+from latentsync.utils.audio import melspectrogram, melspectrogram_torch
+
+DTYPES = {"fp64": torch.float64, "fp32": torch.float32}
+
+
+def load_wavs(args):
+    if args.audio_path != "":
+        wav = AudioReader(args.audio_path, ctx=cpu(0), sample_rate=16000)[:].asnumpy().squeeze(0)
+        return [wav[: len(wav) * (i + 1) // args.batch_size] for i in range(args.batch_size)]
+    # Noise of different lengths, so that the padding of the batch is checked too
+    rng = np.random.default_rng(0)
+    return [rng.uniform(-0.5, 0.5, 16000 * (2 + i)).astype(np.float32) for i in range(args.batch_size)]
+
+
+def main(args):
+    device = args.device
+    if device is None:
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+    wavs = load_wavs(args)
+
+    start_time = time.time()
+    references = [melspectrogram(wav) for wav in wavs]
+    reference_time = time.time() - start_time
+
+    torch_wavs = [torch.from_numpy(wav).to(DTYPES[args.dtype]) for wav in wavs]
+    melspectrogram_torch(torch_wavs, device=device)  # Warmup
+    start_time = time.time()
+    mels = melspectrogram_torch(torch_wavs, device=device)
+    if device == "cuda":
+        torch.cuda.synchronize()
+    torch_time = time.time() - start_time
+
+    max_error = 0.0
+    for reference, mel in zip(references, mels):
+        assert reference.shape == tuple(mel.shape), f"{reference.shape} != {tuple(mel.shape)}"
+        max_error = max(max_error, np.abs(mel.cpu().double().numpy() - reference).max())
+    print(f"Waveforms: {len(wavs)}, mel frames: {[reference.shape[1] for reference in references]}")
+    print(f"Max abs error: {max_error:.3e}")
+    print(f"Time: librosa {reference_time:.3f}s, torch ({args.dtype} on {device}) {torch_time:.3f}s")
+
+    # The mel spectrograms are normalized to [-4, 4]
+    if max_error > args.atol:
+        print(f"FAILED: max abs error above {args.atol}")
+        sys.exit(1)
+    print("PASSED")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check the torch melspectrogram against the librosa one")
+    parser.add_argument("--audio_path", type=str, default="", help="uses random noise when empty")
+    parser.add_argument("--batch_size", type=int, default=8)
+    parser.add_argument("--dtype", type=str, default="fp64", choices=list(DTYPES.keys()))
+    parser.add_argument("--device", type=str, default=None)
+    parser.add_argument("--atol", type=float, default=1e-3)
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,90 @@
+# Copyright (c) 2024 Bytedance Ltd. and/or its affiliates
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import sys
+import time
+
+import torch
+from decord import VideoReader, cpu
+from diffusers import AutoencoderKL
+
+from latentsync.utils.image_processor import ImageProcessor
+from latentsync.utils.vae_decode import decode_lower_half
+
+
+def timed_decode(decode, latents, repeats):
+    decode(latents)  # Warmup
+    if latents.device.type == "cuda":
+        torch.cuda.reset_peak_memory_stats()
+    start_time = time.time()
+    for _ in range(repeats):
+        images = decode(latents)
+    if latents.device.type == "cuda":
+        torch.cuda.synchronize()
+        peak_memory = torch.cuda.max_memory_allocated() / 2**20
+    else:
+        peak_memory = float("nan")
+    return images, (time.time() - start_time) / repeats, peak_memory
+
+
+@torch.no_grad()
+def main(args):
+    device = args.device
+    if device is None:
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+    dtype = torch.float16 if device != "cpu" else torch.float32
+
+    vae = AutoencoderKL.from_pretrained("stabilityai/sd-vae-ft-mse", torch_dtype=dtype)
+    vae.requires_grad_(False)
+    vae.to(device)
+
+    # The aligned faces of the training data, as the UNet would predict them
+    frames = VideoReader(args.video_path, ctx=cpu(0)).get_batch(list(range(args.num_frames))).asnumpy()
+    images = ImageProcessor(args.resolution, mask="fix_mask").process_images(frames)
+    latents = vae.encode(images.to(device, dtype=dtype)).latent_dist.mean
+
+    full_images, full_time, full_memory = timed_decode(lambda x: vae.decode(x).sample, latents, args.repeats)
+    half_images, half_time, half_memory = timed_decode(
+        lambda x: decode_lower_half(vae, x, margin=args.margin), latents, args.repeats
+    )
+
+    reference = full_images[:, :, full_images.shape[2] // 2 :, :].float()
+    assert reference.shape == half_images.shape, f"{reference.shape} != {half_images.shape}"
+    error = (half_images.float() - reference).abs()
+    print(f"Latents shape: {tuple(latents.shape)}, margin: {args.margin}")
+    print(f"Max abs error: {error.max().item():.3e}")
+    print(f"Mean abs error: {error.mean().item():.3e}")
+    print(f"Decode time: full {full_time:.3f}s, lower half {half_time:.3f}s")
+    print(f"Peak memory: full {full_memory:.0f}MB, lower half {half_memory:.0f}MB")
+
+    # The images are in [-1, 1], the tolerance is on the mean error since the norms see the whole input
+    if error.mean().item() > args.atol:
+        print(f"FAILED: mean abs error above {args.atol}")
+        sys.exit(1)
+    print("PASSED")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check the lower-half VAE decode against the full decode")
+    parser.add_argument("--video_path", type=str, required=True)
+    parser.add_argument("--resolution", type=int, default=256)
+    parser.add_argument("--num_frames", type=int, default=16)
+    parser.add_argument("--margin", type=int, default=4, help="latent rows of context above the lower half")
+    parser.add_argument("--device", type=str, default=None)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--atol", type=float, default=2e-2)
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,85 @@
+# Copyright (c) 2024 Bytedance Ltd. and/or its affiliates
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import os
+import sys
+import time
+
+import torch
+
+from eval.syncnet import SyncNetEval
+from eval.syncnet_detect import SyncNetDetector
+from eval.eval_sync_conf import syncnet_eval
+
+
+def main(args):
+    device = args.device
+    if device is None:
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+
+    syncnet = SyncNetEval(device=device)
+    syncnet.loadParameters(args.initial_model)
+    detect_results_dir = os.path.join(args.temp_dir, "detect_results")
+    syncnet_detector = SyncNetDetector(device=device, detect_results_dir=detect_results_dir)
+
+    if args.video_path != "":
+        video_paths = [args.video_path]
+    else:
+        video_names = sorted(f for f in os.listdir(args.videos_dir) if f.endswith(".mp4"))
+        video_paths = [os.path.join(args.videos_dir, video_name) for video_name in video_names]
+
+    failed = False
+    times = {"files": 0.0, "in_memory": 0.0}
+    for video_path in video_paths:
+        results = {}
+        for mode in ["files", "in_memory"]:
+            start_time = time.time()
+            results[mode] = syncnet_eval(
+                syncnet,
+                syncnet_detector,
+                video_path,
+                os.path.join(args.temp_dir, "syncnet_eval_results"),
+                detect_results_dir,
+                in_memory=mode == "in_memory",
+            )
+            times[mode] += time.time() - start_time
+
+        (offset, conf), (offset_in_memory, conf_in_memory) = results["files"], results["in_memory"]
+        # The file path goes through JPEG, mp4v and AAC, the confidences can't be bitwise equal
+        matched = offset == offset_in_memory and abs(conf - conf_in_memory) <= args.conf_atol
+        failed |= not matched
+        print(
+            f"{video_path}: offset {offset} / {offset_in_memory}, conf {conf:.3f} / {conf_in_memory:.3f}"
+            f"{'' if matched else ' MISMATCH'}"
+        )
+    print(f"Time: files {times['files']:.1f}s, in memory {times['in_memory']:.1f}s")
+
+    if failed:
+        print(f"FAILED: offsets differ or confidences differ by more than {args.conf_atol}")
+        sys.exit(1)
+    print("PASSED")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the in-memory SyncNet evaluation with the file-based one")
+    parser.add_argument("--initial_model", type=str, default="checkpoints/auxiliary/syncnet_v2.model")
+    parser.add_argument("--video_path", type=str, default="")
+    parser.add_argument("--videos_dir", type=str, default="", help="checks every video of the directory")
+    parser.add_argument("--temp_dir", type=str, default="temp")
+    parser.add_argument("--device", type=str, default=None)
+    parser.add_argument("--conf_atol", type=float, default=0.3)
+    args = parser.parse_args()
+
+    main(args)
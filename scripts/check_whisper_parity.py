@@ -0,0 +1,81 @@
+# Copyright (c) 2024 Bytedance Ltd. and/or its affiliates
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import sys
+import time
+
+import torch
+
+from latentsync.whisper.audio2feature import Audio2Feature
+
+DTYPES = {"fp32": torch.float32, "fp16": torch.float16, "bf16": torch.bfloat16}
+
+
+def timed_features(audio_encoder, audio_path, repeats):
+    audio_encoder.audio2feat(audio_path)  # Warmup
+    start_time = time.time()
+    for _ in range(repeats):
+        feature = audio_encoder.audio2feat(audio_path)
+    if feature.device.type == "cuda":
+        torch.cuda.synchronize()
+    return feature, (time.time() - start_time) / repeats
+
+
+def main(args):
+    device = args.device
+    if device is None:
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+
+    # The reference is the original encoder, in the dtype Audio2Feature uses by default
+    reference = Audio2Feature(model_path=args.whisper_model_path, device=device)
+    fast = Audio2Feature(
+        model_path=args.whisper_model_path, device=device, dtype=DTYPES[args.dtype], fast_encoder=True
+    )
+
+    reference_feature, reference_time = timed_features(reference, args.audio_path, args.repeats)
+    fast_feature, fast_time = timed_features(fast, args.audio_path, args.repeats)
+    assert reference_feature.shape == fast_feature.shape, f"{reference_feature.shape} != {fast_feature.shape}"
+
+    # Compare what the UNet actually consumes: the overlapping audio windows of every video frame
+    reference_chunks = torch.stack(reference.feature2chunks(reference_feature, fps=25)).float()
+    fast_chunks = torch.stack(fast.feature2chunks(fast_feature, fps=25)).float()
+
+    error = fast_chunks - reference_chunks
+    relative_error = (error.norm() / reference_chunks.norm()).item()
+    cosine = torch.nn.functional.cosine_similarity(fast_chunks.flatten(1), reference_chunks.flatten(1)).min().item()
+    print(f"Features shape: {tuple(reference_feature.shape)}")
+    print(f"Max abs error: {error.abs().max().item():.3e}")
+    print(f"Relative error: {relative_error:.3e}")
+    print(f"Min cosine similarity per chunk: {cosine:.6f}")
+    print(f"Extraction time: reference {reference_time:.3f}s, fast ({args.dtype}) {fast_time:.3f}s")
+    print(f"Speedup: {reference_time / fast_time:.2f}x")
+
+    if relative_error > args.rtol:
+        print(f"FAILED: relative error above {args.rtol}")
+        sys.exit(1)
+    print("PASSED")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check the fast whisper encoder path against the original encoder")
+    parser.add_argument("--audio_path", type=str, required=True)
+    parser.add_argument("--whisper_model_path", type=str, default="checkpoints/whisper/tiny.pt")
+    parser.add_argument("--dtype", type=str, default="fp32", choices=list(DTYPES.keys()))
+    parser.add_argument("--device", type=str, default=None)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--rtol", type=float, default=1e-2)
+    args = parser.parse_args()
+
+    main(args)
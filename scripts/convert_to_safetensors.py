@@ -0,0 +1,57 @@
+# Copyright (c) 2024 Bytedance Ltd. and/or its affiliates
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import os
+
+import torch
+
+from latentsync.utils.checkpoint import save_checkpoint_safetensors
+
+
+def main(args):
+    output_path = args.output_path
+    if output_path is None:
+        output_path = os.path.splitext(args.input_path)[0] + ".safetensors"
+
+    ckpt = torch.load(args.input_path, map_location="cpu")
+
+    if "model_state_dict" in ckpt:
+        # Whisper checkpoint, the model dimensions are needed to build the model
+        state_dict = ckpt["model_state_dict"]
+        if args.encoder_only:
+            state_dict = {key: value for key, value in state_dict.items() if key.startswith("encoder.")}
+            save_checkpoint_safetensors(state_dict, output_path, dims=ckpt["dims"], encoder_only=True)
+        else:
+            save_checkpoint_safetensors(state_dict, output_path, dims=ckpt["dims"])
+    elif "state_dict" in ckpt:
+        if "quantization" in ckpt:
+            raise ValueError("Quantized checkpoints contain packed parameters and cannot be stored as safetensors")
+        save_checkpoint_safetensors(ckpt["state_dict"], output_path, global_step=ckpt.get("global_step", 0))
+    else:
+        save_checkpoint_safetensors(ckpt, output_path)
+
+    print(f"Saved {output_path}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert a UNet or whisper .pt checkpoint to safetensors")
+    parser.add_argument("--input_path", type=str, required=True)
+    parser.add_argument("--output_path", type=str, default=None)
+    parser.add_argument(
+        "--encoder_only", action="store_true", help="only keep the audio encoder weights of a whisper checkpoint"
+    )
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,210 @@
+# Copyright (c) 2024 Bytedance Ltd. and/or its affiliates
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import os
+import json
+import time
+
+import torch
+import torch.nn as nn
+from omegaconf import OmegaConf
+from diffusers import AutoencoderKL
+
+from latentsync.models.unet import UNet3DConditionModel
+from latentsync.pipelines.onnx_engine import (
+    OnnxUNet,
+    OnnxAutoencoder,
+    UNET_ONNX_NAME,
+    VAE_ENCODER_ONNX_NAME,
+    VAE_DECODER_ONNX_NAME,
+    ENGINE_CONFIG_NAME,
+)
+
+
+class UNetExportWrapper(nn.Module):
+    def __init__(self, unet: UNet3DConditionModel):
+        super().__init__()
+        self.unet = unet
+
+    def forward(self, sample, timestep, encoder_hidden_states=None):
+        return self.unet(sample, timestep, encoder_hidden_states=encoder_hidden_states, return_dict=False)[0]
+
+
+class VAEEncoderExportWrapper(nn.Module):
+    def __init__(self, vae: AutoencoderKL):
+        super().__init__()
+        self.vae = vae
+
+    def forward(self, images):
+        # Export the posterior moments, the sampling is done in torch so that the generator is respected
+        return self.vae.quant_conv(self.vae.encoder(images))
+
+
+class VAEDecoderExportWrapper(nn.Module):
+    def __init__(self, vae: AutoencoderKL):
+        super().__init__()
+        self.vae = vae
+
+    def forward(self, latents):
+        return self.vae.decode(latents).sample
+
+
+def get_dummy_inputs(config, batch_size, cross_attention_dim):
+    num_frames = config.data.num_frames
+    latent_size = config.data.resolution // 8
+    unet_inputs = dict(
+        sample=torch.randn(batch_size, config.model.in_channels, num_frames, latent_size, latent_size),
+        timestep=torch.tensor([500], dtype=torch.int64),
+    )
+    if config.model.add_audio_layer:
+        unet_inputs["encoder_hidden_states"] = torch.randn(batch_size * num_frames, 50, cross_attention_dim)
+    vae_encoder_inputs = dict(images=torch.randn(num_frames, 3, config.data.resolution, config.data.resolution))
+    vae_decoder_inputs = dict(latents=torch.randn(num_frames, 4, latent_size, latent_size))
+    return unet_inputs, vae_encoder_inputs, vae_decoder_inputs
+
+
+def export(model, inputs, output_path, output_name, opset_version):
+    print(f"Exporting {output_path} ...")
+    torch.onnx.export(
+        model,
+        tuple(inputs.values()),
+        output_path,
+        input_names=list(inputs.keys()),
+        output_names=[output_name],
+        opset_version=opset_version,
+        do_constant_folding=True,
+    )
+
+
+def max_error(reference: torch.Tensor, output: torch.Tensor):
+    abs_error = (reference.float() - output.float()).abs().max().item()
+    rel_error = abs_error / max(reference.float().abs().max().item(), 1e-8)
+    return abs_error, rel_error
+
+
+@torch.no_grad()
+def check_parity(unet, vae, inputs, onnx_dir, num_threads, atol):
+    """Compare the outputs of the exported graphs on ONNX Runtime with eager PyTorch in float32 on the CPU"""
+    unet_inputs, vae_encoder_inputs, vae_decoder_inputs = inputs
+    onnx_unet = OnnxUNet(onnx_dir, num_threads=num_threads)
+    onnx_vae = OnnxAutoencoder(onnx_dir, num_threads=num_threads)
+
+    results = {}
+
+    start_time = time.time()
+    reference = unet(**unet_inputs).sample
+    torch_time = time.time() - start_time
+    start_time = time.time()
+    output = onnx_unet(**unet_inputs).sample
+    onnx_time = time.time() - start_time
+    results["unet"] = (*max_error(reference, output), torch_time, onnx_time)
+
+    start_time = time.time()
+    reference = vae.encode(vae_encoder_inputs["images"]).latent_dist
+    torch_time = time.time() - start_time
+    start_time = time.time()
+    output = onnx_vae.encode(vae_encoder_inputs["images"]).latent_dist
+    onnx_time = time.time() - start_time
+    results["vae_encoder"] = (*max_error(reference.mean, output.mean), torch_time, onnx_time)
+
+    start_time = time.time()
+    reference = vae.decode(vae_decoder_inputs["latents"]).sample
+    torch_time = time.time() - start_time
+    start_time = time.time()
+    output = onnx_vae.decode(vae_decoder_inputs["latents"]).sample
+    onnx_time = time.time() - start_time
+    results["vae_decoder"] = (*max_error(reference, output), torch_time, onnx_time)
+
+    passed = True
+    for name, (abs_error, rel_error, torch_time, onnx_time) in results.items():
+        status = "OK" if abs_error <= atol else "FAILED"
+        passed = passed and abs_error <= atol
+        print(
+            f"{name}: max abs error {abs_error:.2e}, max rel error {rel_error:.2e}, "
+            f"torch {torch_time:.2f}s, onnxruntime {onnx_time:.2f}s [{status}]"
+        )
+    if not passed:
+        raise RuntimeError(f"Exported graphs do not match eager PyTorch within atol={atol}")
+
+
+def main(args):
+    config = OmegaConf.load(args.unet_config_path)
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    unet, _ = UNet3DConditionModel.from_pretrained(
+        OmegaConf.to_container(config.model), args.inference_ckpt_path, device="cpu"
+    )
+    unet = unet.to(dtype=torch.float32).eval()
+
+    vae = AutoencoderKL.from_pretrained("stabilityai/sd-vae-ft-mse", torch_dtype=torch.float32).eval()
+
+    batch_size = 2 if args.guidance_scale > 1.0 else 1
+    inputs = get_dummy_inputs(config, batch_size, config.model.cross_attention_dim)
+    unet_inputs, vae_encoder_inputs, vae_decoder_inputs = inputs
+
+    with torch.no_grad():
+        export(
+            UNetExportWrapper(unet),
+            unet_inputs,
+            os.path.join(args.output_dir, UNET_ONNX_NAME),
+            "noise_pred",
+            args.opset_version,
+        )
+        export(
+            VAEEncoderExportWrapper(vae),
+            vae_encoder_inputs,
+            os.path.join(args.output_dir, VAE_ENCODER_ONNX_NAME),
+            "moments",
+            args.opset_version,
+        )
+        export(
+            VAEDecoderExportWrapper(vae),
+            vae_decoder_inputs,
+            os.path.join(args.output_dir, VAE_DECODER_ONNX_NAME),
+            "images",
+            args.opset_version,
+        )
+
+    vae_config = dict(vae.config)
+    vae_config["scaling_factor"] = 0.18215
+    vae_config["shift_factor"] = 0
+    engine_config = {
+        "unet": dict(unet.config),
+        "vae": vae_config,
+        "num_frames": config.data.num_frames,
+        "resolution": config.data.resolution,
+        "batch_size": batch_size,
+    }
+    with open(os.path.join(args.output_dir, ENGINE_CONFIG_NAME), "w") as f:
+        json.dump(engine_config, f, indent=2)
+    print(f"Saved engine to {args.output_dir}")
+
+    if args.check:
+        check_parity(unet, vae, inputs, args.output_dir, args.num_threads, args.atol)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export the UNet and the VAE to ONNX graphs with fixed chunk shapes")
+    parser.add_argument("--unet_config_path", type=str, default="configs/unet/second_stage.yaml")
+    parser.add_argument("--inference_ckpt_path", type=str, default="checkpoints/latentsync_unet.pt")
+    parser.add_argument("--output_dir", type=str, default="checkpoints/onnx")
+    parser.add_argument("--guidance_scale", type=float, default=1.0)
+    parser.add_argument("--opset_version", type=int, default=17)
+    parser.add_argument("--num_threads", type=int, default=0)
+    parser.add_argument("--check", action="store_true", help="compare the exported graphs against eager PyTorch")
+    parser.add_argument("--atol", type=float, default=1e-3)
+    args = parser.parse_args()
+
+    main(args)
@@ -31,6 +31,12 @@ def main(config, args, job):
     # Check if the GPU supports float16
     is_fp16_supported = torch.cuda.is_available() and torch.cuda.get_device_capability()[0] > 7
     dtype = torch.float16 if is_fp16_supported else torch.float32
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    if args.engine != "onnx" and args.quantization == "int8":
+        # Dynamic int8 quantization only runs on the CPU, with fp32 activations. Resolved before any model is built, so
+        # that the audio encoder and the VAE are on the same device as the UNet
+        dtype = torch.float32
+        device = "cpu"
 
     #print(f"Input video path: {args.video_path}")
     #print(f"Input audio path: {args.audio_path}")
@@ -45,31 +51,63 @@ def main(config, args, job):
     else:
         raise NotImplementedError("cross_attention_dim must be 768 or 384")
 
-    audio_encoder = Audio2Feature(model_path=whisper_model_path, device="cuda", num_frames=config.data.num_frames)
+    if args.whisper_dtype == "auto":
+        audio_encoder = Audio2Feature(model_path=whisper_model_path, device=device, num_frames=config.data.num_frames)
+    else:
+        # Fast encoder path: weights cast once and fused attention
+        whisper_dtype = {"fp32": torch.float32, "fp16": torch.float16, "bf16": torch.bfloat16}[args.whisper_dtype]
+        audio_encoder = Audio2Feature(
+            model_path=whisper_model_path,
+            device=device,
+            num_frames=config.data.num_frames,
+            dtype=whisper_dtype,
+            fast_encoder=True,
+        )
 
-    vae = AutoencoderKL.from_pretrained("stabilityai/sd-vae-ft-mse", torch_dtype=dtype)
-    vae.config.scaling_factor = 0.18215
-    vae.config.shift_factor = 0
+    if args.engine == "onnx" and args.region_decode:
+        raise ValueError("region_decode is not supported by the ONNX engine, its VAE decoder has a fixed input size")
 
-    unet, _ = UNet3DConditionModel.from_pretrained(
-        OmegaConf.to_container(config.model),
-        args.inference_ckpt_path,  # load checkpoint
-        device="cpu",
-    )
+    if args.engine == "onnx":
+        # The exported graphs run on ONNX Runtime's CPU provider in float32
+        from latentsync.pipelines.onnx_engine import OnnxUNet, OnnxAutoencoder
+
+        dtype = torch.float32
+        vae = OnnxAutoencoder(args.onnx_dir, num_threads=args.num_threads)
+        unet = OnnxUNet(args.onnx_dir, num_threads=args.num_threads)
+    else:
+        vae = AutoencoderKL.from_pretrained("stabilityai/sd-vae-ft-mse", torch_dtype=dtype)
+        vae.config.scaling_factor = 0.18215
+        vae.config.shift_factor = 0
 
-    unet = unet.to(dtype=dtype)
+        if args.quantization == "int8":
+            from latentsync.models.quantization import load_quantized_unet
 
-    # set xformers
-    if is_xformers_available():
-        unet.enable_xformers_memory_efficient_attention()
-        print("Xformers enabled")
+            unet = load_quantized_unet(OmegaConf.to_container(config.model), args.inference_ckpt_path)
+        else:
+            unet, _ = UNet3DConditionModel.from_pretrained(
+                OmegaConf.to_container(config.model),
+                args.inference_ckpt_path,  # load checkpoint
+                device="cpu",
+            )
+
+        unet = unet.to(dtype=dtype)
+
+        # set xformers
+        if is_xformers_available() and device == "cuda":
+            unet.enable_xformers_memory_efficient_attention()
+            print("Xformers enabled")
 
     pipeline = LipsyncPipeline(
         vae=vae,
         audio_encoder=audio_encoder,
         unet=unet,
         scheduler=scheduler,
-    ).to("cuda")
+    ).to(device)
+
+    if args.preview and os.path.isfile(args.preview_decoder_path):
+        from latentsync.models.tiny_decoder import TinyDecoder
+
+        pipeline.enable_preview(TinyDecoder.from_pretrained(args.preview_decoder_path, device=device))
 
     if args.seed != -1:
         set_seed(args.seed)
@@ -89,6 +127,9 @@ def main(config, args, job):
         weight_dtype=dtype,
         width=config.data.resolution,
         height=config.data.resolution,
+        region_decode=args.region_decode,
+        preview=args.preview,
+        preview_steps=args.preview_steps,
     )
 
 def shorten_video(video_path, temp_dir, duration):
@@ -153,6 +194,24 @@ def run_inference(job):
         args.seed = 1247
     if not hasattr(args, 'start_frame'):
         args.start_frame = 0
+    if not hasattr(args, 'engine'):
+        args.engine = "torch"
+    if not hasattr(args, 'onnx_dir'):
+        args.onnx_dir = "checkpoints/onnx"
+    if not hasattr(args, 'num_threads'):
+        args.num_threads = 0
+    if not hasattr(args, 'quantization'):
+        args.quantization = "none"
+    if not hasattr(args, 'whisper_dtype'):
+        args.whisper_dtype = "auto"
+    if not hasattr(args, 'region_decode'):
+        args.region_decode = False
+    if not hasattr(args, 'preview'):
+        args.preview = False
+    if not hasattr(args, 'preview_steps'):
+        args.preview_steps = 5
+    if not hasattr(args, 'preview_decoder_path'):
+        args.preview_decoder_path = "checkpoints/tiny_decoder.pt"
 
     temp_dir = util.create_temp_dir()
 
@@ -194,6 +253,15 @@ def run_inference(job):
 #     parser.add_argument("--guidance_scale", type=float, default=1.0)
 #     parser.add_argument("--seed", type=int, default=1247)
 #     parser.add_argument("--start_frame", type=int, default=0)
+#     parser.add_argument("--engine", type=str, default="torch", choices=["torch", "onnx"])
+#     parser.add_argument("--onnx_dir", type=str, default="checkpoints/onnx")
+#     parser.add_argument("--num_threads", type=int, default=0)
+#     parser.add_argument("--quantization", type=str, default="none", choices=["none", "int8"])
+#     parser.add_argument("--whisper_dtype", type=str, default="auto", choices=["auto", "fp32", "fp16", "bf16"])
+#     parser.add_argument("--region_decode", action="store_true")
+#     parser.add_argument("--preview", action="store_true")
+#     parser.add_argument("--preview_steps", type=int, default=5)
+#     parser.add_argument("--preview_decoder_path", type=str, default="checkpoints/tiny_decoder.pt")
 #     args = parser.parse_args()
 
 #     run_inference(args)
@@ -0,0 +1,134 @@
+# Copyright (c) 2024 Bytedance Ltd. and/or its affiliates
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import copy
+import time
+
+import torch
+from omegaconf import OmegaConf
+from diffusers import AutoencoderKL, DDIMScheduler
+from einops import rearrange
+
+from latentsync.models.unet import UNet3DConditionModel
+from latentsync.models.quantization import quantize_unet, save_quantized_unet
+from latentsync.pipelines.lipsync_pipeline import LipsyncPipeline
+from latentsync.utils.image_processor import ImageProcessor
+from latentsync.utils.util import read_video
+from latentsync.whisper.audio2feature import Audio2Feature
+
+
+@torch.no_grad()
+def prepare_clip_inputs(config, args, unet):
+    """Build the UNet inputs of the first chunk of a fixed clip, exactly as LipsyncPipeline does"""
+    num_frames = config.data.num_frames
+    resolution = config.data.resolution
+
+    vae = AutoencoderKL.from_pretrained("stabilityai/sd-vae-ft-mse", torch_dtype=torch.float32)
+    vae.config.scaling_factor = 0.18215
+    vae.config.shift_factor = 0
+
+    whisper_model_path = "small" if config.model.cross_attention_dim == 768 else "tiny"
+    audio_encoder = Audio2Feature(model_path=whisper_model_path, device="cpu", num_frames=num_frames)
+    scheduler = DDIMScheduler.from_pretrained("configs")
+    pipeline = LipsyncPipeline(vae=vae, audio_encoder=audio_encoder, unet=unet, scheduler=scheduler)
+
+    generator = torch.Generator().manual_seed(args.seed)
+    device = torch.device("cpu")
+
+    image_processor = ImageProcessor(resolution, mask="fix_mask", device="cpu")
+    video_frames = read_video(args.video_path, use_decord=False)[:num_frames]
+    faces = torch.stack([image_processor.affine_transform(frame)[0] for frame in video_frames])
+    pixel_values, masked_pixel_values, masks = image_processor.prepare_masks_and_masked_images(
+        faces, affine_transform=False
+    )
+    mask_latents, masked_image_latents = pipeline.prepare_mask_latents(
+        masks, masked_pixel_values, resolution, resolution, torch.float32, device, generator, False
+    )
+    image_latents = pipeline.prepare_image_latents(pixel_values, device, torch.float32, generator, False)
+    latents = pipeline.prepare_latents(
+        1, num_frames, vae.config.latent_channels, resolution, resolution, torch.float32, device, generator
+    )
+
+    whisper_feature = audio_encoder.audio2feat(args.audio_path)
+    whisper_chunks = audio_encoder.feature2chunks(feature_array=whisper_feature, fps=25)
+    audio_embeds = torch.stack(whisper_chunks[:num_frames]).to(torch.float32)
+
+    return scheduler, latents, torch.cat([mask_latents, masked_image_latents, image_latents], dim=1), audio_embeds
+
+
+@torch.no_grad()
+def denoise(unet, scheduler, latents, condition_latents, audio_embeds, num_inference_steps):
+    scheduler.set_timesteps(num_inference_steps)
+    step_times = []
+    for t in scheduler.timesteps:
+        latent_model_input = scheduler.scale_model_input(latents, t)
+        latent_model_input = torch.cat([latent_model_input, condition_latents], dim=1)
+        start_time = time.time()
+        noise_pred = unet(latent_model_input, t, encoder_hidden_states=audio_embeds).sample
+        step_times.append(time.time() - start_time)
+        latents = scheduler.step(noise_pred, t, latents).prev_sample
+    return latents, sum(step_times) / len(step_times)
+
+
+def main(args):
+    config = OmegaConf.load(args.unet_config_path)
+    if args.num_threads > 0:
+        torch.set_num_threads(args.num_threads)
+
+    unet, global_step = UNet3DConditionModel.from_pretrained(
+        OmegaConf.to_container(config.model), args.inference_ckpt_path, device="cpu"
+    )
+    unet = unet.to(dtype=torch.float32).eval()
+
+    print("Quantizing UNet ...")
+    quantized_unet = quantize_unet(copy.deepcopy(unet), include_conv=args.include_conv)
+    save_quantized_unet(quantized_unet, args.output_path, global_step)
+    print(f"Saved pre-quantized checkpoint to {args.output_path}")
+
+    if args.video_path is None or args.audio_path is None:
+        return
+
+    scheduler, latents, condition_latents, audio_embeds = prepare_clip_inputs(config, args, unet)
+
+    fp32_latents, fp32_step_time = denoise(
+        unet, scheduler, latents, condition_latents, audio_embeds, args.inference_steps
+    )
+    int8_latents, int8_step_time = denoise(
+        quantized_unet, scheduler, latents, condition_latents, audio_embeds, args.inference_steps
+    )
+
+    error = (int8_latents - fp32_latents).float()
+    per_frame_mse = rearrange(error**2, "b c f h w -> f (b c h w)").mean(dim=1)
+    print(f"Latent MSE: {error.pow(2).mean().item():.3e} (worst frame {per_frame_mse.max().item():.3e})")
+    print(f"Latent max abs error: {error.abs().max().item():.3e}")
+    print(f"Latent relative error: {(error.norm() / fp32_latents.float().norm()).item():.3e}")
+    print(f"UNet step time: fp32 {fp32_step_time:.2f}s, int8 {int8_step_time:.2f}s")
+    print(f"Speedup: {fp32_step_time / int8_step_time:.2f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Quantize the UNet to int8 and evaluate it against fp32 on a clip")
+    parser.add_argument("--unet_config_path", type=str, default="configs/unet/second_stage.yaml")
+    parser.add_argument("--inference_ckpt_path", type=str, default="checkpoints/latentsync_unet.pt")
+    parser.add_argument("--output_path", type=str, default="checkpoints/latentsync_unet_int8.pt")
+    parser.add_argument("--include_conv", action="store_true", help="also store the InflatedConv3d weights in int8")
+    parser.add_argument("--video_path", type=str, default=None)
+    parser.add_argument("--audio_path", type=str, default=None)
+    parser.add_argument("--inference_steps", type=int, default=20)
+    parser.add_argument("--num_threads", type=int, default=0)
+    parser.add_argument("--seed", type=int, default=1247)
+    args = parser.parse_args()
+
+    main(args)
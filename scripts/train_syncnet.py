@@ -19,9 +19,14 @@ from omegaconf import OmegaConf
 import shutil
 
 from latentsync.data.syncnet_dataset import SyncNetDataset
+from latentsync.data.shards import ShardSyncNetDataset
+from latentsync.data.latent_dataset import LatentSyncNetDataset
+from latentsync.data.clip_sampler import BatchMixer, ClipLocalityDataset
 from latentsync.models.syncnet import SyncNet
 from latentsync.models.syncnet_wav2lip import SyncNetWav2Lip
-from latentsync.utils.util import gather_loss, plot_loss_chart
+from latentsync.utils.util import plot_loss_chart
+from latentsync.utils.metrics import TrainingMetrics
+from latentsync.utils.checkpoint import AsyncCheckpointWriter
 from accelerate.utils import set_seed
 
 import torch
@@ -74,16 +79,36 @@ def main(config):
         vae = None
 
     # Dataset and Dataloader setup
-    train_dataset = SyncNetDataset(config.data.train_data_dir, config.data.train_fileslist, config)
+    use_latent_cache = config.data.get("latent_cache_dir", "") != ""
+    if use_latent_cache:
+        assert config.data.latent_space, "The latent cache is only used for training in the latent space"
+        train_dataset = LatentSyncNetDataset(config.data.train_data_dir, config.data.train_fileslist, config)
+    elif config.data.get("train_shards_dir", "") != "":
+        train_dataset = ShardSyncNetDataset(config.data.train_shards_dir, config)
+    else:
+        train_dataset = SyncNetDataset(config.data.train_data_dir, config.data.train_fileslist, config)
     val_dataset = SyncNetDataset(config.data.val_data_dir, config.data.val_fileslist, config)
 
-    train_distributed_sampler = DistributedSampler(
-        train_dataset,
-        num_replicas=num_processes,
-        rank=global_rank,
-        shuffle=True,
-        seed=config.run.seed,
-    )
+    if config.data.get("clip_windows_per_video", 0) > 0:
+        # Several windows per opened video, the dataset then splits the videos between the ranks itself
+        train_dataset = ClipLocalityDataset(
+            train_dataset,
+            windows_per_video=config.data.clip_windows_per_video,
+            span_frames=config.data.clip_span_frames,
+            shuffle_buffer_size=config.data.clip_shuffle_buffer_size,
+            num_replicas=num_processes,
+            rank=global_rank,
+            seed=config.run.seed,
+        )
+        train_distributed_sampler = None
+    else:
+        train_distributed_sampler = DistributedSampler(
+            train_dataset,
+            num_replicas=num_processes,
+            rank=global_rank,
+            shuffle=True,
+            seed=config.run.seed,
+        )
 
     # DataLoaders creation:
     train_dataloader = torch.utils.data.DataLoader(
@@ -96,6 +121,9 @@ def main(config):
         drop_last=True,
         worker_init_fn=train_dataset.worker_init_fn,
     )
+    if train_distributed_sampler is None and config.data.num_workers > 1:
+        # A batch of the IterableDataset comes from a single worker, the consecutive batches of the workers are mixed
+        train_dataloader = BatchMixer(train_dataloader, num_batches=config.data.num_workers)
     
     num_samples_limit = 640
 
@@ -127,6 +155,8 @@ def main(config):
         ckpt = torch.load(config.ckpt.resume_ckpt_path, map_location=device)
 
         syncnet.load_state_dict(ckpt["state_dict"])
+        if "optimizer" in ckpt:
+            optimizer.load_state_dict(ckpt["optimizer"])
         global_step = ckpt["global_step"]
         train_step_list = ckpt["train_step_list"]
         train_loss_list = ckpt["train_loss_list"]
@@ -163,21 +193,46 @@ def main(config):
         range(0, config.run.max_train_steps), initial=global_step, desc="Steps", disable=not is_main_process
     )
 
+    # The loss is reduced across ranks every metrics_interval steps, along with the step and data wait times
+    metrics = TrainingMetrics(
+        ["loss"],
+        device,
+        config.data.batch_size,
+        interval=config.run.get("metrics_interval", 10),
+        log_path=os.path.join(output_dir, "train_log.jsonl"),
+    )
+    metrics.history["loss"] = (train_step_list, train_loss_list)
+
     # Support mixed-precision training
     scaler = torch.cuda.amp.GradScaler() if config.run.mixed_precision_training else None
+    if scaler is not None and config.ckpt.resume_ckpt_path != "" and "scaler" in ckpt:
+        scaler.load_state_dict(ckpt["scaler"])
+
+    if is_main_process:
+        checkpoint_writer = AsyncCheckpointWriter(
+            os.path.join(output_dir, "checkpoints"),
+            keep_last=config.ckpt.get("keep_last_ckpts", 0),
+            max_pending=config.ckpt.get("max_pending_ckpts", 2),
+        )
 
     for epoch in range(first_epoch, num_train_epochs):
-        train_dataloader.sampler.set_epoch(epoch)
+        if train_distributed_sampler is not None:
+            train_distributed_sampler.set_epoch(epoch)
+        else:
+            train_dataset.set_epoch(epoch)
         syncnet.train()
 
-        for step, batch in enumerate(train_dataloader):
+        for step, batch in enumerate(metrics.timed(train_dataloader)):
             ### >>>> Training >>>> ###
 
             frames = batch["frames"].to(device, dtype=torch.float16)
             audio_samples = batch["audio_samples"].to(device, dtype=torch.float16)
             y = batch["y"].to(device, dtype=torch.float32)
 
-            if config.data.latent_space:
+            if use_latent_cache:
+                # Sampled from the cached posteriors by the dataset workers, the VAE encoder is skipped
+                frames = rearrange(frames * 0.18215, "b f c h w -> b (f c) h w")
+            elif config.data.latent_space:
                 max_batch_size = (
                     num_samples_limit // config.data.num_frames
                 )  # due to the limited cuda memory, we split the input frames into parts
@@ -235,9 +290,8 @@ def main(config):
             progress_bar.update(1)
             global_step += 1
 
-            global_average_loss = gather_loss(loss, device)
-            train_step_list.append(global_step)
-            train_loss_list.append(global_average_loss)
+            metrics.update("loss", loss)
+            metrics.step(global_step)
 
             if is_main_process and global_step % config.run.validation_steps == 0:
                 logger.info(f"Validation at step {global_step}")
@@ -257,29 +311,32 @@ def main(config):
 
             if is_main_process and global_step % config.ckpt.save_ckpt_steps == 0:
                 checkpoint_save_path = os.path.join(output_dir, f"checkpoints/checkpoint-{global_step}.pt")
-                torch.save(
-                    {
-                        "state_dict": syncnet.module.state_dict(),  # to unwrap DDP
-                        "global_step": global_step,
-                        "train_step_list": train_step_list,
-                        "train_loss_list": train_loss_list,
-                        "val_step_list": val_step_list,
-                        "val_loss_list": val_loss_list,
-                    },
-                    checkpoint_save_path,
-                )
-                logger.info(f"Saved checkpoint to {checkpoint_save_path}")
+                checkpoint = {
+                    "state_dict": syncnet.module.state_dict(),  # to unwrap DDP
+                    "global_step": global_step,
+                    "train_step_list": train_step_list,
+                    "train_loss_list": train_loss_list,
+                    "val_step_list": val_step_list,
+                    "val_loss_list": val_loss_list,
+                    "optimizer": optimizer.state_dict(),
+                }
+                if scaler is not None:
+                    checkpoint["scaler"] = scaler.state_dict()
+                checkpoint_writer.save(checkpoint, checkpoint_save_path)
                 plot_loss_chart(
                     os.path.join(output_dir, f"loss_charts/loss_chart-{global_step}.png"),
                     ("Train loss", train_step_list, train_loss_list),
                     ("Val loss", val_step_list, val_loss_list),
                 )
 
-            progress_bar.set_postfix({"step_loss": global_average_loss})
+            progress_bar.set_postfix(metrics.latest)
             if global_step >= config.run.max_train_steps:
                 break
 
     progress_bar.close()
+    metrics.close()
+    if is_main_process:
+        checkpoint_writer.close()
     dist.destroy_process_group()
 
 
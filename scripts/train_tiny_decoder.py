@@ -0,0 +1,111 @@
+# Copyright (c) 2024 Bytedance Ltd. and/or its affiliates
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import argparse
+
+import torch
+import torch.nn.functional as F
+from tqdm.auto import tqdm
+from einops import rearrange
+from omegaconf import OmegaConf
+from diffusers import AutoencoderKL
+from accelerate.utils import set_seed
+
+from latentsync.data.unet_dataset import UNetDataset
+from latentsync.models.tiny_decoder import TinyDecoder
+
+
+def main(args):
+    set_seed(args.seed)
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    config = OmegaConf.load(args.unet_config_path)
+
+    # The teacher, the decoder is distilled on the latents the UNet actually works on
+    vae = AutoencoderKL.from_pretrained("stabilityai/sd-vae-ft-mse", torch_dtype=torch.float16)
+    vae.config.scaling_factor = 0.18215
+    vae.requires_grad_(False)
+    vae.to(device)
+
+    decoder = TinyDecoder().to(device)
+    if args.resume_ckpt_path != "":
+        decoder.load_state_dict(torch.load(args.resume_ckpt_path, map_location=device)["state_dict"])
+    decoder.train()
+    optimizer = torch.optim.AdamW(decoder.parameters(), lr=args.lr)
+
+    if args.lpips_loss_weight != 0:
+        import lpips
+
+        lpips_loss_func = lpips.LPIPS(net="vgg").to(device)
+
+    # Only the face frames are needed, the audio isn't loaded
+    config.run.use_syncnet = False
+    config.data.precomputed_audio_embeds = False
+    train_dataset = UNetDataset(config.data.train_data_dir, config)
+    train_dataloader = torch.utils.data.DataLoader(
+        train_dataset,
+        batch_size=args.batch_size,
+        shuffle=True,
+        num_workers=args.num_workers,
+        drop_last=True,
+        worker_init_fn=train_dataset.worker_init_fn,
+    )
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    progress_bar = tqdm(range(args.max_train_steps))
+    global_step = 0
+    while global_step < args.max_train_steps:
+        for batch in train_dataloader:
+            images = rearrange(batch["gt"], "b f c h w -> (b f) c h w").to(device, dtype=torch.float16)
+            with torch.no_grad():
+                latents = vae.encode(images).latent_dist.sample() * vae.config.scaling_factor
+                target = vae.decode(latents / vae.config.scaling_factor).sample.float()
+
+            pred = decoder(latents.float())
+            loss = F.l1_loss(pred, target)
+            if args.lpips_loss_weight != 0:
+                loss = loss + args.lpips_loss_weight * lpips_loss_func(pred, target).mean()
+
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+
+            global_step += 1
+            progress_bar.update(1)
+            progress_bar.set_postfix(loss=loss.item())
+
+            if global_step % args.save_ckpt_steps == 0 or global_step == args.max_train_steps:
+                ckpt_path = os.path.join(args.output_dir, f"tiny_decoder-{global_step}.pt")
+                torch.save({"state_dict": decoder.state_dict(), "global_step": global_step}, ckpt_path)
+                print(f"Saved checkpoint to {ckpt_path}")
+
+            if global_step >= args.max_train_steps:
+                break
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Distill the tiny preview decoder from sd-vae-ft-mse")
+    parser.add_argument("--unet_config_path", type=str, default="configs/unet/first_stage.yaml")
+    parser.add_argument("--output_dir", type=str, default="output/tiny_decoder")
+    parser.add_argument("--resume_ckpt_path", type=str, default="")
+    parser.add_argument("--batch_size", type=int, default=4, help="videos per batch, each gives num_frames images")
+    parser.add_argument("--num_workers", type=int, default=8)
+    parser.add_argument("--lr", type=float, default=2e-4)
+    parser.add_argument("--lpips_loss_weight", type=float, default=0.1)
+    parser.add_argument("--max_train_steps", type=int, default=100000)
+    parser.add_argument("--save_ckpt_steps", type=int, default=5000)
+    parser.add_argument("--seed", type=int, default=1247)
+    args = parser.parse_args()
+
+    main(args)
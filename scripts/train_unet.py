@@ -13,11 +13,14 @@
 # limitations under the License.
 
 import os
+import sys
 import math
 import argparse
+import subprocess
 import shutil
 import datetime
 import logging
+from functools import partial
 from omegaconf import OmegaConf
 
 from tqdm.auto import tqdm
@@ -37,20 +40,27 @@ from diffusers.utils.import_utils import is_xformers_available
 from accelerate.utils import set_seed
 
 from latentsync.data.unet_dataset import UNetDataset
+from latentsync.data.shards import ShardUNetDataset
+from latentsync.data.latent_dataset import LatentUNetDataset
+from latentsync.data.clip_sampler import BatchMixer, ClipLocalityDataset
 from latentsync.models.unet import UNet3DConditionModel
 from latentsync.models.syncnet import SyncNet
 from latentsync.pipelines.lipsync_pipeline import LipsyncPipeline
+from latentsync.utils.vae_decode import decode_lower_half
+from latentsync.utils.checkpoint import AsyncCheckpointWriter, load_checkpoint
 from latentsync.utils.util import (
     init_dist,
     cosine_loss,
     reversed_forward,
 )
-from latentsync.utils.util import plot_loss_chart, gather_loss
+from latentsync.utils.util import plot_loss_chart
+from latentsync.utils.metrics import TrainingMetrics
 from latentsync.whisper.audio2feature import Audio2Feature
 from latentsync.trepa import TREPALoss
 from eval.syncnet import SyncNetEval
 from eval.syncnet_detect import SyncNetDetector
 from eval.eval_sync_conf import syncnet_eval
+from scripts.validate_unet import FINISHED_NAME, METRICS_NAME, checkpoint_done
 import lpips
 
 
@@ -99,10 +109,19 @@ def main(config):
     vae.requires_grad_(False)
     vae.to(device)
 
-    syncnet_eval_model = SyncNetEval(device=device)
-    syncnet_eval_model.loadParameters("checkpoints/auxiliary/syncnet_v2.model")
+    # Validate in a separate evaluator process (scripts/validate_unet.py) that watches the checkpoints
+    async_validation = config.run.get("async_validation", False)
+    if async_validation and config.run.get("validation_device", "") == "":
+        # On a training GPU the evaluator competes with the training for compute and memory and slows down every rank
+        raise ValueError(
+            "run.async_validation requires run.validation_device, preferably a GPU that isn't used for training"
+        )
 
-    syncnet_detector = SyncNetDetector(device=device, detect_results_dir="detect_results")
+    if not async_validation:
+        syncnet_eval_model = SyncNetEval(device=device)
+        syncnet_eval_model.loadParameters("checkpoints/auxiliary/syncnet_v2.model")
+
+        syncnet_detector = SyncNetDetector(device=device, detect_results_dir="detect_results")
 
     if config.model.cross_attention_dim == 768:
         whisper_model_path = "checkpoints/whisper/small.pt"
@@ -111,12 +130,22 @@ def main(config):
     else:
         raise NotImplementedError("cross_attention_dim must be 768 or 384")
 
-    audio_encoder = Audio2Feature(
-        model_path=whisper_model_path,
-        device=device,
-        audio_embeds_cache_dir=config.data.audio_embeds_cache_dir,
-        num_frames=config.data.num_frames,
-    )
+    if config.model.add_audio_layer and not config.data.get("precomputed_audio_embeds", True):
+        # The training step doesn't run whisper, the dataset workers crop the precomputed features
+        raise ValueError(
+            "data.precomputed_audio_embeds is required, precompute the whisper features with "
+            "preprocess/build_feature_store.py --feature whisper"
+        )
+
+    if not async_validation:
+        # Only the validation pipeline runs whisper
+        audio_encoder = Audio2Feature(
+            model_path=whisper_model_path,
+            device=device,
+            audio_embeds_cache_dir=config.data.audio_embeds_cache_dir,
+            num_frames=config.data.num_frames,
+            audio_embeds_store_dir=config.data.get("audio_embeds_store_dir", ""),
+        )
 
     unet, resume_global_step = UNet3DConditionModel.from_pretrained(
         OmegaConf.to_container(config.model),
@@ -157,14 +186,35 @@ def main(config):
         unet.enable_gradient_checkpointing()
 
     # Get the training dataset
-    train_dataset = UNetDataset(config.data.train_data_dir, config)
-    distributed_sampler = DistributedSampler(
-        train_dataset,
-        num_replicas=num_processes,
-        rank=global_rank,
-        shuffle=True,
-        seed=config.run.seed,
-    )
+    use_latent_cache = config.data.get("latent_cache_dir", "") != ""
+    if use_latent_cache:
+        if config.run.pixel_space_supervise:
+            raise ValueError("The latent cache has no ground truth images, it requires pixel_space_supervise off")
+        train_dataset = LatentUNetDataset(config.data.train_data_dir, config)
+    elif config.data.get("train_shards_dir", "") != "":
+        train_dataset = ShardUNetDataset(config.data.train_shards_dir, config)
+    else:
+        train_dataset = UNetDataset(config.data.train_data_dir, config)
+    if config.data.get("clip_windows_per_video", 0) > 0:
+        # Several windows per opened video, the dataset then splits the videos between the ranks itself
+        train_dataset = ClipLocalityDataset(
+            train_dataset,
+            windows_per_video=config.data.clip_windows_per_video,
+            span_frames=config.data.clip_span_frames,
+            shuffle_buffer_size=config.data.clip_shuffle_buffer_size,
+            num_replicas=num_processes,
+            rank=global_rank,
+            seed=config.run.seed,
+        )
+        distributed_sampler = None
+    else:
+        distributed_sampler = DistributedSampler(
+            train_dataset,
+            num_replicas=num_processes,
+            rank=global_rank,
+            shuffle=True,
+            seed=config.run.seed,
+        )
 
     # DataLoaders creation:
     train_dataloader = torch.utils.data.DataLoader(
@@ -177,6 +227,9 @@ def main(config):
         drop_last=True,
         worker_init_fn=train_dataset.worker_init_fn,
     )
+    if distributed_sampler is None and config.data.num_workers > 1:
+        # A batch of the IterableDataset comes from a single worker, the consecutive batches of the workers are mixed
+        train_dataloader = BatchMixer(train_dataloader, num_batches=config.data.num_workers)
 
     # Get the training iteration
     if config.run.max_train_steps == -1:
@@ -191,6 +244,14 @@ def main(config):
         num_training_steps=config.run.max_train_steps,
     )
 
+    # Decode only the lower half of the predicted frames, the only pixels LPIPS and a lower-half SyncNet look at
+    lower_half_decode = config.run.pixel_space_supervise and config.run.get("lower_half_decode", False)
+    if lower_half_decode:
+        if config.run.trepa_loss_weight != 0:
+            raise ValueError("lower_half_decode can't be used with the TREPA loss, it needs the whole frames")
+        if config.model.add_audio_layer and config.run.use_syncnet and not syncnet_config.data.lower_half:
+            raise ValueError("lower_half_decode requires a SyncNet trained on the lower half")
+
     if config.run.perceptual_loss_weight != 0 and config.run.pixel_space_supervise:
         lpips_loss_func = lpips.LPIPS(net="vgg").to(device)
 
@@ -198,13 +259,31 @@ def main(config):
         trepa_loss_func = TREPALoss(device=device)
 
     # Validation pipeline
-    pipeline = LipsyncPipeline(
-        vae=vae,
-        audio_encoder=audio_encoder,
-        unet=unet,
-        scheduler=noise_scheduler,
-    ).to(device)
-    pipeline.set_progress_bar_config(disable=True)
+    if async_validation:
+        if is_main_process:
+            subprocess.Popen(
+                [
+                    sys.executable,
+                    "-m",
+                    "scripts.validate_unet",
+                    "--unet_config_path",
+                    config.unet_config_path,
+                    "--train_output_dir",
+                    output_dir,
+                    "--device",
+                    config.run.validation_device,
+                    "--parent_pid",
+                    str(os.getpid()),
+                ]
+            )
+    else:
+        pipeline = LipsyncPipeline(
+            vae=vae,
+            audio_encoder=audio_encoder,
+            unet=unet,
+            scheduler=noise_scheduler,
+        ).to(device)
+        pipeline.set_progress_bar_config(disable=True)
 
     # DDP warpper
     unet = DDP(unet, device_ids=[local_rank], output_device=local_rank)
@@ -235,9 +314,14 @@ def main(config):
         disable=not is_main_process,
     )
 
-    train_step_list = []
-    sync_loss_list = []
-    recon_loss_list = []
+    # The losses are reduced across ranks every metrics_interval steps, along with the step and data wait times
+    metrics = TrainingMetrics(
+        ["loss", "recon_loss", "sync_loss"],
+        device,
+        config.data.batch_size,
+        interval=config.run.get("metrics_interval", 10),
+        log_path=os.path.join(output_dir, "train_log.jsonl"),
+    )
 
     val_step_list = []
     sync_conf_list = []
@@ -245,50 +329,73 @@ def main(config):
     # Support mixed-precision training
     scaler = torch.cuda.amp.GradScaler() if config.run.mixed_precision_training else None
 
+    # Resume the optimization state too when the checkpoint was saved by this script
+    if config.ckpt.resume_ckpt_path != "":
+        resume_ckpt = load_checkpoint(config.ckpt.resume_ckpt_path)
+        if "optimizer" in resume_ckpt:
+            optimizer.load_state_dict(resume_ckpt["optimizer"])
+            lr_scheduler.load_state_dict(resume_ckpt["lr_scheduler"])
+            if scaler is not None and "scaler" in resume_ckpt:
+                scaler.load_state_dict(resume_ckpt["scaler"])
+        del resume_ckpt
+
+    if is_main_process:
+        # The old checkpoints are only removed once the evaluator is done with them, up to max_unvalidated_ckpts
+        removable = partial(checkpoint_done, os.path.join(output_dir, METRICS_NAME)) if async_validation else None
+        checkpoint_writer = AsyncCheckpointWriter(
+            os.path.join(output_dir, "checkpoints"),
+            keep_last=config.ckpt.get("keep_last_ckpts", 0),
+            max_pending=config.ckpt.get("max_pending_ckpts", 2),
+            removable=removable,
+            max_unvalidated=config.ckpt.get("max_unvalidated_ckpts", 4),
+        )
+
     for epoch in range(first_epoch, num_train_epochs):
-        train_dataloader.sampler.set_epoch(epoch)
+        if distributed_sampler is not None:
+            distributed_sampler.set_epoch(epoch)
+        else:
+            train_dataset.set_epoch(epoch)
         unet.train()
 
-        for step, batch in enumerate(train_dataloader):
+        for step, batch in enumerate(metrics.timed(train_dataloader)):
             ### >>>> Training >>>> ###
 
             if config.model.add_audio_layer:
                 if batch["mel"] != []:
                     mel = batch["mel"].to(device, dtype=torch.float16)
 
-                audio_embeds_list = []
-                try:
-                    for idx in range(len(batch["video_path"])):
-                        video_path = batch["video_path"][idx]
-                        start_idx = batch["start_idx"][idx]
-
-                        with torch.no_grad():
-                            audio_feat = audio_encoder.audio2feat(video_path)
-                        audio_embeds = audio_encoder.crop_overlap_audio_window(audio_feat, start_idx)
-                        audio_embeds_list.append(audio_embeds)
-                except Exception as e:
-                    logger.info(f"{type(e).__name__} - {e} - {video_path}")
-                    continue
-                audio_embeds = torch.stack(audio_embeds_list)  # (B, 16, 50, 384)
-                audio_embeds = audio_embeds.to(device, dtype=torch.float16)
+            if config.model.add_audio_layer:
+                # Cropped from the precomputed features by the dataset workers
+                audio_embeds = batch["audio_embeds"].to(device, dtype=torch.float16)  # (B, 16, 50, 384)
             else:
                 audio_embeds = None
 
-            # Convert videos to latent space
-            gt_images = batch["gt"].to(device, dtype=torch.float16)
-            gt_masked_images = batch["masked_gt"].to(device, dtype=torch.float16)
             mask = batch["mask"].to(device, dtype=torch.float16)
-            ref_images = batch["ref"].to(device, dtype=torch.float16)
-
-            gt_images = rearrange(gt_images, "b f c h w -> (b f) c h w")
-            gt_masked_images = rearrange(gt_masked_images, "b f c h w -> (b f) c h w")
             mask = rearrange(mask, "b f c h w -> (b f) c h w")
-            ref_images = rearrange(ref_images, "b f c h w -> (b f) c h w")
 
-            with torch.no_grad():
-                gt_latents = vae.encode(gt_images).latent_dist.sample()
-                gt_masked_images = vae.encode(gt_masked_images).latent_dist.sample()
-                ref_images = vae.encode(ref_images).latent_dist.sample()
+            if use_latent_cache:
+                # Sampled from the cached posteriors by the dataset workers, the VAE encoder is skipped
+                gt_latents = batch["gt_latents"].to(device, dtype=torch.float16)
+                gt_masked_images = batch["masked_gt_latents"].to(device, dtype=torch.float16)
+                ref_images = batch["ref_latents"].to(device, dtype=torch.float16)
+
+                gt_latents = rearrange(gt_latents, "b f c h w -> (b f) c h w")
+                gt_masked_images = rearrange(gt_masked_images, "b f c h w -> (b f) c h w")
+                ref_images = rearrange(ref_images, "b f c h w -> (b f) c h w")
+            else:
+                # Convert videos to latent space
+                gt_images = batch["gt"].to(device, dtype=torch.float16)
+                gt_masked_images = batch["masked_gt"].to(device, dtype=torch.float16)
+                ref_images = batch["ref"].to(device, dtype=torch.float16)
+
+                gt_images = rearrange(gt_images, "b f c h w -> (b f) c h w")
+                gt_masked_images = rearrange(gt_masked_images, "b f c h w -> (b f) c h w")
+                ref_images = rearrange(ref_images, "b f c h w -> (b f) c h w")
+
+                with torch.no_grad():
+                    gt_latents = vae.encode(gt_images).latent_dist.sample()
+                    gt_masked_images = vae.encode(gt_masked_images).latent_dist.sample()
+                    ref_images = vae.encode(ref_images).latent_dist.sample()
 
             mask = torch.nn.functional.interpolate(mask, size=config.data.resolution // vae_scale_factor)
 
@@ -352,14 +459,23 @@ def main(config):
 
             pred_latents = reversed_forward(noise_scheduler, pred_noise, timesteps, noisy_tensor)
 
-            if config.run.pixel_space_supervise:
+            if lower_half_decode:
+                pred_images = decode_lower_half(
+                    vae,
+                    rearrange(pred_latents, "b c f h w -> (b f) c h w") / vae.config.scaling_factor
+                    + vae.config.shift_factor,
+                )
+            elif config.run.pixel_space_supervise:
                 pred_images = vae.decode(
                     rearrange(pred_latents, "b c f h w -> (b f) c h w") / vae.config.scaling_factor
                     + vae.config.shift_factor
                 ).sample
 
             if config.run.perceptual_loss_weight != 0 and config.run.pixel_space_supervise:
-                pred_images_perceptual = pred_images[:, :, pred_images.shape[2] // 2 :, :]
+                if lower_half_decode:
+                    pred_images_perceptual = pred_images
+                else:
+                    pred_images_perceptual = pred_images[:, :, pred_images.shape[2] // 2 :, :]
                 gt_images_perceptual = gt_images[:, :, gt_images.shape[2] // 2 :, :]
                 lpips_loss = lpips_loss_func(pred_images_perceptual.float(), gt_images_perceptual.float()).mean()
             else:
@@ -378,13 +494,13 @@ def main(config):
                 else:
                     syncnet_input = rearrange(pred_latents, "b c f h w -> b (f c) h w")
 
-                if syncnet_config.data.lower_half:
+                if syncnet_config.data.lower_half and not lower_half_decode:
                     height = syncnet_input.shape[2]
                     syncnet_input = syncnet_input[:, :, height // 2 :, :]
                 ones_tensor = torch.ones((config.data.batch_size, 1)).float().to(device=device)
                 vision_embeds, audio_embeds = syncnet(syncnet_input, mel)
                 sync_loss = cosine_loss(vision_embeds.float(), audio_embeds.float(), ones_tensor).mean()
-                sync_loss_list.append(gather_loss(sync_loss, device))
+                metrics.update("sync_loss", sync_loss)
             else:
                 sync_loss = 0
 
@@ -395,9 +511,9 @@ def main(config):
                 + trepa_loss * config.run.trepa_loss_weight
             )
 
-            train_step_list.append(global_step)
+            metrics.update("loss", loss)
             if config.run.recon_loss_weight != 0:
-                recon_loss_list.append(gather_loss(recon_loss, device))
+                metrics.update("recon_loss", recon_loss)
 
             optimizer.zero_grad()
 
@@ -423,6 +539,7 @@ def main(config):
             lr_scheduler.step()
             progress_bar.update(1)
             global_step += 1
+            metrics.step(global_step)
 
             ### <<<< Training <<<< ###
 
@@ -431,26 +548,28 @@ def main(config):
                 if config.run.recon_loss_weight != 0:
                     plot_loss_chart(
                         os.path.join(output_dir, f"loss_charts/recon_loss_chart-{global_step}.png"),
-                        ("Reconstruction loss", train_step_list, recon_loss_list),
+                        ("Reconstruction loss", *metrics.history["recon_loss"]),
                     )
                 if config.model.add_audio_layer:
-                    if sync_loss_list != []:
+                    if metrics.history["sync_loss"][0] != []:
                         plot_loss_chart(
                             os.path.join(output_dir, f"loss_charts/sync_loss_chart-{global_step}.png"),
-                            ("Sync loss", train_step_list, sync_loss_list),
+                            ("Sync loss", *metrics.history["sync_loss"]),
                         )
                 model_save_path = os.path.join(output_dir, f"checkpoints/checkpoint-{global_step}.pt")
                 state_dict = {
                     "global_step": global_step,
                     "state_dict": unet.module.state_dict(),  # to unwrap DDP
+                    "optimizer": optimizer.state_dict(),
+                    "lr_scheduler": lr_scheduler.state_dict(),
                 }
-                try:
-                    torch.save(state_dict, model_save_path)
-                    logger.info(f"Saved checkpoint to {model_save_path}")
-                except Exception as e:
-                    logger.error(f"Error saving model: {e}")
+                if scaler is not None:
+                    state_dict["scaler"] = scaler.state_dict()
+                # Written and renamed in the background, so the evaluator process never sees a partial checkpoint
+                checkpoint_writer.save(state_dict, model_save_path)
 
-                # Validation
+            # Validation
+            if is_main_process and (global_step % config.ckpt.save_ckpt_steps == 0) and not async_validation:
                 logger.info("Running validation... ")
 
                 validation_video_out_path = os.path.join(output_dir, f"val_videos/val_video_{global_step}.mp4")
@@ -477,7 +596,13 @@ def main(config):
 
                 if config.model.add_audio_layer:
                     try:
-                        _, conf = syncnet_eval(syncnet_eval_model, syncnet_detector, validation_video_out_path, "temp")
+                        _, conf = syncnet_eval(
+                            syncnet_eval_model,
+                            syncnet_detector,
+                            validation_video_out_path,
+                            "temp",
+                            in_memory=config.run.get("syncnet_eval_in_memory", False),
+                        )
                     except Exception as e:
                         logger.info(e)
                         conf = 0
@@ -487,13 +612,20 @@ def main(config):
                         ("Sync confidence", val_step_list, sync_conf_list),
                     )
 
-            logs = {"step_loss": loss.item(), "lr": lr_scheduler.get_last_lr()[0]}
+            # The latest reduced losses, reading loss.item() here would sync every step
+            logs = {**metrics.latest, "lr": lr_scheduler.get_last_lr()[0]}
             progress_bar.set_postfix(**logs)
 
             if global_step >= config.run.max_train_steps:
                 break
 
     progress_bar.close()
+    metrics.close()
+    if is_main_process:
+        checkpoint_writer.close()
+    if is_main_process and async_validation:
+        # The evaluator validates the remaining checkpoints and exits
+        open(os.path.join(output_dir, "checkpoints", FINISHED_NAME), "w").close()
     dist.destroy_process_group()
 
 
@@ -0,0 +1,232 @@
+# Copyright (c) 2024 Bytedance Ltd. and/or its affiliates
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Evaluator process for train_unet.py with run.async_validation. It watches the checkpoints directory of a training run,
+runs the validation pipeline and the SyncNet confidence on every new checkpoint, and appends the results to
+val_metrics.jsonl, so that the training ranks never wait for validation.
+"""
+
+import os
+import json
+import time
+import argparse
+import logging
+
+import torch
+from omegaconf import OmegaConf
+from diffusers import AutoencoderKL, DDIMScheduler
+
+from latentsync.models.unet import UNet3DConditionModel
+from latentsync.pipelines.lipsync_pipeline import LipsyncPipeline
+from latentsync.utils.checkpoint import CHECKPOINT_PATTERN, load_checkpoint
+from latentsync.utils.util import plot_loss_chart
+from latentsync.whisper.audio2feature import Audio2Feature
+from eval.syncnet import SyncNetEval
+from eval.syncnet_detect import SyncNetDetector
+from eval.eval_sync_conf import syncnet_eval
+
+METRICS_NAME = "val_metrics.jsonl"
+FINISHED_NAME = "training_finished"
+
+logger = logging.getLogger(__name__)
+
+
+def pending_checkpoints(checkpoints_dir, validated_steps):
+    checkpoints = []
+    for file in os.listdir(checkpoints_dir):
+        match = CHECKPOINT_PATTERN.match(file)
+        if match is not None and int(match.group(1)) not in validated_steps:
+            checkpoints.append((int(match.group(1)), os.path.join(checkpoints_dir, file)))
+    return sorted(checkpoints)
+
+
+def load_metrics(metrics_path):
+    if not os.path.isfile(metrics_path):
+        return []
+    with open(metrics_path) as f:
+        return [json.loads(line) for line in f]
+
+
+def checkpoint_done(metrics_path, global_step):
+    """Whether the evaluator is done with the checkpoint, validated, failed or skipped, so that it can be removed"""
+    return global_step in {metrics["global_step"] for metrics in load_metrics(metrics_path)}
+
+
+def parent_alive(parent_pid):
+    if parent_pid <= 0:
+        return True
+    try:
+        os.kill(parent_pid, 0)
+    except OSError:
+        return False
+    return True
+
+
+class Evaluator:
+    def __init__(self, config, output_dir, device):
+        self.config = config
+        self.output_dir = output_dir
+        self.device = torch.device(device)
+
+        vae = AutoencoderKL.from_pretrained("stabilityai/sd-vae-ft-mse", torch_dtype=torch.float16)
+        vae.config.scaling_factor = 0.18215
+        vae.config.shift_factor = 0
+
+        if config.model.cross_attention_dim == 768:
+            whisper_model_path = "checkpoints/whisper/small.pt"
+        elif config.model.cross_attention_dim == 384:
+            whisper_model_path = "checkpoints/whisper/tiny.pt"
+        else:
+            raise NotImplementedError("cross_attention_dim must be 768 or 384")
+        audio_encoder = Audio2Feature(
+            model_path=whisper_model_path, device=self.device, num_frames=config.data.num_frames
+        )
+
+        self.unet, _ = UNet3DConditionModel.from_pretrained(OmegaConf.to_container(config.model), "", device="cpu")
+        self.pipeline = LipsyncPipeline(
+            vae=vae,
+            audio_encoder=audio_encoder,
+            unet=self.unet.to(dtype=torch.float16),
+            scheduler=DDIMScheduler.from_pretrained("configs"),
+        ).to(self.device)
+        self.pipeline.set_progress_bar_config(disable=True)
+
+        if config.model.add_audio_layer:
+            # Separate working directories, so that the evaluator doesn't collide with anything in the cwd
+            self.temp_dir = os.path.join(output_dir, "val_temp")
+            self.detect_results_dir = os.path.join(output_dir, "val_detect_results")
+            self.syncnet_eval_model = SyncNetEval(device=self.device)
+            self.syncnet_eval_model.loadParameters("checkpoints/auxiliary/syncnet_v2.model")
+            self.syncnet_detector = SyncNetDetector(device=self.device, detect_results_dir=self.detect_results_dir)
+
+    def validate(self, global_step, ckpt_path):
+        # Memory-mapped, only the weights are read from a checkpoint that also holds the optimizer state
+        state_dict = load_checkpoint(ckpt_path)["state_dict"]
+        self.unet.load_state_dict(state_dict)
+        del state_dict
+
+        video_out_path = os.path.join(self.output_dir, f"val_videos/val_video_{global_step}.mp4")
+        video_mask_path = os.path.join(self.output_dir, "val_videos/val_video_mask.mp4")
+        start_time = time.time()
+        with torch.autocast(device_type=self.device.type, dtype=torch.float16):
+            self.pipeline(
+                self.config.data.val_video_path,
+                self.config.data.val_audio_path,
+                video_out_path,
+                video_mask_path,
+                num_frames=self.config.data.num_frames,
+                num_inference_steps=self.config.run.inference_steps,
+                guidance_scale=self.config.run.guidance_scale,
+                weight_dtype=torch.float16,
+                width=self.config.data.resolution,
+                height=self.config.data.resolution,
+                mask=self.config.data.mask,
+            )
+        metrics = {"global_step": global_step, "video_path": video_out_path}
+
+        if self.config.model.add_audio_layer:
+            try:
+                _, conf = syncnet_eval(
+                    self.syncnet_eval_model,
+                    self.syncnet_detector,
+                    video_out_path,
+                    self.temp_dir,
+                    detect_results_dir=self.detect_results_dir,
+                    in_memory=self.config.run.get("syncnet_eval_in_memory", False),
+                )
+            except Exception as e:
+                # Recorded with a zero confidence like the in-process validation, e.g. when no face is detected
+                logger.warning(f"SyncNet evaluation of checkpoint {global_step} failed: {type(e).__name__} - {e}")
+                metrics["error"] = f"{type(e).__name__}: {e}"
+                conf = 0
+            metrics["sync_conf"] = conf
+        metrics["validation_time"] = time.time() - start_time
+        return metrics
+
+
+def main(args):
+    logging.basicConfig(
+        format="%(asctime)s - %(levelname)s - %(name)s - %(message)s",
+        datefmt="%m/%d/%Y %H:%M:%S",
+        level=logging.INFO,
+    )
+    config = OmegaConf.load(args.unet_config_path)
+    checkpoints_dir = os.path.join(args.train_output_dir, "checkpoints")
+    metrics_path = os.path.join(args.train_output_dir, METRICS_NAME)
+    os.makedirs(os.path.join(args.train_output_dir, "val_videos"), exist_ok=True)
+    os.makedirs(os.path.join(args.train_output_dir, "loss_charts"), exist_ok=True)
+
+    evaluator = Evaluator(config, args.train_output_dir, args.device)
+
+    # Resumable, the checkpoints already in the metrics file are skipped
+    metrics_list = load_metrics(metrics_path)
+    validated_steps = {metrics["global_step"] for metrics in metrics_list}
+
+    while True:
+        # Checked before listing, so that the checkpoints saved right before the end are still validated
+        finished = os.path.isfile(os.path.join(checkpoints_dir, FINISHED_NAME)) or not parent_alive(args.parent_pid)
+        checkpoints = pending_checkpoints(checkpoints_dir, validated_steps)
+        if args.latest_only and len(checkpoints) > 1:
+            # Recorded as skipped, so that ckpt.keep_last_ckpts can remove them
+            with open(metrics_path, "a") as f:
+                for global_step, _ in checkpoints[:-1]:
+                    f.write(json.dumps({"global_step": global_step, "skipped": True}) + "\n")
+            validated_steps.update(global_step for global_step, _ in checkpoints[:-1])
+            checkpoints = checkpoints[-1:]
+
+        for global_step, ckpt_path in checkpoints:
+            # The checkpoint may have been removed by ckpt.keep_last_ckpts since it was listed, or the pipeline may
+            # fail on it, the error is recorded and the evaluator moves on to the next one
+            try:
+                metrics = evaluator.validate(global_step, ckpt_path)
+            except Exception as e:
+                logger.exception(f"Validation of checkpoint {global_step} failed")
+                metrics = {"global_step": global_step, "error": f"{type(e).__name__}: {e}"}
+                torch.cuda.empty_cache()
+            with open(metrics_path, "a") as f:
+                f.write(json.dumps(metrics) + "\n")
+            logger.info(f"Validated checkpoint {global_step}: {metrics}")
+            validated_steps.add(global_step)
+            metrics_list.append(metrics)
+
+            if "sync_conf" in metrics:
+                metrics_list.sort(key=lambda metrics: metrics["global_step"])
+                sync_conf_list = [metrics for metrics in metrics_list if "sync_conf" in metrics]
+                plot_loss_chart(
+                    os.path.join(args.train_output_dir, f"loss_charts/sync_conf_chart-{global_step}.png"),
+                    (
+                        "Sync confidence",
+                        [metrics["global_step"] for metrics in sync_conf_list],
+                        [metrics["sync_conf"] for metrics in sync_conf_list],
+                    ),
+                )
+
+        if finished and len(checkpoints) == 0:
+            break
+        if len(checkpoints) == 0:
+            time.sleep(args.poll_interval)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Validate the checkpoints of a UNet training run as they are saved")
+    parser.add_argument("--unet_config_path", type=str, required=True)
+    parser.add_argument("--train_output_dir", type=str, required=True, help="the run folder, with checkpoints/")
+    parser.add_argument("--device", type=str, default="cuda:0")
+    parser.add_argument("--poll_interval", type=float, default=30)
+    parser.add_argument("--latest_only", action="store_true", help="skip to the newest checkpoint when behind")
+    parser.add_argument("--parent_pid", type=int, default=0, help="exit once this process is gone")
+    args = parser.parse_args()
+
+    main(args)